@@ -9,31 +9,51 @@ The rules are re-written based on the current rule being evaluated.
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import functools
+import hashlib
+import json
+import math
+import random
 import subprocess
 import sys
 import re
 import os
+import tempfile
+import time
 import yaml
 import httpx
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError
 from dotenv import load_dotenv
 
 load_dotenv()  # This loads variables from .env
-# Create an httpx.Client with SSL verification disabled; this is necessary to avoid SSL complications
-# due to the corporate VPN
-http_client = httpx.Client(verify=False)
 
 api_key = os.getenv("OPENAI_API_KEY")
 if not api_key:
     raise ValueError("OPENAI_API_KEY not found in environment variables")
-client = OpenAI(
-    api_key=api_key,
-    http_client=http_client
-)
+
+# Summaries are generated concurrently: up to SUMMARY_WORKERS requests in flight, paced by two token
+# buckets that follow the account's rate limits (requests and tokens per minute; the defaults are the
+# lowest paid tier's gpt-4o limits, set yours in .env). 429s and 5xx are retried with jittered
+# exponential backoff, honouring Retry-After; a 429 also empties the request bucket and halves its
+# rate, so every worker slows down, not just the one that hit it. OPENAI_BASE_URL points the client
+# at fake-openai-api.py to run or benchmark the whole thing offline.
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "16"))
+REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))
+TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "30000"))
+SUMMARY_MAX_TOKENS = 60
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0  # seconds, doubled on every retry
+BACKOFF_CAP = 60.0
+
+_summary_stats = {}
+
+PROMPT_VERSION = 2  # bump whenever the prompts below change, cached summaries made with older ones are then ignored
 
 # Below you find the prompt I'm using. This is an example of how to integrate it, since I don't have
 # a paid subscription to fully test.
-def generate_summary_with_chatgpt(alert_name, expr_text, current_summary=None):
+def build_summary_prompt(alert_name, expr_text, current_summary=None):
     base_prompt = f"""You are a DevOps assistant. Rewrite the summary for a Prometheus alert.
 - It must describe what the alert is about in plain language;
 - It must be a single sentence with no more than 60 characters;
@@ -51,31 +71,290 @@ Expression:
         base_prompt += f"Current summary: {current_summary}\n"
 
     base_prompt += "New summary:"
+    return base_prompt
+
+# Batched prompts: the instructions are sent once for up to SUMMARY_BATCH_SIZE rules, as long as the
+# rules fit in SUMMARY_BATCH_TOKENS, and the answer is a JSON object with one summary per rule id.
+# Summaries that are missing, or break the 60 character rule, are asked for again one rule at a time.
+SUMMARY_BATCH_SIZE = 20  # 1 sends every rule on its own
+SUMMARY_BATCH_TOKENS = 2000
+SUMMARY_MAX_LENGTH = 60
+
+def build_batch_entry(rule_id, alert_name, expr_text, current_summary=None):
+    entry = f"""id: {rule_id}
+Alert: {alert_name}
+Expression:
+{expr_text}
+"""
+    if current_summary:
+        entry += f"Current summary: {current_summary}\n"
+    return entry
 
+def build_batch_prompt(entries):
+    return f"""You are a DevOps assistant. Rewrite the summary for each of the Prometheus alerts below.
+- It must describe what the alert is about in plain language;
+- It must be a single sentence with no more than {SUMMARY_MAX_LENGTH} characters;
+- Use context from the expression and alert name if available;
+- Be concise but clear;
+- Always rewrite if the summary seems too vague or generic;
+- Include obvious metrics (for example time frames) from expression into the summary;
+
+Answer with a JSON object only, in this form, with one entry for every alert id:
+{{"summaries": [{{"id": "<alert id>", "summary": "<new summary>"}}]}}
+
+""" + "\n".join(entries)
+
+def estimate_tokens(text):
+# about 4 characters per token; settled against the reported usage afterwards
+    return len(text) // 4
+
+def pack_batches(jobs):
+# consecutive jobs grouped into batches under both limits; a job too big for any batch goes alone
+    batches = []
+    batch, batch_tokens = [], 0
+    for i, job in enumerate(jobs):
+        tokens = estimate_tokens(build_batch_entry(f"r{len(batch)}", *job))
+        if batch and (len(batch) == SUMMARY_BATCH_SIZE or batch_tokens + tokens > SUMMARY_BATCH_TOKENS):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append((i, job))
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def valid_summary(summary):
+    return (isinstance(summary, str) and 0 < len(summary.strip()) <= SUMMARY_MAX_LENGTH
+            and "\n" not in summary.strip())
+
+def token_bucket(per_minute):
+# holds up to a minute's worth and refills continuously, like the API's own limiter
+    return {"rate": per_minute / 60, "capacity": per_minute, "level": per_minute,
+            "updated": time.monotonic(), "slowed": 0, "lock": asyncio.Lock()}
+
+async def take(bucket, amount):
+# waits until the bucket holds amount and takes it; waiters queue up on the lock in order
+    amount = min(amount, bucket["capacity"])
+    async with bucket["lock"]:
+        while True:
+            now = time.monotonic()
+            bucket["level"] = min(bucket["capacity"], bucket["level"] + (now - bucket["updated"]) * bucket["rate"])
+            bucket["updated"] = now
+            if bucket["level"] >= amount:
+                bucket["level"] -= amount
+                return
+            await asyncio.sleep((amount - bucket["level"]) / bucket["rate"])
+
+def give_back(bucket, amount):
+# settles a reservation once the real usage is known (negative if it was too small), or returns all
+# of it when the request failed
+    bucket["level"] = min(bucket["capacity"], bucket["level"] + amount)
+
+def slow_down(bucket, sent):
+# a 429 means the account's real limit is lower than configured (or shared with something else):
+# empty the bucket and halve its rate for the rest of the run. Requests already in flight when it
+# slowed down were sent at the old rate, so their 429s don't halve it again
+    bucket["level"] = 0
+    if sent > bucket["slowed"]:
+        bucket["rate"] = max(bucket["rate"] / 2, 1 / 60)
+        bucket["slowed"] = time.monotonic()
+
+def retry_delay(attempt, error):
+# the server's Retry-After if it sent one, otherwise "full jitter" backoff, so workers that failed
+# together don't all come back at the same moment
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": base_prompt}],
-            max_tokens=60,
-            temperature=0.3
-        )
+        return float(retry_after) + random.uniform(0, BACKOFF_BASE)
+    except (TypeError, ValueError):
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+async def complete(client, limits, label, prompt, max_tokens, **options):
+# one chat completion through the shared limiter, retried on 429/5xx; None if it failed for good
+    estimate = estimate_tokens(prompt) + max_tokens
+
+    for attempt in range(MAX_RETRIES + 1):
+        await take(limits["requests"], 1)
+        await take(limits["tokens"], estimate)
+        _summary_stats["requests"] += 1
+        sent = time.monotonic()
+        try:
+            response = await client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=max_tokens,
+                temperature=0.3,
+                **options
+            )
+        except (APIStatusError, APIConnectionError) as e:
+            # the tokens only count for completions that came back, a retry reserves them anew
+            give_back(limits["tokens"], estimate)
+            status = getattr(e, "status_code", None)
+            if (status is not None and status != 429 and status < 500) or attempt == MAX_RETRIES:
+                print(f"❌ OpenAI error for {label}: {e}")
+                return None
+            if status == 429:
+                _summary_stats["rate_limited"] += 1
+                slow_down(limits["requests"], sent)
+            _summary_stats["retries"] += 1
+            await asyncio.sleep(retry_delay(attempt, e))
+            continue
+        except Exception as e:
+            give_back(limits["tokens"], estimate)
+            print(f"❌ OpenAI error for {label}: {e}")
+            return None
+
+        if response.usage:
+            give_back(limits["tokens"], estimate - response.usage.total_tokens)
+            _summary_stats["tokens"] += response.usage.total_tokens
+        return response.choices[0].message.content
+
+async def generate_summary_with_chatgpt(client, limits, alert_name, expr_text, current_summary=None):
+    prompt = build_summary_prompt(alert_name, expr_text, current_summary)
+    content = await complete(client, limits, alert_name, prompt, SUMMARY_MAX_TOKENS)
+    return content.strip('" \n') if content is not None else None
+
+async def generate_batch_with_chatgpt(client, limits, batch):
+# batch is [(index, job)]; returns {index: summary} for the rules that came back valid
+    ids = {f"r{n}": i for n, (i, _) in enumerate(batch)}
+    prompt = build_batch_prompt([build_batch_entry(rule_id, *job) for rule_id, (_, job) in zip(ids, batch)])
+    # a summary is at most 60 characters, about 15 tokens, plus its id and the JSON around it
+    content = await complete(client, limits, f"a batch of {len(batch)} alerts", prompt, 30 * len(batch) + 20,
+                             response_format={"type": "json_object"})
+    try:
+        answer = json.loads(content) if content is not None else []
+    except ValueError:
+        print(f"⚠️ Unreadable answer for a batch of {len(batch)} alerts, asking for them one by one")
+        answer = []
+    items = answer.get("summaries", []) if isinstance(answer, dict) else answer
+
+    summaries = {}
+    for item in items if isinstance(items, list) else []:
+        if isinstance(item, dict) and item.get("id") in ids and valid_summary(item.get("summary")):
+            summaries[ids[item["id"]]] = item["summary"].strip()
+    return summaries
+
+async def generate_summaries(jobs):
+# jobs are (alert_name, expr, current_summary); the summaries come back in the same order, None where
+# no summary could be generated
+    _summary_stats.update(requests=0, retries=0, rate_limited=0, tokens=0, batches=0, fallbacks=0)
+    results = [None] * len(jobs)
+    batches = pack_batches(jobs) if SUMMARY_BATCH_SIZE > 1 else [[(i, job)] for i, job in enumerate(jobs)]
+    pending = iter(batches)
+    limits = {"requests": token_bucket(REQUESTS_PER_MINUTE), "tokens": token_bucket(TOKENS_PER_MINUTE)}
+    started = time.monotonic()
+
+    # SSL verification is disabled; this is necessary to avoid SSL complications due to the corporate VPN
+    async with httpx.AsyncClient(verify=False, limits=httpx.Limits(max_connections=SUMMARY_WORKERS)) as http_client:
+        # retries are ours, with the shared limiter in the loop
+        client = AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+        done = 0
+
+        async def worker():
+            nonlocal done
+            for batch in pending:
+                summaries = {}
+                if len(batch) > 1:
+                    _summary_stats["batches"] += 1
+                    summaries = await generate_batch_with_chatgpt(client, limits, batch)
+                for i, job in batch:
+                    if i not in summaries:
+                        if len(batch) > 1:
+                            _summary_stats["fallbacks"] += 1
+                        summaries[i] = await generate_summary_with_chatgpt(client, limits, *job)
+                    results[i] = summaries[i]
+                    done += 1
+                    if done % 100 == 0:
+                        print(f"… {done}/{len(jobs)} summaries generated")
+
+        await asyncio.gather(*(worker() for _ in range(min(SUMMARY_WORKERS, len(batches)))))
+
+    elapsed = time.monotonic() - started
+    stats = _summary_stats
+    generated = sum(1 for summary in results if summary)
+    print(f"Generated {generated}/{len(jobs)} summaries in {elapsed:.1f}s "
+          f"({len(jobs) / elapsed if elapsed else 0:.1f} rules/s, {SUMMARY_WORKERS} workers): "
+          f"{stats['requests']} requests ({stats['batches']} batches, {stats['fallbacks']} single-rule fallbacks), "
+          f"{stats['retries']} retries ({stats['rate_limited']} rate limited), {stats['tokens']} tokens")
+    return results
+
+# Summary cache
+# A rule that didn't change gets the same summary again, so summaries are kept on disk keyed by a hash
+# of everything that goes into the prompt: alert name, expression (whitespace outside string literals
+# normalized), current summary, prompt version and model. Only misses go to the API; identical rules
+# (the same rule installed in several namespaces) cost one call. Entries unused for
+# SUMMARY_CACHE_MAX_AGE are dropped, and past SUMMARY_CACHE_MAX_ENTRIES the least recently used go.
+SUMMARY_CACHE_FILE = os.getenv("SUMMARY_CACHE_FILE", os.path.join(
+    os.path.expanduser("~"), ".cache", "alertmanager-migrator", "summaries.json"))
+SUMMARY_CACHE_MAX_AGE = 30 * 24 * 3600
+SUMMARY_CACHE_MAX_ENTRIES = 100000
+
+def normalize_expr(expr_text):
+# collapses runs of whitespace (line breaks and indentation included) but keeps quoted label values as they are
+    return re.sub(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`[^`]*`)|\s+',
+                  lambda m: m.group(1) or " ", str(expr_text)).strip()
+
+def summary_cache_key(alert_name, expr_text, current_summary=None):
+    material = [PROMPT_VERSION, OPENAI_MODEL, alert_name, normalize_expr(expr_text), current_summary or ""]
+    return hashlib.sha256(json.dumps(material).encode()).hexdigest()
+
+def load_summary_cache():
+    try:
+        with open(SUMMARY_CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_summary_cache(cache):
+# evicts by age and size, then writes to a temp file and renames it, so an interrupted run never
+# leaves a broken cache behind; returns how many entries were evicted
+    now = time.time()
+    entries = {key: entry for key, entry in cache.items() if now - entry["used_at"] < SUMMARY_CACHE_MAX_AGE}
+    if len(entries) > SUMMARY_CACHE_MAX_ENTRIES:
+        recent = sorted(entries, key=lambda key: entries[key]["used_at"], reverse=True)[:SUMMARY_CACHE_MAX_ENTRIES]
+        entries = {key: entries[key] for key in recent}
+    directory = os.path.dirname(SUMMARY_CACHE_FILE) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(entries, f)
+    os.replace(tmp, SUMMARY_CACHE_FILE)
+    return len(cache) - len(entries)
+
+def cached_summaries(jobs):
+# like generate_summaries, but only the jobs without a cached summary are sent
+    cache = load_summary_cache() if ENABLE_SUMMARY_CACHE else {}
+    now = time.time()
+    keys = [summary_cache_key(*job) for job in jobs]
+    misses = {}
+    for key, job in zip(keys, jobs):
+        if key in cache:
+            cache[key]["used_at"] = now
+        else:
+            misses.setdefault(key, job)
+    hits = sum(1 for key in keys if key not in misses)
 
-        summary = response.choices[0].message.content.strip('" \n')
-        print(f"\n✅ ChatGPT response: {summary}")
-        return summary
+    if misses:
+        for key, summary in zip(misses, asyncio.run(generate_summaries(list(misses.values())))):
+            # failures aren't cached, the next run tries them again
+            if summary:
+                cache[key] = {"summary": summary, "used_at": now}
 
-    except Exception as e:
-        print(f"❌ OpenAI error: {e}")
-        return None
+    if ENABLE_SUMMARY_CACHE:
+        evicted = save_summary_cache(cache)
+        print(f"Summary cache: {hits} hits, {len(jobs) - hits} misses ({len(misses)} API lookups), "
+              f"{evicted} evicted, {len(cache) - evicted} entries in {SUMMARY_CACHE_FILE}")
+    return [cache[key]["summary"] if key in cache else None for key in keys]
 
 RULES_FILE = "rules.txt"
 ENABLE_FLATTEN = True  # Toggle this to False to skip flattening
 ENABLE_CHATGPT_SUMMARY = False # Toggle this to True to make ChatGPT rewrite the summaries
+ENABLE_SUMMARY_CACHE = True  # Toggle this to False to regenerate every summary
 
 def run_kubectl_get_rules():
     try:
         result = subprocess.run(
-            ["kubectl", "get", "prometheusrule", "--all-namespaces", "-o", "yaml"],
+            ["kubectl", "get", "prometheusrule", "--all-namespaces", "-o", "json"],
             capture_output=True,
             check=True,
             text=True
@@ -85,108 +364,199 @@ def run_kubectl_get_rules():
         print("Failed to retrieve Prometheus rules:", e.stderr)
         sys.exit(1)
 
-def write_rules_to_file(data):
-    with open(RULES_FILE, "w") as f:
-        f.write(data)
-    print(f"Rules written to {RULES_FILE}")
-
-def flatten_descriptions_in_file():
+# The rules go through the run once. With summaries to rewrite, they are fetched as JSON (parsed by
+# the C json module, many times faster than building them from YAML), flattened, given new summaries
+# and serialized, each stage handing the parsed rules to the next. Without, nothing needs the whole
+# list: kubectl's YAML is flattened on the event stream as it arrives and emitted straight into
+# rules.txt, in constant memory. rules.txt is written once, to a temp file renamed over it, so an
+# interrupted run never leaves half a file; how long each stage took is printed at the end.
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)  # libyaml's C parser/emitter when available
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+FLATTEN_KEYS = ("description", "summary")
+NODE_EVENTS = {yaml.ScalarEvent, yaml.AliasEvent, yaml.MappingStartEvent, yaml.SequenceStartEvent}
+
+_stage_timings = {}
+
+def run_stage(name, fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    _stage_timings[name] = time.perf_counter() - started
+    return result
+
+def parse_rules(rules_json):
+    data = json.loads(rules_json)
+    print("✅ Rules loaded.")
+    print("Top-level keys:", list(data.keys()) if isinstance(data, dict) else "⚠️ Empty")
+    return data
+
+def fold_text(text):
+    return " ".join(line.strip() for line in text.splitlines() if line.strip())
+
+def flatten_descriptions(data):
+# every description/summary string, at any depth, folded to one line
     print("Flattening multiline 'description' and 'summary' annotations...")
-
-    with open(RULES_FILE, "r") as f:
-        lines = f.readlines()
-
-    new_lines = []
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        match = re.match(r'^(\s*)(description|summary):\s*(.*)', line)
-
-        if match:
-            indent = match.group(1)
-            key = match.group(2)
-            inline_value = match.group(3).strip()
-            value_lines = []
-
-            # Start with any value on the same line
-            if inline_value:
-                value_lines.append(inline_value)
-
-            i += 1
-            while i < len(lines):
-                next_line = lines[i]
-                next_indent = len(next_line) - len(next_line.lstrip())
-                if next_indent > len(indent):
-                    value_lines.append(next_line.strip())
-                    i += 1
+    pending = [data]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key in FLATTEN_KEYS and isinstance(value, str):
+                    node[key] = fold_text(value)
                 else:
-                    break
-
-            flat_text = ' '.join(value_lines)
-
-            # Escape single quotes by doubling them (YAML single-quote rule)
-            escaped_text = flat_text.replace("'", "''")
+                    pending.append(value)
+        elif isinstance(node, list):
+            pending.extend(node)
+    print("Flattening complete.")
 
-            # Use single quotes to safely wrap the entire string
-            new_lines.append(f"{indent}{key}: '{escaped_text}'\n")
+def flatten_events(events):
+# one entry per open collection: for mappings [True while the next node is a key, the last key], None for
+# sequences and the document level. Events are told apart by exact type, the hot loop runs once per node
+    stack = [None]
+    for event in events:
+        kind = type(event)
+        if kind in NODE_EVENTS:
+            parent = stack[-1]
+            if parent is not None:
+                if parent[0]:
+                    parent[1] = event.value if kind is yaml.ScalarEvent else None
+                elif kind is yaml.ScalarEvent and parent[1] in FLATTEN_KEYS:
+                    # untagged scalars need the quoted form marked implicit, or the emitter asks for a tag
+                    implicit = (False, True) if event.tag is None else event.implicit
+                    event = yaml.ScalarEvent(event.anchor, event.tag, implicit, fold_text(event.value), style="'")
+                parent[0] = not parent[0]
+            if kind is yaml.MappingStartEvent:
+                stack.append([True, None])
+            elif kind is yaml.SequenceStartEvent:
+                stack.append(None)
+        elif kind is yaml.MappingEndEvent or kind is yaml.SequenceEndEvent:
+            stack.pop()
+        yield event
+
+def copy_rules(source, target):
+    events = yaml.parse(source, Loader=YAML_LOADER)
+    emit_rules(flatten_events(events) if ENABLE_FLATTEN else events, target)
+
+def stream_rules(target):
+# kubectl's YAML through flatten_events into target, as it arrives
+    with tempfile.TemporaryFile() as errors:
+        kubectl = subprocess.Popen(["kubectl", "get", "prometheusrule", "--all-namespaces", "-o", "yaml"],
+                                   stdout=subprocess.PIPE, stderr=errors)
+        try:
+            copy_rules(kubectl.stdout, target)
+        except BaseException:
+            kubectl.kill()
+            raise
+        finally:
+            kubectl.stdout.close()
+            kubectl.wait()
+        if kubectl.returncode:
+            errors.seek(0)
+            raise subprocess.CalledProcessError(kubectl.returncode, kubectl.args, stderr=errors.read().decode())
+
+_yaml_resolver = yaml.resolver.Resolver()
+_MAPPING_END = object()
+_SEQUENCE_END = object()
+
+@functools.lru_cache(maxsize=65536)
+def plain_is_str(value):
+# whether the string reads back as a string unquoted ("true", "10", "null" don't); keys and short
+# values repeat a lot, hence the cache
+    return _yaml_resolver.resolve(yaml.ScalarNode, value, (True, False)) == "tag:yaml.org,2002:str"
+
+def float_text(value):
+# the YAML 1.1 spelling SafeLoader reads back as a float: repr() gives "inf", "nan" and "1e-05",
+# which it reads as strings
+    if value != value:
+        return ".nan"
+    if value in (math.inf, -math.inf):
+        return ".inf" if value > 0 else "-.inf"
+    text = repr(value)
+    return text.replace("e", ".0e", 1) if "e" in text and "." not in text else text
+
+def rules_events(data):
+# YAML events for the parsed JSON, built directly instead of through PyYAML's Python representer,
+# so the C emitter does nearly all the work. Multi-line strings (expressions, unflattened
+# annotations) are asked for as | blocks, like kubectl prints them; the emitter quotes whatever needs it
+    yield yaml.StreamStartEvent()
+    yield yaml.DocumentStartEvent(explicit=False)
+    pending = [data]
+    while pending:
+        node = pending.pop()
+        kind = type(node)
+        if kind is str:
+            yield yaml.ScalarEvent(None, None, (plain_is_str(node), True), node, style="|" if "\n" in node else None)
+        elif kind is dict:
+            yield yaml.MappingStartEvent(None, None, True, flow_style=False)
+            pending.append(_MAPPING_END)
+            for key, value in reversed(node.items()):
+                pending.append(value)
+                pending.append(key)
+        elif kind is list:
+            yield yaml.SequenceStartEvent(None, None, True, flow_style=False)
+            pending.append(_SEQUENCE_END)
+            pending.extend(reversed(node))
+        elif node is _MAPPING_END:
+            yield yaml.MappingEndEvent()
+        elif node is _SEQUENCE_END:
+            yield yaml.SequenceEndEvent()
         else:
-            new_lines.append(line)
-            i += 1
+            if node is None:
+                text = "null"
+            elif kind is bool:
+                text = "true" if node else "false"
+            else:
+                text = float_text(node) if kind is float else repr(node)
+            yield yaml.ScalarEvent(None, None, (True, False), text)
+    yield yaml.DocumentEndEvent(explicit=False)
+    yield yaml.StreamEndEvent()
 
-    with open(RULES_FILE, "w") as f:
-        f.writelines(new_lines)
-
-    print("Flattening complete.")
+def emit_rules(events, target):
+    yaml.emit(events, target, Dumper=YAML_DUMPER, width=2 ** 31 - 1, allow_unicode=True)
 
+def write_rules_file(write):
+# write(f) fills a temp file next to rules.txt, which is renamed over it once complete
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(RULES_FILE)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            write(f)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    os.replace(tmp, RULES_FILE)
+    print(f"Rules written to {RULES_FILE}")
 
-def enhance_summaries_with_chatgpt():
+def enhance_summaries_with_chatgpt(data):
     print("Enhancing summaries with ChatGPT...")
 
-    try:
-        with open(RULES_FILE, "r") as f:
-            data = yaml.safe_load(f)
-            print("✅ YAML structure loaded.")
-            print("Top-level keys:", list(data.keys()) if data else "⚠️ Empty")
-    except yaml.YAMLError as e:
-        print(f"❌ Failed to parse YAML: {e}")
-        return
-
     modified = False
-    items = data.get("items", [])
+    items = (data or {}).get("items") or []
     groups = []
 
     for item in items:
         spec = item.get("spec", {})
         groups.extend(spec.get("groups", []))
 
-    for group in groups:
-        for rule in group.get("rules", []):
-            expr = rule.get("expr", "")
-            annotations = rule.setdefault("annotations", {})
-            current_summary = annotations.get("summary")
-            alert_name = rule.get("alert", "")
-
-            # Always generate a new summary
-            print(f"→ Generating summary for alert: {alert_name}")
-            new_summary = generate_summary_with_chatgpt(
-                alert_name,
-                expr,
-                current_summary if current_summary else None
-            )
-            if new_summary:
-                if new_summary != current_summary:
-                    annotations["summary"] = new_summary
-                    print(f"- Rewritten summary for {alert_name}: {new_summary}")
-                    modified = True
-                else:
-                    print(f"- Summary for {alert_name} unchanged after rewrite.")
+    rules = [rule for group in groups for rule in group.get("rules", [])]
+    # Always generate a new summary
+    print(f"→ Generating summaries for {len(rules)} alerts")
+    jobs = [(rule.get("alert", ""), rule.get("expr", ""), (rule.get("annotations") or {}).get("summary") or None)
+            for rule in rules]
+    summaries = cached_summaries(jobs)
+
+    for rule, (alert_name, _, current_summary), new_summary in zip(rules, jobs, summaries):
+        annotations = rule["annotations"] = rule.get("annotations") or {}
+        if new_summary:
+            if new_summary != current_summary:
+                annotations["summary"] = new_summary
+                print(f"- Rewritten summary for {alert_name}: {new_summary}")
+                modified = True
             else:
-                print(f"- No summary generated for {alert_name}.")
+                print(f"- Summary for {alert_name} unchanged after rewrite.")
+        else:
+            print(f"- No summary generated for {alert_name}.")
 
     if modified:
-        with open(RULES_FILE, "w") as f:
-            yaml.dump(data, f, default_flow_style=False, sort_keys=False)
-        print("Summaries forcibly rewritten in rules.txt")
+        print(f"Summaries forcibly rewritten, they go to {RULES_FILE}")
     else:
         print("No summaries rewritten.")
         print("No summaries needed updates.")
@@ -224,14 +594,30 @@ def main():
         sys.exit(1)
 
     print("Fetching Alertmanager rules...")
-    rules_yaml = run_kubectl_get_rules()
-    write_rules_to_file(rules_yaml)
-
-    if ENABLE_FLATTEN:
-        flatten_descriptions_in_file()
-
-    if ENABLE_CHATGPT_SUMMARY:
-        enhance_summaries_with_chatgpt()
+    if not ENABLE_CHATGPT_SUMMARY:
+        if ENABLE_FLATTEN:
+            print("Flattening multiline 'description' and 'summary' annotations on the way...")
+        try:
+            run_stage("fetch, flatten and write", write_rules_file, stream_rules)
+        except subprocess.CalledProcessError as e:
+            print("Failed to retrieve Prometheus rules:", e.stderr)
+            sys.exit(1)
+        except yaml.YAMLError as e:
+            print(f"❌ Failed to parse the rules: {e}")
+            sys.exit(1)
+    else:
+        rules_json = run_stage("fetch", run_kubectl_get_rules)
+        try:
+            data = run_stage("parse", parse_rules, rules_json)
+        except ValueError as e:
+            print(f"❌ Failed to parse the rules: {e}")
+            sys.exit(1)
+        if ENABLE_FLATTEN:
+            run_stage("flatten", flatten_descriptions, data)
+        run_stage("enhance", enhance_summaries_with_chatgpt, data)
+        run_stage("serialize and write", write_rules_file, lambda f: emit_rules(rules_events(data), f))
+
+    print("Stage timings: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in _stage_timings.items()))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+End-to-end runtime of nodepoolUpgrader.py and AlertManager-Migrator.py against synthetic clusters.
+
+For every scale it generates recordings with harness/scenarios.py, puts the replaying gcloud/kubectl
+on PATH and runs the scripts in a scratch directory, timing the whole process:
+  - nodepoolUpgrader.py with --transport cli (every call goes through the fake CLI, without the
+    drain watcher, whose watches recordings can't replay)
+  - nodepoolUpgrader.py with --transport api, against fake-gke-api.py serving the same clusters
+  - AlertManager-Migrator.py fetching and flattening --rules alert rules (skipped if its
+    dependencies are not installed; no OpenAI calls are made with the default toggles)
+
+The upgrader's .jsonl journal gives the number of commands/API calls and the time spent in them.
+
+    python benchmarks/bench_end_to_end.py --pools 1,100,1000 --deployments 10000 --pdbs 5000
+    python benchmarks/bench_end_to_end.py --pools 10 --latency-ms 300 --transport cli
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import KUBERNETES_DIR, write_runnable_script
+
+sys.path.insert(0, os.path.join(KUBERNETES_DIR, "harness"))
+import scenarios  # noqa: E402
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def journal_stats(directory):
+    commands = 0
+    command_seconds = 0.0
+    for path in glob.glob(os.path.join(directory, "*.jsonl")):
+        # live runs also leave their checkpoint journal next to the event journals
+        if os.path.basename(path) == "nodepool-upgrade-checkpoint.jsonl":
+            continue
+        with open(path) as f:
+            for line in f:
+                event = json.loads(line)
+                if event["type"] == "command":
+                    commands += 1
+                    command_seconds += event["duration"]
+    return commands, command_seconds
+
+def run_timed(cmd, cwd, env, stdin=""):
+    started = time.perf_counter()
+    result = subprocess.run(cmd, cwd=cwd, env=env, input=stdin, capture_output=True, text=True)
+    return time.perf_counter() - started, result
+
+def start_fake_api(fake_args, port):
+    cmd = [sys.executable, os.path.join(KUBERNETES_DIR, "fake-gke-api.py"), "--port", str(port),
+           "--seconds-per-node", "0"] + fake_args
+    server = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    # it prints the exports once it is listening
+    server.stdout.readline()
+    return server
+
+def bench_upgrader(script, workdir, env, transport, pools, fake_args):
+    cwd = os.path.join(workdir, f"upgrader-{transport}")
+    os.makedirs(cwd)
+    env = dict(env, NODEPOOL_UPGRADER_CACHE_DIR=os.path.join(cwd, "cache"))
+    server = None
+    if transport == "api":
+        port = free_port()
+        server = start_fake_api(fake_args, port)
+        endpoint = f"http://127.0.0.1:{port}"
+        env.update(GKE_API_ENDPOINT=endpoint, KUBE_API_ENDPOINT=endpoint, COMPUTE_API_ENDPOINT=endpoint,
+                   GKE_ACCESS_TOKEN="fake-token")
+    try:
+        cmd = [sys.executable, script, "--project", "bench-project", "--region", "us-central1",
+               "--cluster", "fake-cluster", "--transport", transport, "--no-cache", "--poll-interval", "0"]
+        if transport == "cli":
+            # the drain watcher's kubectl get --raw lists and watches can't be replayed from recordings
+            cmd.append("--no-drain-watch")
+        # answers "yes" to every confirmation the run asks for
+        elapsed, result = run_timed(cmd, cwd, env, "y\n" * (pools * 4 + 10))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+    if result.returncode != 0:
+        return f"failed (exit {result.returncode}): {result.stderr.strip()[-200:]}"
+    commands, command_seconds = journal_stats(cwd)
+    return f"{elapsed:8.2f}s  {commands:>6} calls, {command_seconds:.2f}s in calls"
+
+def bench_migrator(script, workdir, env):
+    cwd = os.path.join(workdir, "migrator")
+    os.makedirs(cwd)
+    env = dict(env, OPENAI_API_KEY=env.get("OPENAI_API_KEY", "bench-dummy-key"))
+    cmd = [sys.executable, script, "--project", "bench-project", "--cluster", "fake-cluster", "--region", "us-central1"]
+    elapsed, result = run_timed(cmd, cwd, env)
+    if "ModuleNotFoundError" in result.stderr:
+        return "skipped: " + result.stderr.strip().splitlines()[-1]
+    if result.returncode != 0:
+        return f"failed (exit {result.returncode}): {result.stderr.strip()[-200:]}"
+    size = os.path.getsize(os.path.join(cwd, "rules.txt"))
+    return f"{elapsed:8.2f}s  rules.txt {size / 1024 / 1024:.1f} MB"
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the GKE scripts on synthetic clusters")
+    parser.add_argument("--pools", default="1,100,1000", help="Comma-separated node pool counts")
+    parser.add_argument("--nodes-per-pool", type=int, default=1)
+    parser.add_argument("--deployments", type=int, default=10000)
+    parser.add_argument("--pdbs", type=int, default=5000)
+    parser.add_argument("--rules", type=int, default=5000, help="Alert rules for the migrator run")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added to every fake gcloud/kubectl call")
+    parser.add_argument("--transport", default="cli,api", help="Upgrader transports to run")
+    parser.add_argument("--skip-migrator", action="store_true")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directories (journals, logs)")
+    args = parser.parse_args()
+
+    fake_api = scenarios.load_fake_api()
+    for pools in [int(p) for p in args.pools.split(",")]:
+        workdir = tempfile.mkdtemp(prefix=f"bench-e2e-{pools}-")
+        fake_args = ["--node-pools", str(pools), "--nodes-per-pool", str(args.nodes_per_pool),
+                     "--deployments", str(args.deployments), "--pdbs", str(args.pdbs)]
+        recordings = os.path.join(workdir, "recordings")
+        scenarios.generate(recordings, fake_api.build_parser().parse_args(fake_args),
+                           0 if args.skip_migrator else args.rules)
+        bin_dir = scenarios.make_bin_dir(os.path.join(workdir, "bin"), recordings, args.latency_ms)
+        env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""))
+
+        print(f"\n{pools} node pools, {args.deployments} deployments, {args.pdbs} PDBs"
+              f" (fake CLI latency {args.latency_ms:.0f} ms)")
+        upgrader = write_runnable_script("nodepoolUpgrader.py", workdir)
+        for transport in args.transport.split(","):
+            print(f"  {'nodepoolUpgrader ' + transport:<24}{bench_upgrader(upgrader, workdir, env, transport, pools, fake_args)}")
+        if not args.skip_migrator:
+            migrator = write_runnable_script("AlertManager-Migrator.py", workdir)
+            print(f"  {'AlertManager-Migrator':<24}{bench_migrator(migrator, workdir, env)}")
+
+        if args.keep:
+            print(f"  kept {workdir}")
+        else:
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Benchmarks AlertManager-Migrator.py's flattening of description/summary annotations on a big rule dump.
+
+Builds a --size-mb PrometheusRule list, made of the rules of several clusters one after the other
+(harness/scenarios.py rules with | block descriptions), both as kubectl prints it with -o yaml and
+with -o json, and times each variant in a fresh process, from the fetched text to the flattened
+rules.txt, reporting its peak memory:
+  - legacy: the YAML written to rules.txt, then the original regex and indentation line rewrite of it
+    (kept here only as a baseline)
+  - stream: what the migrator does without summaries to rewrite, the YAML read from disk (as it
+    would come from kubectl) flattened on the event stream straight into rules.txt, with libyaml
+  - pipeline: what it does with them (minus the rewriting), the parse, flatten and serialize stages
+    on the JSON
+  - python: stream with PyYAML's pure Python parser and emitter (not run by default)
+
+Before timing, each variant's output on a small dump is loaded and compared with the rules it
+should give (the legacy rewrite keeps the | of block scalars in the text, so it fails this). That
+dump also carries floats that repr() doesn't spell the YAML way (1e-05, inf, nan).
+
+    python benchmarks/bench_flatten.py --size-mb 100
+    python benchmarks/bench_flatten.py --size-mb 10 --variants legacy,stream,pipeline,python
+"""
+
+import argparse
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import KUBERNETES_DIR, load_script
+
+sys.path.insert(0, os.path.join(KUBERNETES_DIR, "harness"))
+import scenarios  # noqa: E402
+
+def legacy_flatten(path):
+# the original implementation, for comparison
+    with open(path, "r") as f:
+        lines = f.readlines()
+
+    new_lines = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        match = re.match(r'^(\s*)(description|summary):\s*(.*)', line)
+        if match:
+            indent = match.group(1)
+            key = match.group(2)
+            inline_value = match.group(3).strip()
+            value_lines = []
+            if inline_value:
+                value_lines.append(inline_value)
+            i += 1
+            while i < len(lines):
+                next_line = lines[i]
+                next_indent = len(next_line) - len(next_line.lstrip())
+                if next_indent > len(indent):
+                    value_lines.append(next_line.strip())
+                    i += 1
+                else:
+                    break
+            escaped_text = ' '.join(value_lines).replace("'", "''")
+            new_lines.append(f"{indent}{key}: '{escaped_text}'\n")
+        else:
+            new_lines.append(line)
+            i += 1
+
+    with open(path, "w") as f:
+        f.writelines(new_lines)
+
+ODD_FLOATS = [1e-05, 1e16, -2.5e-300, float("inf"), float("-inf"), float("nan"), 0.5, -0.0]
+
+def write_dumps(directory, size_mb, rules_per_cluster=2000, odd_floats=False):
+# one cluster's items rendered once, then repeated with the namespaces renamed per cluster until the
+# YAML reaches size_mb; returns the paths of the YAML and JSON dumps
+    data = scenarios.build_prometheus_rules(rules_per_cluster)
+    if odd_floats:
+        data["items"][0]["spec"]["values"] = ODD_FLOATS
+    text = scenarios.dump_rules_yaml(data)
+    # items is the last key of the list scenarios builds
+    items = text[text.index("items:\n") + len("items:\n"):]
+    yaml_path = os.path.join(directory, "dump.yaml")
+    clusters = 0
+    with open(yaml_path, "w") as f:
+        f.write("apiVersion: v1\nkind: List\nitems:\n")
+        while f.tell() < size_mb * 1024 * 1024:
+            f.write(items.replace("namespace: monitoring-", f"namespace: cluster-{clusters}-monitoring-"))
+            clusters += 1
+
+    json_path = os.path.join(directory, "dump.json")
+    with open(json_path, "w") as f:
+        json.dump(dict(data, items=[dict(item, metadata=dict(item["metadata"], namespace=f"cluster-{cluster}-"
+                                                                  + item["metadata"]["namespace"]))
+                                    for cluster in range(clusters) for item in data["items"]]), f, indent=4)
+    return yaml_path, json_path
+
+def load_migrator(variant):
+    os.environ.setdefault("OPENAI_API_KEY", "bench-dummy-key")
+    migrator = load_script("AlertManager-Migrator.py")
+    if variant == "python":
+        import yaml
+        migrator.YAML_LOADER, migrator.YAML_DUMPER = yaml.SafeLoader, yaml.SafeDumper
+    return migrator
+
+def legacy_run(text, path):
+    with open(path, "w") as f:
+        f.write(text)
+    legacy_flatten(path)
+
+def stream_run(migrator, path):
+    with open(path, "rb") as source:
+        migrator.write_rules_file(lambda target: migrator.copy_rules(source, target))
+
+def pipeline_run(migrator, text):
+    data = migrator.parse_rules(text)
+    migrator.flatten_descriptions(data)
+    migrator.write_rules_file(lambda target: migrator.emit_rules(migrator.rules_events(data), target))
+
+def prepare(variant, directory, target):
+# returns the run to time; the variants that take kubectl's output as a whole get it already read
+    yaml_path, json_path = os.path.join(directory, "dump.yaml"), os.path.join(directory, "dump.json")
+    if variant == "legacy":
+        with open(yaml_path) as f:
+            text = f.read()
+        return lambda: legacy_run(text, target)
+    migrator = load_migrator(variant)
+    migrator.RULES_FILE = target
+    if variant == "pipeline":
+        with open(json_path) as f:
+            text = f.read()
+        return lambda: pipeline_run(migrator, text)
+    return lambda: stream_run(migrator, yaml_path)
+
+def run_worker(variant, directory, target):
+# runs in its own process, so the peak memory is this variant's alone
+    run = prepare(variant, directory, target)
+    started = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - started
+    print(f"{elapsed} {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}")
+
+def run_variant(variant, directory, target):
+    result = subprocess.run([sys.executable, __file__, "--worker", variant, directory, target],
+                            check=True, capture_output=True, text=True)
+    elapsed, max_rss = result.stdout.split()[-2:]
+    return float(elapsed), int(max_rss) / 1024
+
+def expected_rules(rules):
+# what flattening should produce: every description/summary string folded to one line
+    if isinstance(rules, dict):
+        return {key: " ".join(line.strip() for line in value.splitlines() if line.strip())
+                if key in ("description", "summary") and isinstance(value, str) else expected_rules(value)
+                for key, value in rules.items()}
+    if isinstance(rules, list):
+        return [expected_rules(value) for value in rules]
+    return rules
+
+def count_differences(a, b):
+    if isinstance(a, dict) and isinstance(b, dict) and a.keys() == b.keys():
+        return sum(count_differences(a[key], b[key]) for key in a)
+    if isinstance(a, list) and isinstance(b, list) and len(a) == len(b):
+        return sum(count_differences(x, y) for x, y in zip(a, b))
+    # nan is the one value not equal to itself
+    return int(a != b and not (a != a and b != b))
+
+def check_outputs(variants, workdir):
+    import yaml
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    directory = os.path.join(workdir, "check")
+    os.makedirs(directory)
+    yaml_path, _ = write_dumps(directory, 1, rules_per_cluster=500, odd_floats=True)
+    with open(yaml_path) as f:
+        expected = expected_rules(yaml.load(f, Loader=loader))
+    for variant in variants:
+        target = os.path.join(directory, f"rules-{variant}.txt")
+        run_variant(variant, directory, target)
+        with open(target) as f:
+            differences = count_differences(expected, yaml.load(f, Loader=loader))
+        print(f"  {variant:<10}{'output as expected' if not differences else f'{differences} values wrong'}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark flattening of alert rule annotations")
+    parser.add_argument("--size-mb", type=int, default=100)
+    parser.add_argument("--variants", default="legacy,stream,pipeline",
+                        help="Comma-separated: legacy, stream, pipeline, python")
+    parser.add_argument("--worker", nargs=3, metavar=("VARIANT", "DIRECTORY", "TARGET"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        return run_worker(*args.worker)
+
+    variants = args.variants.split(",")
+    workdir = tempfile.mkdtemp(prefix="bench-flatten-")
+    try:
+        check_outputs(variants, workdir)
+        yaml_path, json_path = write_dumps(workdir, args.size_mb)
+        size = os.path.getsize(yaml_path) / 1024 / 1024
+        print(f"\n{size:.0f} MB rule dump ({os.path.getsize(json_path) / 1024 / 1024:.0f} MB as JSON)")
+        for variant in variants:
+            target = os.path.join(workdir, f"rules-{variant}.txt")
+            elapsed, max_rss = run_variant(variant, workdir, target)
+            print(f"  {variant:<10}{elapsed:>8.2f}s  {size / elapsed:>6.1f} MB/s  peak RSS {max_rss:>7.0f} MB")
+            os.remove(target)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
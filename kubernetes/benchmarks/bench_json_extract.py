@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the JSON extraction nodepoolUpgrader.py does on gcloud output.
+
+Builds a ~20 MB "node-pools list" output wrapped in gcloud warnings (with braces inside label
+and description values, which the old brace counter got wrong) and times:
+  - the old character-by-character brace counter + json.loads (kept here only as a baseline)
+  - decode_json_from_text
+
+    python benchmarks/bench_json_extract.py --size-mb 20
+"""
+
+import argparse
+import json
+
+from common import load_script, timeit
+
+def legacy_extract_json_from_text(text):
+# the original implementation, for comparison
+    first_brace = text.find('{')
+    first_bracket = text.find('[')
+    if first_brace == -1 and first_bracket == -1:
+        raise ValueError("No JSON object or array found in text")
+    if first_brace == -1 or (first_bracket != -1 and first_bracket < first_brace):
+        start, open_char, close_char = first_bracket, '[', ']'
+    else:
+        start, open_char, close_char = first_brace, '{', '}'
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] == open_char:
+            depth += 1
+        elif text[i] == close_char:
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    raise ValueError("No matching closing bracket found for JSON.")
+
+def build_fixture(size_mb, tricky=True):
+# tricky=False leaves out the brackets in warnings and values, so the legacy extractor can be timed too
+    note = "keep } and ] out of brace counters" if tricky else "plain value"
+    pool = {
+        "name": "pool-0",
+        "version": "1.29.8-gke.1211000",
+        "initialNodeCount": 3,
+        "config": {
+            "machineType": "e2-standard-8",
+            "imageType": "COS_CONTAINERD",
+            "labels": {"team": "payments", "note": note},
+            "metadata": {"startup-script": "#!/bin/bash\necho '{\"ready\": true}' > /tmp/ready" if tricky else ""},
+            "oauthScopes": ["https://www.googleapis.com/auth/cloud-platform"] * 4,
+        },
+        "upgradeSettings": {"maxSurge": 1, "maxUnavailable": 0},
+        "status": "RUNNING",
+    }
+    one = len(json.dumps(pool, indent=2))
+    pools = []
+    for i in range(max(1, size_mb * 1024 * 1024 // one)):
+        pools.append(dict(pool, name=f"pool-{i}"))
+    before = "WARNING: The following filter keys were not present in any resource : [name]\n" if tricky \
+        else "WARNING: Some requests did not succeed.\n"
+    after = "\nUpdates are available for some Google Cloud CLI components. {To install them} run:\n" if tricky \
+        else "\nUpdates are available for some Google Cloud CLI components.\n"
+    return before + json.dumps(pools, indent=2) + after + "  $ gcloud components update\n", len(pools)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JSON extraction from gcloud output")
+    parser.add_argument("--size-mb", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    upgrader = load_script("nodepoolUpgrader.py")
+
+    def legacy(text):
+        try:
+            return json.loads(legacy_extract_json_from_text(text))
+        except ValueError as e:
+            return e
+
+    for tricky in (False, True):
+        text, count = build_fixture(args.size_mb, tricky)
+        label = "with brackets in warnings/values" if tricky else "plain"
+        print(f"\nFixture ({label}): {len(text) / 1024 / 1024:.1f} MB, {count} node pools")
+
+        legacy_time, legacy_result = timeit(lambda: legacy(text), args.repeat)
+        decode_time, decoded = timeit(lambda: upgrader.decode_json_from_text(text), args.repeat)
+
+        legacy_ok = isinstance(legacy_result, list) and len(legacy_result) == count
+        print(f"{'legacy brace counter':<24}{legacy_time:>8.3f}s  "
+              f"{'ok' if legacy_ok else f'WRONG: {legacy_result!s:.60}'}")
+        print(f"{'decode_json_from_text':<24}{decode_time:>8.3f}s  {'ok' if len(decoded) == count else 'WRONG'}")
+
+if __name__ == "__main__":
+    main()
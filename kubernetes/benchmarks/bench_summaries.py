@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Throughput of AlertManager-Migrator.py's summary generation against fake-openai-api.py.
+
+Starts the fake completion server with the given latency, rate limits and error rate, then runs the
+migrator's generate_summaries over --rules synthetic alert rules once per worker count, with the
+migrator's limiter set to the same limits, and once per --batch-sizes (1 is a request per rule, more
+packs that many rules into one JSON-mode request). The serial baseline (what the old one-call-after-another
+loop did) is timed on --serial-sample rules and extrapolated. Every run checks that each summary
+came back for its own rule.
+
+    python benchmarks/bench_summaries.py --rules 4000 --workers 8,32,64 --rpm 5000 --tpm 2000000
+    python benchmarks/bench_summaries.py --rules 500 --workers 16 --rpm 300 --error-rate 0.05
+    python benchmarks/bench_summaries.py --rules 2000 --workers 16 --batch-sizes 1,10,40 --bad-item-rate 0.02
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+from common import KUBERNETES_DIR, load_script
+
+sys.path.insert(0, os.path.join(KUBERNETES_DIR, "harness"))
+import scenarios  # noqa: E402
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_fake_openai(args, port):
+    cmd = [sys.executable, os.path.join(KUBERNETES_DIR, "fake-openai-api.py"), "--port", str(port),
+           "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms), "--rpm", str(args.rpm),
+           "--tpm", str(args.tpm), "--error-rate", str(args.error_rate), "--bad-item-rate", str(args.bad_item_rate)]
+    server = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    # it prints the exports once it is listening
+    server.stdout.readline()
+    return server
+
+def server_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        return json.load(response)
+
+def build_jobs(count):
+# the same (alert, expr, summary) triples enhance_summaries_with_chatgpt hands over
+    rules = scenarios.build_prometheus_rules(count)
+    return [(rule["alert"], rule["expr"], rule["annotations"]["summary"])
+            for item in rules["items"] for group in item["spec"]["groups"] for rule in group["rules"]]
+
+def run_pipeline(migrator, jobs, workers, batch_size):
+    migrator.SUMMARY_WORKERS = workers
+    migrator.SUMMARY_BATCH_SIZE = batch_size
+    started = time.perf_counter()
+    summaries = asyncio.run(migrator.generate_summaries(jobs))
+    elapsed = time.perf_counter() - started
+    in_order = all(summary == f"{alert} is firing"[:60] for (alert, _, _), summary in zip(jobs, summaries))
+    return elapsed, summaries, in_order
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the migrator's concurrent summary generation")
+    parser.add_argument("--rules", type=int, default=4000)
+    parser.add_argument("--workers", default="8,32,64", help="Comma-separated worker counts")
+    parser.add_argument("--batch-sizes", default="1,20", help="Comma-separated rules per request")
+    parser.add_argument("--serial-sample", type=int, default=20, help="Rules the serial baseline is timed on")
+    parser.add_argument("--latency-ms", type=float, default=800)
+    parser.add_argument("--jitter-ms", type=float, default=400)
+    parser.add_argument("--rpm", type=int, default=5000, help="Requests per minute, server and limiter")
+    parser.add_argument("--tpm", type=int, default=2000000, help="Tokens per minute, server and limiter")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests the server fails")
+    parser.add_argument("--bad-item-rate", type=float, default=0.0,
+                        help="Share of batched summaries the server leaves out or makes too long")
+    args = parser.parse_args()
+
+    port = free_port()
+    server = start_fake_openai(args, port)
+    os.environ.update(OPENAI_BASE_URL=f"http://127.0.0.1:{port}/v1", OPENAI_API_KEY="sk-fake",
+                      OPENAI_REQUESTS_PER_MINUTE=str(args.rpm), OPENAI_TOKENS_PER_MINUTE=str(args.tpm))
+    try:
+        migrator = load_script("AlertManager-Migrator.py")
+        jobs = build_jobs(args.rules)
+        print(f"{len(jobs)} rules, {args.latency_ms:.0f}+{args.jitter_ms:.0f} ms per completion, "
+              f"{args.rpm} RPM / {args.tpm} TPM, {args.error_rate:.0%} server errors\n")
+
+        sample = jobs[:args.serial_sample]
+        elapsed, _, in_order = run_pipeline(migrator, sample, 1, 1)
+        serial = elapsed / len(sample) * len(jobs)
+        print(f"{'serial (extrapolated)':<24}{serial:>9.1f}s  {len(jobs) / serial:>7.1f} rules/s"
+              f"  {'ok' if in_order else 'OUT OF ORDER'}\n")
+
+        for workers in [int(w) for w in args.workers.split(",")]:
+            for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+                before = server_stats(port)
+                elapsed, summaries, in_order = run_pipeline(migrator, jobs, workers, batch_size)
+                after = server_stats(port)
+                served = {key: after[key] - before[key] for key in after}
+                stats = migrator._summary_stats
+                label = f"{workers} workers, batch {batch_size}"
+                print(f"{label:<24}{elapsed:>9.1f}s  {len(jobs) / elapsed:>7.1f} rules/s"
+                      f"  {serial / elapsed:>5.1f}x  {'ok' if in_order else 'OUT OF ORDER'}, "
+                      f"{sum(1 for s in summaries if s is None)} failed, {stats['requests']} requests, "
+                      f"{stats['tokens']} tokens, server: {served['rate_limited']} 429s, {served['errors']} 5xx\n")
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Helpers shared by the benchmarks in this folder.
+
+The scripts in kubernetes/ start with a plain-text description followed by a "# ---" line,
+so they can't be imported directly; load_script runs the code part into a fresh module instead.
+"""
+
+import os
+import tempfile
+import time
+import types
+
+KUBERNETES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def script_source(name):
+    path = os.path.join(KUBERNETES_DIR, name)
+    with open(path) as f:
+        text = f.read()
+    header, separator, code = text.partition("# ---\n")
+    return path, code if separator else text
+
+def load_script(name, module_name=None):
+    path, code = script_source(name)
+    module = types.ModuleType(module_name or os.path.splitext(name)[0].replace("-", "_"))
+    module.__file__ = path
+    exec(compile(code, path, "exec"), module.__dict__)
+    return module
+
+def write_runnable_script(name, directory=None):
+# the code part as a standalone file, for benchmarks that run a script end to end in a subprocess
+    path, code = script_source(name)
+    directory = directory or tempfile.mkdtemp(prefix="bench-")
+    target = os.path.join(directory, os.path.basename(path))
+    with open(target, "w") as f:
+        f.write(code)
+    return target
+
+def timeit(fn, repeat=3):
+# best of N wall-clock runs, in seconds, plus the result of the last run
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+"""
+A small local stand-in for the GKE and Kubernetes APIs, so nodepoolUpgrader.py can be run,
+tested and benchmarked without a live GCP project.
+
+It generates synthetic clusters (node pools, nodes, workloads of every kind, pods, PDBs) and serves
+the handful of endpoints the upgrader uses (the region's Compute quotas included), with keep-alive
+enabled and an optional per-request latency.
+Node pool upgrades return operations that progress over time, like the real thing: the pool's nodes are
+replaced one by one, cordoned and drained with PDBs respected. The Kubernetes lists page with
+limit/continue and carry a resourceVersion, and pods, nodes and PDBs can be watched from it (the GKE
+"fields" projection is accepted but not applied).
+Start it, then point the upgrader at it with the environment variables it prints:
+
+    python fake-gke-api.py --port 8089 --node-pools 5 --deployments 1000 --pdbs 500
+"""
+
+import argparse
+import copy
+import hashlib
+import itertools
+import json
+import re
+import select
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FAKE_TOKEN = "fake-token"
+POOL_LABEL = "cloud.google.com/gke-nodepool"
+WATCH_HISTORY = 20000  # changes kept for watches to resume from, older resourceVersions get 410 Gone
+WATCHABLE = {"/api/v1/pods": "pods", "/api/v1/nodes": "nodes", "/apis/policy/v1/poddisruptionbudgets": "pdbs"}
+
+def kube_time(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+def image_id(image):
+    return image.rsplit(":", 1)[0] + "@sha256:" + hashlib.sha256(image.encode()).hexdigest()
+
+def running_status(images, started, ready_after):
+# what the upgrader reads off a running pod: when it started, when it got Ready, and the image digests
+    return {"phase": "Running", "startTime": kube_time(started),
+            "conditions": [{"type": "Ready", "status": "True", "lastTransitionTime": kube_time(started + ready_after)}],
+            "containerStatuses": [{"imageID": image_id(image)} for image in images]}
+
+def build_state(args):
+# builds the whole synthetic cluster once, every request is served from these lists
+    node_pools = []
+    for i in range(args.node_pools):
+        node_pools.append({
+            "name": f"pool-{i}",
+            "version": args.node_version,
+            "initialNodeCount": args.nodes_per_pool,
+            "upgradeSettings": {"maxSurge": 1 if i % 2 == 0 else 0, "maxUnavailable": 0 if i % 2 == 0 else 1},
+            "config": {"machineType": "e2-standard-4", "imageType": "COS_CONTAINERD"},
+            "status": "RUNNING"
+        })
+
+    deployments = []
+    for i in range(args.deployments):
+        name = f"deploy-{i}"
+        deployments.append({
+            "metadata": {"namespace": f"ns-{i % args.namespaces}", "name": name,
+                         "labels": {"app": name, "tier": "web" if i % 2 == 0 else "worker"}},
+            "spec": {"replicas": 1 if i % 5 == 0 else 3,
+                     "selector": {"matchLabels": {"app": name}},
+                     "template": {"metadata": {"labels": {"app": name}}}}
+        })
+
+    # the other controller kinds the risk check looks at: StatefulSets (every other one with a single
+    # replica), each Deployment's ReplicaSet plus a few without an owner, and HPAs on every tenth
+    # Deployment that may scale it down to one replica
+    statefulsets = []
+    for i in range(args.statefulsets):
+        name = f"db-{i}"
+        statefulsets.append({
+            "metadata": {"namespace": f"ns-{i % args.namespaces}", "name": name},
+            "spec": {"replicas": 1 if i % 2 == 0 else 3, "selector": {"matchLabels": {"app": name}},
+                     "template": {"metadata": {"labels": {"app": name}}}}
+        })
+    replicasets = []
+    for dep in deployments:
+        replicasets.append({
+            "metadata": {"namespace": dep["metadata"]["namespace"], "name": f"{dep['metadata']['name']}-5d9c7",
+                         "ownerReferences": [{"kind": "Deployment", "name": dep["metadata"]["name"]}]},
+            "spec": dict(dep["spec"])
+        })
+    for i in range(args.bare_pods):
+        name = f"legacy-rs-{i}"
+        replicasets.append({
+            "metadata": {"namespace": f"ns-{i % args.namespaces}", "name": name},
+            "spec": {"replicas": 1, "selector": {"matchLabels": {"app": name}},
+                     "template": {"metadata": {"labels": {"app": name}}}}
+        })
+    hpas = []
+    for i in range(3, args.deployments, 10):
+        dep = deployments[i]["metadata"]
+        hpas.append({
+            "metadata": {"namespace": dep["namespace"], "name": dep["name"]},
+            "spec": {"scaleTargetRef": {"apiVersion": "apps/v1", "kind": "Deployment", "name": dep["name"]},
+                     "minReplicas": 1, "maxReplicas": 10}
+        })
+
+    pdbs = []
+    for i in range(min(args.pdbs, args.deployments)):
+        dep = deployments[i]["metadata"]
+        # every third PDB uses matchExpressions so both selector forms get exercised
+        if i % 3 == 0:
+            selector = {"matchExpressions": [{"key": "app", "operator": "In", "values": [dep["name"]]}]}
+        else:
+            selector = {"matchLabels": {"app": dep["name"]}}
+        replicas = deployments[i]["spec"]["replicas"]
+        pdbs.append({
+            "metadata": {"namespace": dep["namespace"], "name": f"pdb-{i}"},
+            "spec": {"selector": selector, "minAvailable": 1},
+            "status": {"disruptionsAllowed": max(replicas - 1, 0), "expectedPods": replicas}
+        })
+
+    # nodes of the first cluster's pools, with the deployment pods spread round-robin over them
+    # plus one DaemonSet pod per node
+    nodes = []
+    for np in node_pools:
+        for j in range(args.nodes_per_pool):
+            nodes.append({
+                "metadata": {"name": f"gke-{args.cluster}-{np['name']}-{j}",
+                             "labels": {"cloud.google.com/gke-nodepool": np["name"]}},
+                "status": {"allocatable": {"cpu": args.node_cpu, "memory": args.node_memory}}
+            })
+    # every pod started a day ago and took --image-pull-seconds to pull its image before it got ready
+    pods = []
+    started = time.time() - 86400
+    cold = args.image_pull_seconds + 2
+    if nodes:
+        slot = 0
+        for i, dep in enumerate(deployments):
+            image = f"us-docker.pkg.dev/fake-project/apps/app-{i % args.images}:v1"
+            for r in range(dep["spec"]["replicas"]):
+                pods.append({
+                    "metadata": {"namespace": dep["metadata"]["namespace"], "name": f"{dep['metadata']['name']}-{r}",
+                                 "labels": dep["spec"]["template"]["metadata"]["labels"],
+                                 "ownerReferences": [{"kind": "ReplicaSet", "name": dep["metadata"]["name"]}]},
+                    "spec": {"nodeName": nodes[slot % len(nodes)]["metadata"]["name"],
+                             "containers": [{"name": "app", "image": image,
+                                             "resources": {"requests": {"cpu": "100m", "memory": "128Mi"}}}]},
+                    "status": running_status([image], started, cold)
+                })
+                slot += 1
+        # pods somebody started by hand, no owner at all
+        for i in range(args.bare_pods):
+            pods.append({
+                "metadata": {"namespace": f"ns-{i % args.namespaces}", "name": f"debug-{i}",
+                             "labels": {"run": f"debug-{i}"}},
+                "spec": {"nodeName": nodes[i % len(nodes)]["metadata"]["name"],
+                         "containers": [{"name": "shell", "image": "busybox:1.36",
+                                         "resources": {"requests": {"cpu": "10m", "memory": "16Mi"}}}]},
+                "status": running_status(["busybox:1.36"], started, cold)
+            })
+        for node in nodes:
+            pods.append({
+                "metadata": {"namespace": "kube-system", "name": f"fluentbit-{node['metadata']['name']}",
+                             "labels": {"k8s-app": "fluentbit"}, "ownerReferences": [{"kind": "DaemonSet", "name": "fluentbit"}]},
+                "spec": {"nodeName": node["metadata"]["name"],
+                         "containers": [{"name": "fluentbit", "image": "fluent/fluent-bit:3.0",
+                                         "resources": {"requests": {"cpu": "50m", "memory": "64Mi"}}}]},
+                "status": running_status(["fluent/fluent-bit:3.0"], started, cold)
+            })
+
+    # the first cluster keeps the plain --cluster name, extra ones (for fleet runs) get a suffix;
+    # the last --level-clusters of them already run their node pools at the control plane version
+    locations = args.locations.split(",")
+    clusters = {}
+    for i in range(args.clusters):
+        name = args.cluster if i == 0 else f"{args.cluster}-{i}"
+        level = i >= args.clusters - args.level_clusters
+        clusters[name] = {
+            "name": name,
+            "location": locations[i % len(locations)],
+            "currentMasterVersion": args.master_version,
+            "currentNodeVersion": args.master_version if level else args.node_version,
+            "endpoint": f"127.0.0.1:{args.port}",
+            "masterAuth": {"clusterCaCertificate": ""},
+            "status": "RUNNING",
+            "nodePools": [dict(np, version=args.master_version) for np in copy.deepcopy(node_pools)] if level
+                         else copy.deepcopy(node_pools)
+        }
+    # the region's quotas, with the fake nodes (e2-standard-4, one external IP each) counted as usage
+    quotas = [{"metric": "CPUS", "limit": 4 * len(nodes) + args.free_cpus, "usage": 4 * len(nodes)},
+              {"metric": "IN_USE_ADDRESSES", "limit": len(nodes) + args.free_addresses, "usage": len(nodes)}]
+    lock = threading.Lock()
+    return {"clusters": clusters, "quotas": quotas, "deployments": deployments, "statefulsets": statefulsets,
+            "replicasets": replicasets, "hpas": hpas, "pdbs": pdbs, "nodes": nodes, "pods": pods,
+            "daemonsets": {}, "cluster": args.cluster, "image_pull_seconds": args.image_pull_seconds,
+            "drain_timeout": args.drain_timeout, "unschedulable_pods": args.unschedulable_pods,
+            "operations": {}, "lock": lock, "op_ids": itertools.count(1),
+            "rv": 1, "events": [], "compacted": 0, "changed": threading.Condition(lock)}
+
+def publish(state, resource, kind, obj):
+# called with the lock held: stamps the object with the next resourceVersion and hands the change to the watches
+    state["rv"] += 1
+    obj["metadata"]["resourceVersion"] = str(state["rv"])
+    line = json.dumps({"type": kind, "object": obj}) + "\n"
+    state["events"].append((state["rv"], resource, obj["metadata"].get("labels") or {}, line))
+    if len(state["events"]) > 2 * WATCH_HISTORY:
+        dropped = len(state["events"]) - WATCH_HISTORY
+        state["compacted"] = state["events"][dropped - 1][0]
+        del state["events"][:dropped]
+    state["changed"].notify_all()
+
+def prepull_targets(daemonset):
+# the node pools a pre-pull DaemonSet's node affinity points at
+    pools = set()
+    terms = daemonset["spec"]["template"]["spec"].get("affinity", {}).get("nodeAffinity", {}) \
+        .get("requiredDuringSchedulingIgnoredDuringExecution", {}).get("nodeSelectorTerms", [])
+    for term in terms:
+        for expression in term.get("matchExpressions", []):
+            if expression["key"] == POOL_LABEL and expression["operator"] == "In":
+                pools.update(expression["values"])
+    return pools
+
+def pdb_blocks(state, pod):
+# whether a PDB with no disruptions left covers the pod (matchLabels and In expressions, all the fake PDBs use)
+    labels = pod["metadata"].get("labels") or {}
+    for pdb in state["pdbs"]:
+        if pdb["metadata"]["namespace"] != pod["metadata"]["namespace"] or pdb["status"]["disruptionsAllowed"]:
+            continue
+        selector = pdb["spec"]["selector"]
+        if all(labels.get(k) == v for k, v in selector.get("matchLabels", {}).items()) and \
+                all(labels.get(e["key"]) in e["values"] for e in selector.get("matchExpressions", [])):
+            return True
+    return False
+
+def evict_pods(state, pods, new_node, warm, pending):
+# called with the lock held: each pod is marked for deletion, deleted and recreated on the new node, or
+# left Pending and unschedulable while pending (a list of such pods) has room
+    now = time.time()
+    gone = {id(pod) for pod in pods}
+    recreated = []
+    for pod in pods:
+        pod["metadata"]["deletionTimestamp"] = kube_time(now)
+        publish(state, "pods", "MODIFIED", pod)
+        publish(state, "pods", "DELETED", pod)
+        pod = copy.deepcopy(pod)
+        del pod["metadata"]["deletionTimestamp"]
+        images = [container["image"] for container in pod["spec"]["containers"]]
+        if len(pending[0]) < pending[1]:
+            del pod["spec"]["nodeName"]
+            pod["status"] = {"phase": "Pending", "conditions": [{
+                "type": "PodScheduled", "status": "False", "reason": "Unschedulable",
+                "lastTransitionTime": kube_time(now),
+                "message": "0/3 nodes are available: 1 node(s) were unschedulable, 2 Insufficient cpu."}]}
+            pending[0].append(pod)
+        else:
+            pod["spec"]["nodeName"] = new_node
+            pod["status"] = running_status(images, now, 2 if warm else state["image_pull_seconds"] + 2)
+        recreated.append(pod)
+        publish(state, "pods", "ADDED", pod)
+    state["pods"] = [pod for pod in state["pods"] if id(pod) not in gone] + recreated
+
+def replace_node(state, op, old_name, pace, pending):
+# one surge step on the first cluster: a new node joins, the old one is cordoned and drained, then goes
+# away. Pods only have to wait for their image pull if no DaemonSet pre-pulled the images onto the new
+# node, in which case its pods did the pulling. A pod a PDB with no disruptions left covers is evicted
+# only after --drain-timeout seconds (GKE's hour, scaled down).
+    pool_name = op["nodePool"]["name"]
+    with state["lock"]:
+        old = next(node for node in state["nodes"] if node["metadata"]["name"] == old_name)
+        new = copy.deepcopy(old)
+        new["metadata"]["name"] = f"{old_name.split('-u')[0]}-u{op['name'].rsplit('-', 1)[-1]}"
+        state["nodes"] = state["nodes"] + [new]
+        publish(state, "nodes", "ADDED", new)
+        warmups = [ds for ds in state["daemonsets"].values() if pool_name in prepull_targets(ds)]
+        now = time.time()
+        for ds in warmups:
+            spec = ds["spec"]["template"]["spec"]
+            images = [container["image"] for container in spec.get("initContainers", []) + spec["containers"]]
+            pod = {"metadata": {"namespace": ds["metadata"]["namespace"],
+                                "name": f"{ds['metadata']['name']}-{new['metadata']['name']}",
+                                "ownerReferences": [{"kind": "DaemonSet", "name": ds["metadata"]["name"]}]},
+                   "spec": {"nodeName": new["metadata"]["name"], "containers": spec["containers"]},
+                   "status": running_status(images, now - state["image_pull_seconds"], state["image_pull_seconds"])}
+            state["pods"] = state["pods"] + [pod]
+            publish(state, "pods", "ADDED", pod)
+        old.setdefault("spec", {})["unschedulable"] = True
+        publish(state, "nodes", "MODIFIED", old)
+        cordoned = time.time()
+        movable = [pod for pod in state["pods"] if pod["spec"].get("nodeName") == old_name and not any(
+            owner.get("kind") == "DaemonSet" for owner in pod["metadata"].get("ownerReferences", []))]
+        held = [pod for pod in movable if pace and pdb_blocks(state, pod)]
+    time.sleep(pace / 2)
+    with state["lock"]:
+        evict_pods(state, [pod for pod in movable if not any(pod is h for h in held)], new["metadata"]["name"],
+                   warmups, pending)
+    if held:
+        time.sleep(max(0, cordoned + state["drain_timeout"] - time.time()))
+        with state["lock"]:
+            evict_pods(state, held, new["metadata"]["name"], warmups, pending)
+    with state["lock"]:
+        for pod in [pod for pod in state["pods"] if pod["spec"].get("nodeName") == old_name]:
+            publish(state, "pods", "DELETED", pod)
+        state["pods"] = [pod for pod in state["pods"] if pod["spec"].get("nodeName") != old_name]
+        state["nodes"] = [node for node in state["nodes"] if node is not old]
+        publish(state, "nodes", "DELETED", old)
+    time.sleep(pace / 2)
+    return new["metadata"]["name"]
+
+def drive_upgrade(state, op, seconds_per_node):
+# plays the upgrade out, one node every --seconds-per-node (all at once with 0). Only the first cluster
+# has nodes and pods; the first --unschedulable-pods evicted pods stay Pending until the upgrade is done.
+    pace = max(seconds_per_node, 0)
+    with state["lock"]:
+        old_nodes = [node["metadata"]["name"] for node in state["nodes"] if op["cluster"] == state["cluster"]
+                     and node["metadata"]["labels"].get(POOL_LABEL) == op["nodePool"]["name"]]
+    pending = ([], state["unschedulable_pods"] if pace else 0)
+    new_nodes = []
+    for i in range(op["total"]):
+        if i < len(old_nodes):
+            new_nodes.append(replace_node(state, op, old_nodes[i], pace, pending))
+        else:
+            time.sleep(pace)
+        with state["lock"]:
+            op["done"] += 1
+    with state["lock"]:
+        for i, pod in enumerate(pending[0]):
+            images = [container["image"] for container in pod["spec"]["containers"]]
+            pod["spec"]["nodeName"] = new_nodes[i % len(new_nodes)]
+            pod["status"] = running_status(images, time.time(), state["image_pull_seconds"] + 2)
+            publish(state, "pods", "MODIFIED", pod)
+        op["nodePool"]["version"] = op["targetVersion"]
+        op["status"] = "DONE"
+
+def operation_view(op):
+    return {
+        "name": op["name"],
+        "operationType": op.get("type", "UPGRADE_NODES"),
+        "status": op["status"],
+        "targetLink": op["targetLink"],
+        "progress": {"metrics": [{"name": "NODES_TOTAL", "intValue": str(op["total"])},
+                                 {"name": "NODES_DONE", "intValue": str(op["done"])}]}
+    }
+
+def make_handler(state, latency, seconds_per_node):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, the whole point of the client layer
+        disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def send_list(self, kind, items, query):
+            # limit/continue like the real API server; the continue token is the next offset and the
+            # resourceVersion of the first page, which every page of the list reports
+            limit = int(query.get("limit", ["0"])[0])
+            start, _, version = query.get("continue", ["0"])[0].partition("/")
+            start, version = int(start), version or self.resource_version
+            metadata = {"resourceVersion": version}
+            if limit and start + limit < len(items):
+                metadata["continue"] = f"{start + limit}/{version}"
+            return self.send_json(200, {"kind": kind, "metadata": metadata,
+                                        "items": items[start:start + limit] if limit else items[start:]})
+
+        def send_watch(self, resource, query, selector):
+            # one JSON event per line for timeoutSeconds, then the connection is closed (no chunking)
+            since = int(query.get("resourceVersion", [self.resource_version])[0] or self.resource_version)
+            deadline = time.time() + float(query.get("timeoutSeconds", ["1800"])[0])
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            try:
+                while time.time() < deadline:
+                    with state["changed"]:
+                        if since < state["compacted"]:
+                            status = {"kind": "Status", "status": "Failure", "reason": "Expired", "code": 410,
+                                      "message": f"too old resource version: {since} ({state['compacted']})"}
+                            lines = [json.dumps({"type": "ERROR", "object": status}) + "\n"]
+                            deadline = 0
+                        else:
+                            lines = [line for version, kind, labels, line in state["events"]
+                                     if version > since and kind == resource and selector.items() <= labels.items()]
+                            since = state["rv"]
+                            if not lines:
+                                state["changed"].wait(min(1, max(0, deadline - time.time())))
+                    if lines:
+                        self.wfile.write("".join(lines).encode())
+                        self.wfile.flush()
+                    elif select.select([self.connection], [], [], 0)[0] and \
+                            not self.connection.recv(1, socket.MSG_PEEK):
+                        return  # the client went away
+                if deadline and query.get("allowWatchBookmarks", [""])[0] == "true":
+                    self.wfile.write((json.dumps({"type": "BOOKMARK", "object": {
+                        "kind": "Status", "metadata": {"resourceVersion": str(since)}}}) + "\n").encode())
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def read_body(self):
+            return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+        def authorized(self):
+            if latency:
+                time.sleep(latency)
+            if self.headers.get("Authorization") != f"Bearer {FAKE_TOKEN}":
+                self.send_json(401, {"error": "unauthorized"})
+                return False
+            return True
+
+        def do_PUT(self):
+            if not self.authorized():
+                return
+            body = self.read_body()
+            path = urlparse(self.path).path
+            match = re.fullmatch(r"/v1/projects/[^/]+/locations/[^/]+/clusters/([^/]+)/nodePools/([^/]+)", path)
+            cluster = state["clusters"].get(match.group(1)) if match else None
+            pool = next((np for np in cluster["nodePools"] if np["name"] == match.group(2)), None) if cluster else None
+            if pool is None:
+                return self.send_json(404, {"error": f"no fake for {path}"})
+            with state["lock"]:
+                # GKE only runs one operation per cluster at a time
+                if any(op["cluster"] == cluster["name"] and op["status"] != "DONE"
+                       for op in state["operations"].values()):
+                    return self.send_json(400, {"error": {"message": "operation already in progress"}})
+                name = f"operation-{next(state['op_ids'])}"
+                # an update of the upgrade settings alone is done as soon as it is made
+                if "upgradeSettings" in body and not body.get("nodeVersion"):
+                    pool["upgradeSettings"] = body["upgradeSettings"]
+                    op = state["operations"][name] = {
+                        "name": name, "type": "UPDATE_NODE_POOL", "cluster": cluster["name"], "status": "DONE",
+                        "started": time.time(), "total": 0, "done": 0, "nodePool": pool, "targetLink": path
+                    }
+                    return self.send_json(200, operation_view(op))
+                op = state["operations"][name] = {
+                    "name": name, "cluster": cluster["name"], "status": "RUNNING", "started": time.time(),
+                    "total": pool["initialNodeCount"] * max(1, len(pool.get("locations", []))), "done": 0,
+                    "nodePool": pool, "targetVersion": body.get("nodeVersion"), "targetLink": path
+                }
+            if seconds_per_node > 0:
+                threading.Thread(target=drive_upgrade, args=(state, op, seconds_per_node), daemon=True).start()
+            else:
+                drive_upgrade(state, op, 0)
+            with state["lock"]:
+                self.send_json(200, operation_view(op))
+
+        def do_POST(self):
+            if not self.authorized():
+                return
+            body = self.read_body()
+            path = urlparse(self.path).path
+            if not re.fullmatch(r"/apis/apps/v1/namespaces/[^/]+/daemonsets", path):
+                return self.send_json(404, {"error": f"no fake for {path}"})
+            with state["lock"]:
+                if body["metadata"]["name"] in state["daemonsets"]:
+                    return self.send_json(409, {"reason": "AlreadyExists"})
+                state["daemonsets"][body["metadata"]["name"]] = body
+            self.send_json(201, body)
+
+        def do_DELETE(self):
+            if not self.authorized():
+                return
+            self.read_body()
+            path = urlparse(self.path).path
+            match = re.fullmatch(r"/apis/apps/v1/namespaces/[^/]+/daemonsets/([^/]+)", path)
+            with state["lock"]:
+                daemonset = state["daemonsets"].pop(match.group(1), None) if match else None
+                if daemonset is None:
+                    return self.send_json(404, {"reason": "NotFound"})
+                name = daemonset["metadata"]["name"]
+                state["pods"] = [pod for pod in state["pods"]
+                                 if not any(owner.get("kind") == "DaemonSet" and owner.get("name") == name
+                                            for owner in pod["metadata"].get("ownerReferences", []))]
+            self.send_json(200, {"kind": "Status", "status": "Success"})
+
+        def do_GET(self):
+            if not self.authorized():
+                return
+
+            url = urlparse(self.path)
+            path = url.path
+            query = parse_qs(url.query)
+            # read before any list, so a watch from a list's resourceVersion misses nothing
+            self.resource_version = str(state["rv"])
+
+            if re.fullmatch(r"/v1/projects/[^/]+/locations/-/operations", path):
+                with state["lock"]:
+                    views = [operation_view(op) for op in state["operations"].values()]
+                return self.send_json(200, {"operations": views})
+            match = re.fullmatch(r"/v1/projects/[^/]+/locations/[^/]+/operations/([^/]+)", path)
+            if match:
+                with state["lock"]:
+                    op = state["operations"].get(match.group(1))
+                    if op is None:
+                        return self.send_json(404, {"error": f"operation {match.group(1)} not found"})
+                    return self.send_json(200, operation_view(op))
+
+            if re.fullmatch(r"/v1/projects/[^/]+/locations/-/clusters", path):
+                return self.send_json(200, {"clusters": list(state["clusters"].values())})
+            match = re.fullmatch(r"/v1/projects/[^/]+/locations/[^/]+/clusters/([^/]+)(/nodePools)?", path)
+            if match:
+                cluster = state["clusters"].get(match.group(1))
+                if cluster is None:
+                    return self.send_json(404, {"error": f"cluster {match.group(1)} not found"})
+                if match.group(2):
+                    return self.send_json(200, {"nodePools": cluster["nodePools"]})
+                return self.send_json(200, cluster)
+            if re.fullmatch(r"/compute/v1/projects/[^/]+/regions/[^/]+", path):
+                return self.send_json(200, {"quotas": state["quotas"]})
+            if path == "/apis/apps/v1/deployments":
+                return self.send_list("DeploymentList", state["deployments"], query)
+            if path == "/apis/apps/v1/statefulsets":
+                return self.send_list("StatefulSetList", state["statefulsets"], query)
+            if path == "/apis/apps/v1/replicasets":
+                return self.send_list("ReplicaSetList", state["replicasets"], query)
+            if path == "/apis/autoscaling/v2/horizontalpodautoscalers":
+                return self.send_list("HorizontalPodAutoscalerList", state["hpas"], query)
+            # only the selectors the upgrader uses: equality labels, (in)equality fields
+            selector = dict(term.split("=", 1) for term in query.get("labelSelector", [""])[0].split(",") if term)
+            fields = [re.fullmatch(r"([^!=]+)(!?=)(.*)", term).groups()
+                      for term in query.get("fieldSelector", [""])[0].split(",") if term]
+            if path in WATCHABLE and query.get("watch", [""])[0] in ("true", "1"):
+                return self.send_watch(WATCHABLE[path], query, selector)
+            if path == "/apis/policy/v1/poddisruptionbudgets":
+                return self.send_list("PodDisruptionBudgetList", state["pdbs"], query)
+            if path == "/api/v1/nodes":
+                return self.send_list("NodeList", [node for node in state["nodes"]
+                                                   if selector.items() <= node["metadata"]["labels"].items()], query)
+            if path == "/api/v1/pods":
+                values = {"spec.nodeName": lambda pod: pod["spec"].get("nodeName") or "",
+                          "status.phase": lambda pod: pod["status"]["phase"]}
+                pods = [pod for pod in state["pods"]
+                        if all((values[field](pod) == value) == (op == "=") for field, op, value in fields)]
+                return self.send_list("PodList", pods, query)
+
+            self.send_json(404, {"error": f"no fake for {path}"})
+
+    return Handler
+
+class FakeServer(ThreadingHTTPServer):
+    request_queue_size = 128  # the upgrader's pre-flight opens a burst of connections at once
+
+def build_parser():
+# also used by harness/scenarios.py, so the fake CLI and the fake API generate the same clusters
+    parser = argparse.ArgumentParser(description="Fake GKE/Kubernetes API for offline runs of nodepoolUpgrader.py")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--cluster", default="fake-cluster")
+    parser.add_argument("--clusters", type=int, default=1, help="Number of clusters listed by the project")
+    parser.add_argument("--level-clusters", type=int, default=0,
+                        help="How many of the listed clusters have no node pool behind the control plane")
+    parser.add_argument("--locations", default="us-central1,europe-west1,us-east1-b")
+    parser.add_argument("--master-version", default="1.30.5-gke.1014001")
+    parser.add_argument("--node-version", default="1.29.8-gke.1211000")
+    parser.add_argument("--node-pools", type=int, default=3)
+    parser.add_argument("--nodes-per-pool", type=int, default=3)
+    parser.add_argument("--deployments", type=int, default=50)
+    parser.add_argument("--statefulsets", type=int, default=4)
+    parser.add_argument("--bare-pods", type=int, default=2, help="Ownerless pods, and as many ownerless ReplicaSets")
+    parser.add_argument("--pdbs", type=int, default=25)
+    parser.add_argument("--namespaces", type=int, default=10)
+    parser.add_argument("--node-cpu", default="3920m", help="Allocatable CPU of every fake node")
+    parser.add_argument("--node-memory", default="12Gi", help="Allocatable memory of every fake node")
+    parser.add_argument("--images", type=int, default=8, help="Distinct images the deployments run")
+    parser.add_argument("--image-pull-seconds", type=float, default=40,
+                        help="How long a pod waits for its image on a node that doesn't have it yet")
+    parser.add_argument("--drain-timeout", type=float, default=5,
+                        help="Seconds a drain waits on a PDB that allows no disruptions (GKE waits an hour)")
+    parser.add_argument("--unschedulable-pods", type=int, default=0,
+                        help="Evicted pods left Pending as unschedulable until their upgrade is done")
+    parser.add_argument("--free-cpus", type=int, default=48, help="Regional CPU quota left over")
+    parser.add_argument("--free-addresses", type=int, default=100, help="Regional IP address quota left over")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added to every request")
+    parser.add_argument("--seconds-per-node", type=float, default=0.5, help="Speed of fake node pool upgrades")
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+
+    state = build_state(args)
+    server = FakeServer(("127.0.0.1", args.port),
+                        make_handler(state, args.latency_ms / 1000, args.seconds_per_node))
+
+    print(f"Fake GKE API listening on http://127.0.0.1:{args.port}")
+    print(f"  export GKE_API_ENDPOINT=http://127.0.0.1:{args.port}")
+    print(f"  export KUBE_API_ENDPOINT=http://127.0.0.1:{args.port}")
+    print(f"  export COMPUTE_API_ENDPOINT=http://127.0.0.1:{args.port}")
+    print(f"  export GKE_ACCESS_TOKEN={FAKE_TOKEN}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
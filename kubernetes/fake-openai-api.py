@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+A small local stand-in for the OpenAI chat completions endpoint, so the summary pipeline of
+AlertManager-Migrator.py can be run, tested and benchmarked without an account or any cost.
+
+Every completion takes --latency-ms (plus up to --jitter-ms) and answers with a short summary made
+from the prompt's alert name, or, for JSON mode requests (batched prompts), with a JSON object holding
+one summary per alert id. Like the real API it enforces requests and tokens per minute, refilled
+continuously, and answers 429 with a Retry-After header past them, and it fails --error-rate of the
+requests with a 500 or 503. GET /stats returns what it has served so far.
+Start it, then point the migrator at it with the environment variables it prints:
+
+    python fake-openai-api.py --port 8090 --latency-ms 800 --rpm 500 --tpm 30000
+"""
+
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_KEY = "sk-fake"
+
+def count_tokens(text):
+# the same rough 4 characters per token the migrator estimates with
+    return max(1, len(text) // 4)
+
+def summarize(prompt):
+    match = re.search(r"^Alert: (.*)$", prompt, re.MULTILINE)
+    name = match.group(1).strip() if match else "alert"
+    return f"{name} is firing"[:60]
+
+def summarize_batch(prompt, bad_item_rate):
+# the JSON answer to a batched prompt; --bad-item-rate of the alerts are left out or get a summary
+# past 60 characters, the two ways a real model gets a batch wrong
+    summaries = []
+    for rule_id, name in re.findall(r"^id: (\S+)\nAlert: (.*)$", prompt, re.MULTILINE):
+        summary = f"{name.strip()} is firing"[:60]
+        if random.random() < bad_item_rate:
+            if random.random() < 0.5:
+                continue
+            summary = f"{summary}, which is a much longer sentence than anyone asked for"
+        summaries.append({"id": rule_id, "summary": summary})
+    return json.dumps({"summaries": summaries})
+
+def admit(state, tokens):
+# request and token allowances that refill continuously up to a minute's worth, the way the API
+# replenishes its limits; returns the seconds to wait if either is short
+    now = time.monotonic()
+    with state["lock"]:
+        elapsed = now - state["updated"]
+        state["updated"] = now
+        state["requests"] = min(state["rpm"], state["requests"] + elapsed * state["rpm"] / 60)
+        state["tokens"] = min(state["tpm"], state["tokens"] + elapsed * state["tpm"] / 60)
+        if state["requests"] < 1 or state["tokens"] < tokens:
+            return max((1 - state["requests"]) * 60 / state["rpm"], (tokens - state["tokens"]) * 60 / state["tpm"], 0.1)
+        state["requests"] -= 1
+        state["tokens"] -= tokens
+        return 0
+
+def make_handler(state, latency, jitter, error_rate, bad_item_rate):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def count(self, key):
+            with state["lock"]:
+                state["stats"][key] += 1
+
+        def do_GET(self):
+            if self.path == "/stats":
+                with state["lock"]:
+                    return self.send_json(200, dict(state["stats"]))
+            self.send_json(404, {"error": {"message": f"no fake for {self.path}"}})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if self.path.rstrip("/") != "/v1/chat/completions":
+                return self.send_json(404, {"error": {"message": f"no fake for {self.path}"}})
+            if not self.headers.get("Authorization", "").startswith("Bearer "):
+                return self.send_json(401, {"error": {"message": "missing API key", "type": "invalid_request_error"}})
+
+            prompt = "\n".join(message.get("content", "") for message in body.get("messages", []))
+            max_tokens = body.get("max_tokens") or 256
+            wait = admit(state, count_tokens(prompt) + max_tokens)
+            if wait:
+                self.count("rate_limited")
+                return self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                                      "code": "rate_limit_exceeded"}},
+                                      {"Retry-After": f"{wait:.1f}"})
+            time.sleep(latency + random.uniform(0, jitter))
+            if random.random() < error_rate:
+                self.count("errors")
+                status = random.choice([500, 503])
+                return self.send_json(status, {"error": {"message": "The server had an error", "type": "server_error"}})
+
+            self.count("completions")
+            if (body.get("response_format") or {}).get("type") == "json_object":
+                content = summarize_batch(prompt, bad_item_rate)
+            else:
+                content = summarize(prompt)
+            usage = {"prompt_tokens": count_tokens(prompt), "completion_tokens": count_tokens(content)}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            self.send_json(200, {
+                "id": f"chatcmpl-fake-{next(state['ids'])}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "gpt-4o"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+    return Handler
+
+class FakeServer(ThreadingHTTPServer):
+    request_queue_size = 256  # every worker of the pipeline connects at once
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat completions API for offline runs of the migrator")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=800, help="Time every completion takes")
+    parser.add_argument("--jitter-ms", type=float, default=400, help="Up to this much more, at random")
+    parser.add_argument("--rpm", type=int, default=500, help="Requests per minute before answering 429")
+    parser.add_argument("--tpm", type=int, default=30000, help="Tokens per minute before answering 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failed with 500/503")
+    parser.add_argument("--bad-item-rate", type=float, default=0.0,
+                        help="Share of the alerts in a batched answer left out or summarized too long")
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    state = {"lock": threading.Lock(), "updated": time.monotonic(), "rpm": args.rpm, "tpm": args.tpm,
+             "requests": args.rpm, "tokens": args.tpm, "ids": itertools.count(1),
+             "stats": {"completions": 0, "rate_limited": 0, "errors": 0}}
+    server = FakeServer(("127.0.0.1", args.port),
+                        make_handler(state, args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate,
+                                     args.bad_item_rate))
+
+    print(f"Fake OpenAI API listening on http://127.0.0.1:{args.port}")
+    print(f"  export OPENAI_BASE_URL=http://127.0.0.1:{args.port}/v1")
+    print(f"  export OPENAI_API_KEY={FAKE_KEY}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
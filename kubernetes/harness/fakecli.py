@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the gcloud and kubectl executables, so the scripts in kubernetes/ can run without a
+live GCP project.
+
+scenarios.py puts small "gcloud" and "kubectl" wrappers on PATH that call this script with the tool
+name first. It then either:
+  - replays: finds the recording whose match tokens all appear in the command line (the most
+    specific one wins) and prints its stdout/stderr with its exit code, or
+  - records: runs the real tool, passes its output through and saves it as a new recording.
+
+Recordings live in FAKECLI_DIR/<tool>/<name>.json (metadata) + <name>.out / <name>.err (raw output).
+FAKECLI_MODE=replay|record, FAKECLI_LATENCY_MS adds a fixed delay to every replayed call.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+def load_recordings(directory):
+    recordings = []
+    if not os.path.isdir(directory):
+        return recordings
+    for entry in os.listdir(directory):
+        if entry.endswith(".json"):
+            with open(os.path.join(directory, entry)) as f:
+                meta = json.load(f)
+            meta["path"] = os.path.join(directory, entry[:-len(".json")])
+            recordings.append(meta)
+    # most specific first, so "container clusters list" never shadows a longer exact recording
+    recordings.sort(key=lambda meta: len(meta["match"]), reverse=True)
+    return recordings
+
+def find_recording(recordings, argv):
+    args = set(argv)
+    for meta in recordings:
+        if all(token in args for token in meta["match"]):
+            return meta
+    return None
+
+def copy_file(path, stream):
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, stream)
+        stream.flush()
+
+def replay(tool, argv, directory):
+    meta = find_recording(load_recordings(directory), argv)
+    if meta is None:
+        sys.stderr.write(f"fakecli: no recording for {tool} {' '.join(argv)}\n")
+        return 127
+    latency = float(os.environ.get("FAKECLI_LATENCY_MS", meta.get("latency_ms", 0)))
+    if latency:
+        time.sleep(latency / 1000)
+    copy_file(meta["path"] + ".out", sys.stdout.buffer)
+    copy_file(meta["path"] + ".err", sys.stderr.buffer)
+    return meta.get("exit_code", 0)
+
+def real_tool(tool):
+# the first tool of that name on PATH that isn't one of our wrappers
+    override = os.environ.get(f"FAKECLI_REAL_{tool.upper()}")
+    if override:
+        return override
+    fake_dir = os.environ.get("FAKECLI_BIN", "")
+    path = os.pathsep.join(p for p in os.environ.get("PATH", "").split(os.pathsep)
+                           if os.path.abspath(p) != os.path.abspath(fake_dir))
+    return shutil.which(tool, path=path)
+
+def record(tool, argv, directory):
+    executable = real_tool(tool)
+    if executable is None:
+        sys.stderr.write(f"fakecli: real {tool} not found on PATH\n")
+        return 127
+    started = time.time()
+    result = subprocess.run([executable] + argv, capture_output=True)
+    elapsed_ms = (time.time() - started) * 1000
+
+    os.makedirs(directory, exist_ok=True)
+    name = hashlib.sha1("\0".join(argv).encode()).hexdigest()[:16]
+    base = os.path.join(directory, name)
+    with open(base + ".out", "wb") as f:
+        f.write(result.stdout)
+    with open(base + ".err", "wb") as f:
+        f.write(result.stderr)
+    with open(base + ".json", "w") as f:
+        json.dump({"match": argv, "exit_code": result.returncode, "latency_ms": round(elapsed_ms)}, f)
+
+    sys.stdout.buffer.write(result.stdout)
+    sys.stderr.buffer.write(result.stderr)
+    return result.returncode
+
+def main():
+    tool, argv = sys.argv[1], sys.argv[2:]
+    directory = os.path.join(os.environ.get("FAKECLI_DIR", "recordings"), tool)
+    if os.environ.get("FAKECLI_MODE", "replay") == "record":
+        return record(tool, argv, directory)
+    return replay(tool, argv, directory)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Generates recordings for fakecli.py, so nodepoolUpgrader.py and AlertManager-Migrator.py can be run
+end to end against synthetic clusters of any size, and sets up the fake gcloud/kubectl on PATH.
+
+The clusters come from the same generator as fake-gke-api.py, so CLI and API runs see the same data.
+
+    python scenarios.py generate --out /tmp/rec --node-pools 100 --deployments 10000 --pdbs 5000
+    python scenarios.py bin --out /tmp/fakebin --recordings /tmp/rec --latency-ms 300
+    export PATH=/tmp/fakebin:$PATH
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import stat
+import sys
+import types
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+KUBERNETES_DIR = os.path.dirname(HARNESS_DIR)
+
+def load_fake_api():
+    spec = importlib.util.spec_from_file_location("fake_gke_api", os.path.join(KUBERNETES_DIR, "fake-gke-api.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def load_upgrader():
+# the code part of nodepoolUpgrader.py (after its "# ---" header), for its list column definitions
+    path = os.path.join(KUBERNETES_DIR, "nodepoolUpgrader.py")
+    with open(path) as f:
+        code = f.read().partition("# ---\n")[2]
+    module = types.ModuleType("nodepool_upgrader")
+    exec(compile(code, path, "exec"), module.__dict__)
+    return module
+
+def jsonpath_rows(upgrader, items, columns):
+# what `kubectl get ... -o=jsonpath=<the upgrader's template>` prints: tab-separated cells, lists
+# from [*] paths joined by spaces, maps as compact JSON
+    lines = []
+    for item in items:
+        cells = []
+        for path, _ in columns:
+            value = upgrader.column_value(item, path)
+            if value is None:
+                cells.append("")
+            elif "[*]" in path:
+                cells.append(" ".join(str(v) for v in value))
+            elif isinstance(value, (dict, list)):
+                cells.append(json.dumps(value, separators=(",", ":")))
+            else:
+                cells.append(str(value))
+        lines.append("\t".join(cells) + "\n")
+    return "".join(lines)
+
+def write_recording(directory, tool, name, match, stdout="", stderr="", exit_code=0, latency_ms=0):
+    path = os.path.join(directory, tool)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, name + ".out"), "w") as f:
+        f.write(stdout)
+    with open(os.path.join(path, name + ".err"), "w") as f:
+        f.write(stderr)
+    with open(os.path.join(path, name + ".json"), "w") as f:
+        json.dump({"match": match, "exit_code": exit_code, "latency_ms": latency_ms}, f)
+
+def build_prometheus_rules(rule_count, rules_per_group=20, groups_per_object=5):
+# a PrometheusRule list like `kubectl get prometheusrule -A` prints, multi-line descriptions
+# included, since that is what the migrator's flattening step is for
+    items = []
+    groups = []
+    rules = []
+    for i in range(rule_count):
+        rules.append({
+            "alert": f"HighErrorRate{i}",
+            "expr": f'sum(rate(http_requests_total{{job="svc-{i}",code=~"5.."}}[5m]))\n  / sum(rate(http_requests_total{{job="svc-{i}"}}[5m])) > 0.05',
+            "for": "10m",
+            "labels": {"severity": "critical" if i % 4 == 0 else "warning"},
+            "annotations": {
+                "summary": f"High error rate on svc-{i}",
+                "description": f"More than 5% of requests to svc-{i} failed\nover the last 5 minutes.\nCheck the 'svc-{i}' dashboards."
+            }
+        })
+        if len(rules) == rules_per_group or i == rule_count - 1:
+            groups.append({"name": f"group-{len(groups)}", "rules": rules})
+            rules = []
+        if len(groups) == groups_per_object or (i == rule_count - 1 and groups):
+            items.append({
+                "apiVersion": "monitoring.coreos.com/v1",
+                "kind": "PrometheusRule",
+                "metadata": {"name": f"rules-{len(items)}", "namespace": f"monitoring-{len(items) % 3}"},
+                "spec": {"groups": groups}
+            })
+            groups = []
+    return {"apiVersion": "v1", "kind": "List", "items": items}
+
+def dump_rules_yaml(data):
+    import yaml
+
+    class Dumper(yaml.SafeDumper):
+        pass
+
+    def str_presenter(dumper, value):
+        style = "|" if "\n" in value else None
+        return dumper.represent_scalar("tag:yaml.org,2002:str", value, style=style)
+
+    Dumper.add_representer(str, str_presenter)
+    return yaml.dump(data, Dumper=Dumper, default_flow_style=False, sort_keys=False, width=1000)
+
+def generate(out, fake_args, rules=0):
+    state = load_fake_api().build_state(fake_args)
+    clusters = list(state["clusters"].values())
+    cluster = clusters[0]
+    warning = "WARNING: Accessing a Kubernetes Engine cluster requires the kubernetes commandline client [kubectl].\n"
+
+    write_recording(out, "gcloud", "auth-token", ["auth", "print-access-token"], stdout="fake-token\n")
+    write_recording(out, "gcloud", "get-credentials", ["container", "clusters", "get-credentials"],
+                    stderr=f"Fetching cluster endpoint and auth data.\nkubeconfig entry generated for {cluster['name']}.\n")
+    write_recording(out, "gcloud", "clusters-describe", ["container", "clusters", "describe"],
+                    stdout=json.dumps(cluster, indent=2) + "\n", stderr=warning)
+    write_recording(out, "gcloud", "clusters-list", ["container", "clusters", "list"],
+                    stdout=json.dumps(clusters, indent=2) + "\n")
+    write_recording(out, "gcloud", "node-pools-list", ["container", "node-pools", "list"],
+                    stdout=json.dumps(cluster["nodePools"], indent=2) + "\n", stderr=warning)
+    # surge setting updates and upgrades are accepted right away and reported as finished on the first poll
+    write_recording(out, "gcloud", "node-pools-update", ["container", "node-pools", "update"],
+                    stdout=json.dumps({"name": "operation-fake-update", "operationType": "UPDATE_NODE_POOL",
+                                       "status": "RUNNING"}) + "\n")
+    write_recording(out, "gcloud", "clusters-upgrade", ["container", "clusters", "upgrade"],
+                    stdout=json.dumps({"name": "operation-fake", "operationType": "UPGRADE_NODES",
+                                       "status": "RUNNING"}) + "\n")
+    write_recording(out, "gcloud", "regions-describe", ["compute", "regions", "describe"],
+                    stdout=json.dumps({"quotas": state["quotas"]}, indent=2) + "\n")
+    write_recording(out, "gcloud", "operations-list", ["container", "operations", "list"], stdout="[]\n")
+    write_recording(out, "gcloud", "operations-describe", ["container", "operations", "describe"],
+                    stdout=json.dumps({"name": "operation-fake", "status": "DONE"}) + "\n")
+
+    upgrader = load_upgrader()
+    for name, match, items, columns in [
+        ("deployments", ["get", "deployments"], state["deployments"], upgrader.CONTROLLER_COLUMNS),
+        ("statefulsets", ["get", "statefulsets"], state["statefulsets"], upgrader.CONTROLLER_COLUMNS),
+        ("replicasets", ["get", "replicasets"], state["replicasets"], upgrader.CONTROLLER_COLUMNS),
+        ("hpas", ["get", "horizontalpodautoscalers"], state["hpas"], upgrader.HPA_COLUMNS),
+        ("pdbs", ["get", "pdb"], state["pdbs"], upgrader.PDB_COLUMNS),
+        ("pods", ["get", "pods"], state["pods"], upgrader.POD_COLUMNS),
+        ("nodes", ["get", "nodes"], state["nodes"], upgrader.NODE_COLUMNS),
+    ]:
+        write_recording(out, "kubectl", name, match, stdout=jsonpath_rows(upgrader, items, columns))
+
+    if rules:
+        # the migrator reads -o yaml, or -o json when it rewrites summaries
+        prometheus_rules = build_prometheus_rules(rules)
+        write_recording(out, "kubectl", "prometheusrules", ["get", "prometheusrule", "json"],
+                        stdout=json.dumps(prometheus_rules, indent=4) + "\n")
+        write_recording(out, "kubectl", "prometheusrules-yaml", ["get", "prometheusrule", "yaml"],
+                        stdout=dump_rules_yaml(prometheus_rules))
+
+def make_bin_dir(out, recordings, latency_ms=None, mode="replay"):
+# tiny gcloud/kubectl wrappers that hand over to fakecli.py with the settings baked in
+    os.makedirs(out, exist_ok=True)
+    fakecli = os.path.join(HARNESS_DIR, "fakecli.py")
+    for tool in ("gcloud", "kubectl"):
+        path = os.path.join(out, tool)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\n")
+            f.write(f'export FAKECLI_DIR="{os.path.abspath(recordings)}" FAKECLI_MODE="{mode}" FAKECLI_BIN="{os.path.abspath(out)}"\n')
+            if latency_ms is not None:
+                f.write(f'export FAKECLI_LATENCY_MS="{latency_ms}"\n')
+            f.write(f'exec "{sys.executable}" "{fakecli}" {tool} "$@"\n')
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(description="Record/replay harness for the gcloud/kubectl based scripts")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="Write recordings for a synthetic cluster",
+                         parents=[load_fake_api().build_parser()], add_help=False, conflict_handler="resolve")
+    gen.add_argument("--out", required=True)
+    gen.add_argument("--rules", type=int, default=0, help="Also generate this many PrometheusRule alert rules")
+
+    bin_cmd = sub.add_parser("bin", help="Create gcloud/kubectl wrappers that replay (or record) via fakecli.py")
+    bin_cmd.add_argument("--out", required=True)
+    bin_cmd.add_argument("--recordings", required=True)
+    bin_cmd.add_argument("--latency-ms", type=float)
+    bin_cmd.add_argument("--mode", choices=["replay", "record"], default="replay")
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        generate(args.out, args, args.rules)
+        print(f"Recordings written to {args.out}")
+    else:
+        make_bin_dir(args.out, args.recordings, args.latency_ms, args.mode)
+        print(f"export PATH={os.path.abspath(args.out)}:$PATH")
+
+if __name__ == "__main__":
+    main()
@@ -13,69 +13,302 @@ import subprocess
 import json
 from tabulate import tabulate
 import sys
+import os
+import re
+import ssl
+import socket
+import time
+import csv
+import math
+import hashlib
+import functools
+import statistics
+import base64
+import shutil
+import tempfile
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime
 from packaging import version
+from urllib.parse import urlencode
 import logging
 
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 def strip_gke_suffix(v):
 # removes the GKE tag from the version string
     return v.split('-gke')[0]
 
+@functools.lru_cache(maxsize=None)
+def parse_gke_version(v):
+# a fleet runs a handful of distinct versions, so each one is parsed only once
+    return version.parse(strip_gke_suffix(v))
+
 # Functions to generate the log file output
-log_lines = []
+# Everything we print and every command or API call we make is an event. Events are streamed to a
+# JSONL journal as the run goes (buffered, flushed on the next event once JOURNAL_FLUSH_SECONDS have
+# passed, and before anything that blocks: prompts and waits on operations) and the human-readable
+# .log and console output are rendered from those same events, so a crash or Ctrl-C keeps everything
+# up to that point and nothing piles up in memory during long fleet runs.
+JOURNAL_FLUSH_SECONDS = 1.0
+JOURNAL_BUFFER_BYTES = 64 * 1024
+JOURNAL_APPEND = False  # --resume runs add to the journals of the run they continue instead of replacing them
+_run_journal = {"journal": None}
+# in fleet mode every cluster runs in its own thread, so each thread writes its own journal
+# and prefixes what it prints with the cluster it is working on
+_log_context = threading.local()
+_print_lock = threading.Lock()
+_prompt_lock = threading.Lock()
+
+def open_journal(basename):
+    return {
+        "name": basename,
+        "events": open(f"{basename}.jsonl", "a" if JOURNAL_APPEND else "w", buffering=JOURNAL_BUFFER_BYTES),
+        "text": open(f"{basename}.log", "a" if JOURNAL_APPEND else "w", buffering=JOURNAL_BUFFER_BYTES),
+        "lock": threading.Lock(),
+        "flushed_at": time.time()
+    }
+
+def flush_journals():
+# called before blocking, so what was logged up to a prompt or a long wait is on disk while we wait
+    for journal in (getattr(_log_context, "journal", None), _run_journal["journal"]):
+        if journal is None:
+            continue
+        with journal["lock"]:
+            if not journal["events"].closed:
+                journal["events"].flush()
+                journal["text"].flush()
+                journal["flushed_at"] = time.time()
+
+def close_journal(journal):
+    with journal["lock"]:
+        journal["events"].close()
+        journal["text"].close()
+    with _print_lock:
+        print(f"\nLog written to {journal['name']}.log (events in {journal['name']}.jsonl)")
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def render_event(event):
+    if event["type"] == "log":
+        return event["msg"] + event["end"]
+    if event["type"] == "prompt":
+        return f"{event['question']}{event['answer']}\n"
+    status = f"HTTP {event['exit_code']}" if event["kind"] == "api" else f"exit {event['exit_code']}"
+    return f"  {event['command']} -> {status} in {event['duration']:.2f}s, {format_bytes(event['bytes'])}\n"
+
+def emit(event, echo=True):
+    event["ts"] = time.time()
+    text = render_event(event)
+    prefix = getattr(_log_context, "prefix", "")
+    if echo:
+        with _print_lock:
+            if prefix:
+                print("\n".join(f"{prefix}{line}" if line else line for line in text.split("\n")), end="")
+            else:
+                print(text, end="")
+
+    journal = getattr(_log_context, "journal", None) or _run_journal["journal"]
+    if journal is None:
+        return
+    with journal["lock"]:
+        journal["events"].write(json.dumps(event) + "\n")
+        journal["text"].write(text)
+        if event["ts"] - journal["flushed_at"] >= JOURNAL_FLUSH_SECONDS:
+            journal["events"].flush()
+            journal["text"].flush()
+            journal["flushed_at"] = event["ts"]
 
 def log(msg, end='\n'):
-    print(msg, end=end)
-    log_lines.append(msg + end)
+    emit({"type": "log", "msg": msg, "end": end})
+
+def with_log_context(fn):
+# helper threads start without the cluster's journal and prefix, so they borrow the caller's
+    prefix = getattr(_log_context, "prefix", None)
+    journal = getattr(_log_context, "journal", None)
+
+    def run(*args):
+        if prefix is None:
+            return fn(*args)
+        _log_context.prefix, _log_context.journal = prefix, journal
+        try:
+            return fn(*args)
+        finally:
+            del _log_context.prefix, _log_context.journal
+    return run
+
+def record_command(kind, command, started, exit_code, size):
+# one event per gcloud/kubectl command or API call: how long it took, how it ended, how much it returned
+    duration = time.time() - started
+    emit({"type": "command", "kind": kind, "command": command, "duration": duration,
+          "exit_code": exit_code, "bytes": size})
+    ok = exit_code == 0 if kind == "cli" else isinstance(exit_code, int) and exit_code < 400
+    observe(operation_type(kind, command), duration, ok)
+
+# Latency metrics
+# Every command/API call (and every node pool upgrade as a whole) lands in a per-operation
+# histogram. At exit they can be written as a textfile for node_exporter's textfile collector
+# (--metrics-file) and/or summarized on the console (--profile), so we can see whether the time
+# goes to auth, describes, PDB lookups or the upgrades themselves.
+METRICS_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200]
+_metrics = {}
+_metrics_lock = threading.Lock()
+_api_path_ids = re.compile(r'/(projects|locations|clusters|nodePools|operations|namespaces|daemonsets)/[^/]+')
+
+def api_path_type(path):
+    return _api_path_ids.sub(lambda m: f'/{m.group(1)}/*', path.split("?", 1)[0])
+
+def operation_type(kind, command):
+# groups calls by what they do rather than which object they touched, so the metrics keep a fixed
+# set of labels: names, flags, paths and queries are dropped
+#   "GET /v1/projects/p1/locations/r/clusters/c1" -> "api GET /v1/projects/*/locations/*/clusters/*"
+#   "gcloud container node-pools update pool-0 --cluster=c1" -> "cli gcloud container node-pools update"
+#   "kubectl get nodes -l=pool=pool-0" -> "cli kubectl get nodes", "kubectl apply -f /tmp/x.json" -> "cli kubectl apply"
+#   "kubectl get --raw /api/v1/pods?fieldSelector=..." -> "cli kubectl get --raw /api/v1/pods"
+    if kind == "api":
+        method, _, url = command.partition(" ")
+        return f"api {method} {api_path_type('/' + url.split('://', 1)[-1].split('/', 1)[-1])}"
+    words = command.split()
+    if words[0] == "kubectl":
+        if "--raw" in words[:-1]:
+            return f"cli kubectl {words[1]} --raw {api_path_type(words[words.index('--raw') + 1])}"
+        # the verb, and the resource type when one follows it
+        return "cli " + " ".join(words[:2] + [word for word in words[2:3] if not word.startswith("-")])
+    # gcloud: group, resource and verb (or fewer, "auth print-access-token"), never what follows
+    return "cli " + " ".join([words[0]] + [word for word in words[1:4] if not word.startswith("-")][:3])
+
+def observe(operation, seconds, ok=True):
+    with _metrics_lock:
+        metric = _metrics.get(operation)
+        if metric is None:
+            metric = _metrics[operation] = {"count": 0, "errors": 0, "sum": 0.0, "max": 0.0,
+                                            "buckets": [0] * len(METRICS_BUCKETS)}
+        metric["count"] += 1
+        metric["sum"] += seconds
+        metric["max"] = max(metric["max"], seconds)
+        if not ok:
+            metric["errors"] += 1
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                metric["buckets"][i] += 1
+
+def metric_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def write_metrics_file(path):
+# written next to the target and renamed into place, as the textfile collector expects
+    name = "nodepool_upgrader_operation_duration_seconds"
+    lines = [f"# HELP {name} Wall-clock time of gcloud/kubectl commands, API calls and node pool upgrades.",
+             f"# TYPE {name} histogram"]
+    with _metrics_lock:
+        metrics = sorted(_metrics.items())
+    for operation, metric in metrics:
+        label = f'operation="{metric_label(operation)}"'
+        for bound, count in zip(METRICS_BUCKETS, metric["buckets"]):
+            lines.append(f'{name}_bucket{{{label},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{label},le="+Inf"}} {metric["count"]}')
+        lines.append(f'{name}_sum{{{label}}} {metric["sum"]:.6f}')
+        lines.append(f'{name}_count{{{label}}} {metric["count"]}')
+    lines += ["# HELP nodepool_upgrader_operation_errors_total Failed commands, API calls and upgrades.",
+              "# TYPE nodepool_upgrader_operation_errors_total counter"]
+    for operation, metric in metrics:
+        label = f'operation="{metric_label(operation)}"'
+        lines.append(f'nodepool_upgrader_operation_errors_total{{{label}}} {metric["errors"]}')
+    lines += ["# HELP nodepool_upgrader_last_run_timestamp_seconds When the upgrader last finished a run.",
+              "# TYPE nodepool_upgrader_last_run_timestamp_seconds gauge",
+              f"nodepool_upgrader_last_run_timestamp_seconds {time.time():.0f}"]
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
 
-def write_log_file(project, region, cluster):
-    filename = f"{project}-{region}-{cluster}.log"
-    with open(filename, "w") as f:
-        f.writelines(log_lines)
-    print(f"\nLog written to {filename}")
+def print_profile(wall_seconds):
+    with _metrics_lock:
+        metrics = sorted(_metrics.items(), key=lambda item: item[1]["sum"], reverse=True)
+    rows = [{
+        "operation": operation,
+        "calls": metric["count"],
+        "errors": metric["errors"],
+        "total (s)": f"{metric['sum']:.2f}",
+        "avg (s)": f"{metric['sum'] / metric['count']:.3f}",
+        "max (s)": f"{metric['max']:.3f}",
+        "% of run": f"{100 * metric['sum'] / wall_seconds:.1f}" if wall_seconds else "-"
+    } for operation, metric in metrics]
+    log(f"\nProfile ({format_duration(wall_seconds)} wall-clock, concurrent calls overlap):\n")
+    log(tabulate(rows, headers="keys"))
 
-def extract_json_from_text(text):
-# this was tricky: gcloud command offers trailing AND leading information on the output, for example
+def ask(question):
+# prompts are serialized so concurrent clusters don't interleave their questions
+    prefix = getattr(_log_context, "prefix", "")
+    flush_journals()
+    with _prompt_lock:
+        # clusters queued behind the prompt when the run was interrupted get no further questions
+        if _interrupted.is_set():
+            return "n"
+        answer = input(f"{prefix}{question}").strip().lower()
+    # input() already showed the question, so the answer only goes to the journal
+    emit({"type": "prompt", "question": question, "answer": answer}, echo=False)
+    return answer
+
+# gcloud command offers trailing AND leading information on the output, for example
 # when it outputs warnings and/or there are error messages at the end of the json.
-# This whole function was written only to extract the useful json from the output.
-    # Find first JSON opening char
-    first_brace = text.find('{')
-    first_bracket = text.find('[')
+# Instead of counting braces (which breaks on a '}' inside a label or description) we find where
+# the JSON starts and let the real decoder, which understands strings and escapes, tell us where it
+# ends. raw_decode works on offsets, so the output is never sliced or copied.
+_json_decoder = json.JSONDecoder()
+_json_line_start = re.compile(r'^[\[{]', re.M)
+_json_any_start = re.compile(r'[\[{]')
 
-    # Determine which comes first (and exists)
-    if first_brace == -1 and first_bracket == -1:
+def decode_json_from_text(text):
+    # gcloud prints its JSON from the start of a line, and everything nested in it indented, so only
+    # unindented lines can open the document. One that fails to decode on its own line is warning
+    # text ("[beta] ..."); failing further down means the document itself is cut off or broken,
+    # and the nested lines after it must not be taken for it
+    for match in _json_line_start.finditer(text):
+        start = match.start()
+        try:
+            return _json_decoder.raw_decode(text, start)[0]
+        except json.JSONDecodeError as e:
+            line_end = text.find("\n", start)
+            if line_end != -1 and e.pos > line_end:
+                raise ValueError(f"Invalid JSON in output: {e}") from e
+    # no line starts with it (it follows a message on the same line): the first opening is the document
+    match = _json_any_start.search(text)
+    if match is None:
         raise ValueError("No JSON object or array found in text")
+    try:
+        return _json_decoder.raw_decode(text, match.start())[0]
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON in output: {e}") from e
 
-    if first_brace == -1:
-        start = first_bracket
-        open_char = '['
-        close_char = ']'
-    elif first_bracket == -1:
-        start = first_brace
-        open_char = '{'
-        close_char = '}'
-    else:
-        if first_brace < first_bracket:
-            start = first_brace
-            open_char = '{'
-            close_char = '}'
-        else:
-            start = first_bracket
-            open_char = '['
-            close_char = ']'
-
-    # Now find the matching closing brace/bracket (handle nested correctly)
-    depth = 0
-    for i in range(start, len(text)):
-        if text[i] == open_char:
-            depth += 1
-        elif text[i] == close_char:
-            depth -= 1
-            if depth == 0:
-                end = i + 1
-                return text[start:end]
-
-    raise ValueError("No matching closing bracket found for JSON.")
+class CommandError(Exception):
+# a gcloud/kubectl command that failed (or a read the cache can't serve); carries the command and its
+# output, and only main() turns it into an exit code
+    def __init__(self, message, cmd=None, output=""):
+        super().__init__(message)
+        self.cmd = cmd
+        self.output = output
+
+def command_error(cmd, returncode, output):
+    last_line = next((line.strip() for line in reversed(output.splitlines()) if line.strip()), "no output")
+    return CommandError(f"'{' '.join(cmd)[:200]}' exited with {returncode}: {last_line[:300]}", cmd, output)
 
 def run_cmd(cmd, return_json=True, dry_run=False):
     log(f"Running: {' '.join(cmd)}")
@@ -84,219 +317,2413 @@ def run_cmd(cmd, return_json=True, dry_run=False):
         log("Dry run: skipping execution")
         return {} if return_json else ""
 
+    started = time.time()
     try:
         output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        record_command("cli", " ".join(cmd[:4]), started, 0, len(output))
         decoded = output.decode()
 
         if not return_json:
             return decoded
 
-        # Extract valid JSON substring from output (ignore warnings)
-        json_str = extract_json_from_text(decoded)
-
+        # Decode the JSON out of the output (ignore warnings)
         try:
-            return json.loads(json_str)
-        except json.JSONDecodeError as e:
+            return decode_json_from_text(decoded)
+        except ValueError as e:
             log(f"JSON decode error: {e}")
-            log(f"Raw (trimmed) output preview:\n{json_str[:300]}...")
+            log(f"Raw (trimmed) output preview:\n{decoded[:300]}...")
             raise
 
     except subprocess.CalledProcessError as e:
-        log(f"Command failed:\n{e.output.decode()}")
-        sys.exit(1)
+        record_command("cli", " ".join(cmd[:4]), started, e.returncode, len(e.output or b""))
+        output = e.output.decode()
+        log(f"Command failed:\n{output}")
+        raise command_error(cmd, e.returncode, output) from None
+
+def run_cmd_lines(cmd):
+# like run_cmd, but hands out stdout line by line while the command is still writing it,
+# so a huge listing is never held in memory as a whole
+    log(f"Running: {' '.join(cmd)}")
+    started = time.time()
+    size = 0
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors, text=True)
+        for line in process.stdout:
+            size += len(line)
+            yield line.rstrip("\n")
+        process.wait()
+        record_command("cli", " ".join(cmd[:4]), started, process.returncode, size)
+        if process.returncode != 0:
+            errors.seek(0)
+            output = errors.read().decode()
+            log(f"Command failed:\n{output}")
+            raise command_error(cmd, process.returncode, output)
+
+# In-process API client layer.
+# Forking gcloud/kubectl for every lookup means paying interpreter startup, auth refresh and
+# a fresh TLS handshake each time. Instead we talk to the GKE and Kubernetes REST APIs directly,
+# reusing keep-alive connections and a single access token. The subprocess path above stays as
+# the fallback whenever httpx is missing or an API call fails.
+# GKE_API_ENDPOINT / KUBE_API_ENDPOINT / GKE_ACCESS_TOKEN let you point the tool at
+# fake-gke-api.py to run and benchmark it offline.
+TRANSPORT = "api"
+GKE_API_ENDPOINT = os.environ.get("GKE_API_ENDPOINT", "https://container.googleapis.com")
+HTTP_TIMEOUT = 60
+HTTP_POOL_SIZE = 10
+TOKEN_TTL = 50 * 60  # gcloud access tokens live for an hour, refresh a bit before that
+
+_token_cache = {"token": None, "expires_at": 0}
+_token_lock = threading.Lock()
+_http_clients = {}
+_http_lock = threading.Lock()
+_cluster_cache = {}
+_kube_targets = {}
+_kube_credentials = set()
+
+def api_enabled():
+    return TRANSPORT == "api" and httpx is not None
+
+def get_access_token():
+# one token shared by every API call, refreshed only when it is about to expire
+    override = os.environ.get("GKE_ACCESS_TOKEN")
+    if override:
+        return override
+    with _token_lock:
+        if _token_cache["token"] and time.time() < _token_cache["expires_at"]:
+            return _token_cache["token"]
+        started = time.time()
+        output = subprocess.check_output(["gcloud", "auth", "print-access-token"])
+        record_command("cli", "gcloud auth print-access-token", started, 0, len(output))
+        token = output.decode().strip()
+        _token_cache["token"] = token
+        _token_cache["expires_at"] = time.time() + TOKEN_TTL
+        return token
+
+def invalidate_access_token():
+    with _token_lock:
+        _token_cache["token"] = None
+        _token_cache["expires_at"] = 0
+
+def get_http_client(base_url, verify=True):
+# one pooled keep-alive client per API server, so every call after the first skips the TLS handshake
+    with _http_lock:
+        client = _http_clients.get(base_url)
+        if client is None:
+            client = httpx.Client(
+                base_url=base_url,
+                verify=verify,
+                timeout=HTTP_TIMEOUT,
+                limits=httpx.Limits(max_connections=HTTP_POOL_SIZE,
+                                    max_keepalive_connections=HTTP_POOL_SIZE)
+            )
+            _http_clients[base_url] = client
+        return client
+
+def api_request(method, base_url, path, params=None, body=None, verify=True):
+    client = get_http_client(base_url, verify)
+    for attempt in range(2):
+        token = get_access_token()
+        started = time.time()
+        try:
+            response = client.request(method, path, params=params, json=body,
+                                      headers={"Authorization": f"Bearer {token}"})
+        except httpx.HTTPError:
+            record_command("api", f"{method} {base_url}{path}", started, "error", 0)
+            raise
+        record_command("api", f"{method} {base_url}{path}", started, response.status_code, len(response.content))
+        # a 401 usually means the cached token expired early, refresh it once and retry
+        if response.status_code == 401 and attempt == 0:
+            invalidate_access_token()
+            continue
+        response.raise_for_status()
+        return response.json()
+
+def api_get(base_url, path, params=None, verify=True):
+    return api_request("GET", base_url, path, params=params, verify=verify)
+
+def api_or_cli(api_call, cli_cmd, dry_run=False):
+# tries the API first and drops back to the gcloud/kubectl command if anything goes wrong
+    if api_enabled():
+        try:
+            return api_call()
+        except (httpx.HTTPError, subprocess.CalledProcessError, OSError, ValueError, KeyError) as e:
+            log(f"API call failed ({e}), falling back to CLI")
+    return run_cmd(cli_cmd, dry_run=dry_run)
+
+def gke_cluster_path(cluster_name, region, project):
+    return f"/v1/projects/{project}/locations/{region}/clusters/{cluster_name}"
+
+# The GKE resources are projected server side to the fields we actually read: the "fields" system
+# parameter for the API, a json() projection for gcloud. A cluster describe otherwise carries every
+# node pool's full config, which on a 1000-pool cluster is most of the response.
+CLUSTER_FIELDS = ["name", "location", "status", "currentMasterVersion", "currentNodeVersion",
+                  "endpoint", "masterAuth.clusterCaCertificate", "privateClusterConfig.enablePrivateNodes"]
+NODE_POOL_FIELDS = ["name", "version", "status", "initialNodeCount", "locations", "autoscaling",
+                    "upgradeSettings", "config.imageType", "config.machineType"]
+
+def api_fields(fields, collection=None):
+    # gcloud marks repeated fields with [] (nodePools[].version), the API's field mask does not
+    selection = ",".join(field.replace("[]", "").replace(".", "/") for field in fields)
+    return f"{collection}({selection})" if collection else selection
+
+def gcloud_format(fields):
+    return f"--format=json({','.join(fields)})"
+
+def gke_get_cluster(cluster_name, region, project):
+# the cluster resource carries both the master version and the endpoint/CA we need for
+# the Kubernetes API, so it is fetched once per run and shared
+    key = (project, region, cluster_name)
+    if key not in _cluster_cache:
+        _cluster_cache[key] = api_get(GKE_API_ENDPOINT, gke_cluster_path(cluster_name, region, project),
+                                      params={"fields": api_fields(CLUSTER_FIELDS)})
+    return _cluster_cache[key]
+
+def get_kube_target(cluster_name, region, project):
+    key = (project, region, cluster_name)
+    if key not in _kube_targets:
+        override = os.environ.get("KUBE_API_ENDPOINT")
+        if override:
+            _kube_targets[key] = (override.rstrip("/"), True)
+        else:
+            cluster = gke_get_cluster(cluster_name, region, project)
+            ca_pem = base64.b64decode(cluster["masterAuth"]["clusterCaCertificate"]).decode()
+            _kube_targets[key] = (f"https://{cluster['endpoint']}", ssl.create_default_context(cadata=ca_pem))
+    return _kube_targets[key]
+
+def kube_get(cluster_name, region, project, path, params=None):
+    base_url, verify = get_kube_target(cluster_name, region, project)
+    return api_get(base_url, path, params=params, verify=verify)
+
+_kubeconfig_lock = threading.Lock()
+
+def ensure_kube_credentials(cluster_name, region, project):
+# kubectl needs a kubeconfig entry; in API mode we only fetch it if we actually fall back.
+# get-credentials rewrites the shared kubeconfig, so concurrent clusters take turns.
+    key = (project, region, cluster_name)
+    with _kubeconfig_lock:
+        if key in _kube_credentials:
+            return
+        run_cmd([
+            "gcloud", "container", "clusters", "get-credentials", cluster_name,
+            f"--region={region}", f"--project={project}"
+        ], return_json=False)
+        _kube_credentials.add(key)
+
+def kube_context(cluster_name, region, project):
+# the context name get-credentials creates; passing it explicitly means kubectl never
+# depends on whichever cluster happened to be fetched last
+    return f"gke_{project}_{region}_{cluster_name}"
+
+# Projected, paginated Kubernetes lists
+# We read a handful of fields from lists that can hold tens of thousands of objects. Every list is
+# declared as the columns we need: a dotted path ("[*]" takes every element of a list) and how to
+# read the value back from kubectl's text output. The API is asked for KUBE_PAGE_SIZE objects at a
+# time (limit/continue) and each page is cut down to those columns before the next one is fetched;
+# kubectl is given the same columns as a jsonpath template, one line per object, and its output is
+# read line by line as it comes. Either way at most one page of full objects is ever in memory.
+KUBE_PAGE_SIZE = 500
+
+CONTROLLER_COLUMNS = [("metadata.namespace", str), ("metadata.name", str), ("spec.replicas", int),
+                      ("spec.selector", json.loads), ("spec.template.metadata.labels", json.loads),
+                      ("metadata.ownerReferences[*].kind", str.split)]
+HPA_COLUMNS = [("metadata.namespace", str), ("spec.scaleTargetRef.kind", str), ("spec.scaleTargetRef.name", str),
+               ("spec.minReplicas", int)]
+PDB_COLUMNS = [("metadata.namespace", str), ("metadata.name", str), ("spec.selector", json.loads),
+               ("status.disruptionsAllowed", int)]
+POD_COLUMNS = [("metadata.namespace", str), ("spec.nodeName", str),
+               ("spec.containers[*].resources.requests.cpu", str.split),
+               ("spec.containers[*].resources.requests.memory", str.split),
+               ("metadata.labels", json.loads), ("metadata.ownerReferences[*].kind", str.split),
+               ("metadata.name", str)]
+NODE_COLUMNS = [("metadata.name", str), ("metadata.labels", json.loads),
+                ("status.allocatable.cpu", str), ("status.allocatable.memory", str)]
+
+def column_value(obj, path):
+# the API-side twin of a kubectl jsonpath column; missing values are None like kubectl's empty cells
+    values = [obj]
+    for part in path.split("."):
+        every = part.endswith("[*]")
+        key = part[:-3] if every else part
+        found = []
+        for value in values:
+            value = value.get(key) if isinstance(value, dict) else None
+            if value is None:
+                continue
+            if every:
+                found.extend(value if isinstance(value, list) else [])
+            else:
+                found.append(value)
+        values = found
+    if "[*]" in path:
+        return values or None
+    return values[0] if values else None
+
+def jsonpath_template(columns):
+    cells = '{"\\t"}'.join("{." + path + "}" for path, _ in columns)
+    return "{range .items[*]}" + cells + '{"\\n"}{end}'
+
+def kube_list(cluster_name, region, project, path, cli_cmd, columns, params=None):
+# returns one row (list of column values) per object
+    if api_enabled():
+        try:
+            rows = []
+            params = dict(params or {}, limit=KUBE_PAGE_SIZE)
+            while True:
+                page = kube_get(cluster_name, region, project, path, params=params)
+                rows.extend([column_value(item, column) for column, _ in columns] for item in page.get("items", []))
+                token = page.get("metadata", {}).get("continue")
+                if not token:
+                    return rows
+                params["continue"] = token
+        except (httpx.HTTPError, subprocess.CalledProcessError, OSError, ValueError, KeyError) as e:
+            log(f"API call failed ({e}), falling back to kubectl")
+    ensure_kube_credentials(cluster_name, region, project)
+    cli_cmd = cli_cmd + [f"--context={kube_context(cluster_name, region, project)}",
+                         f"--chunk-size={KUBE_PAGE_SIZE}", f"-o=jsonpath={jsonpath_template(columns)}"]
+    rows = []
+    for line in run_cmd_lines(cli_cmd):
+        if line:
+            rows.append([convert(cell) if cell else None for cell, (_, convert) in zip(line.split("\t"), columns)])
+    return rows
+
+# Snapshot cache
+# Dry runs across the fleet re-read the same cluster state several times a day, so every read-only
+# snapshot (cluster describe, node pools, workloads, PDBs, pods, nodes) is kept on disk per
+# project/region/cluster/resource. Dry runs reuse fresh snapshots, --offline-plan uses only the
+# cache, and live runs always refetch (and refresh the cache) before changing anything.
+CACHE_DIR = os.environ.get("NODEPOOL_UPGRADER_CACHE_DIR",
+                           os.path.join(os.path.expanduser("~"), ".cache", "nodepool-upgrader"))
+CACHE_TTL = 15 * 60
+CACHE_MODE = "use"  # use | refresh | only | off
+CACHE_FORMAT = 5  # bump whenever the shape of a snapshot changes, older entries are then ignored
+
+def cache_path(project, region, cluster_name, resource):
+# region/cluster are "-" for project-wide snapshots, the same wildcard the GKE API uses
+    return os.path.join(CACHE_DIR, project, region, cluster_name, f"{resource}.json")
+
+def read_cache_entry(path):
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return entry if entry.get("format") == CACHE_FORMAT else None
+
+def write_cache_entry(path, data):
+# written to a temp file and renamed, so a crash never leaves half a snapshot behind
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"fetched_at": time.time(), "format": CACHE_FORMAT, "data": data}, f)
+    os.replace(tmp, path)
+
+def invalidate_cache(project, region="-", cluster_name="-"):
+    path = os.path.join(CACHE_DIR, project) if region == "-" else os.path.join(CACHE_DIR, project, region, cluster_name)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+        log(f"Cache invalidated for {project}/{region}/{cluster_name}")
+
+def cached_fetch(project, region, cluster_name, resource, fetch):
+    if CACHE_MODE == "off":
+        return fetch()
+    path = cache_path(project, region, cluster_name, resource)
+    if CACHE_MODE in ("use", "only"):
+        entry = read_cache_entry(path)
+        if entry is not None:
+            age = time.time() - entry["fetched_at"]
+            if CACHE_MODE == "only" or age < CACHE_TTL:
+                stale = " (older than the TTL)" if age >= CACHE_TTL else ""
+                log(f"Using cached {resource} snapshot from {format_duration(age)} ago{stale}")
+                return entry["data"]
+        if CACHE_MODE == "only":
+            raise CommandError(f"No cached {resource} snapshot for {project}/{region}/{cluster_name}; "
+                               "run a dry run online first to populate the cache.")
+    data = fetch()
+    write_cache_entry(path, data)
+    return data
 
 def connect_to_cluster(region, project, cluster_name, dry_run):
 # this function just separates the connection logic to the cluster
     log(f"Connecting to cluster {cluster_name} in {region}...")
     if dry_run:
         return
-    run_cmd([
-        "gcloud", "container", "clusters", "get-credentials", cluster_name,
-        f"--region={region}", f"--project={project}"
-    ], return_json=False)
+    if api_enabled():
+        try:
+            get_kube_target(cluster_name, region, project)
+            log("Connected to cluster API.")
+            return
+        except (httpx.HTTPError, subprocess.CalledProcessError, OSError, ValueError, KeyError) as e:
+            log(f"API connection failed ({e}), falling back to kubectl")
+    ensure_kube_credentials(cluster_name, region, project)
     log("Connected to cluster.")
 
 def get_node_pools(cluster_name, region, project, dry_run):
-    return run_cmd([
-        "gcloud", "container", "node-pools", "list",
-        f"--cluster={cluster_name}",
-        f"--region={region}",
-        f"--project={project}",
-        "--format=json"
-    ], dry_run=dry_run)
+    return cached_fetch(project, region, cluster_name, "node-pools", lambda: api_or_cli(
+        lambda: api_get(GKE_API_ENDPOINT, gke_cluster_path(cluster_name, region, project) + "/nodePools",
+                        params={"fields": api_fields(NODE_POOL_FIELDS, "nodePools")}).get("nodePools", []),
+        [
+            "gcloud", "container", "node-pools", "list",
+            f"--cluster={cluster_name}",
+            f"--region={region}",
+            f"--project={project}",
+            gcloud_format(NODE_POOL_FIELDS)
+        ], dry_run=dry_run))
+
+def surge_change(nodepool, max_surge=None):
+# the surge settings a pool should get before its upgrade, None if it already has them.
+# max_surge is what the surge tuner picked; without it any surge with nothing unavailable will do
+    settings = nodepool.get("upgradeSettings", {})
+    if max_surge is None:
+        if settings.get("maxSurge", 0) >= 1 and settings.get("maxUnavailable", 1) == 0:
+            return None
+        return {"maxSurge": 1, "maxUnavailable": 0}
+    if settings.get("maxSurge", 0) == max_surge and settings.get("maxUnavailable", 1) == 0:
+        return None
+    return {"maxSurge": max_surge, "maxUnavailable": 0}
 
-def check_surge_upgrade(nodepool, cluster_name, region, project, dry_run):
+def apply_surge_settings(name, cluster_name, region, project, change):
+# GKE runs one operation per cluster at a time, so the upgrade can only start once the update is done
+    settings = {"maxSurge": change["maxSurge"], "maxUnavailable": change["maxUnavailable"]}
+    operation = api_or_cli(
+        lambda: api_request("PUT", GKE_API_ENDPOINT, gke_cluster_path(cluster_name, region, project)
+                            + f"/nodePools/{name}", body={"upgradeSettings": settings}),
+        [
+            "gcloud", "container", "node-pools", "update", name,
+            f"--cluster={cluster_name}",
+            f"--region={region}",
+            f"--project={project}",
+            f"--max-surge-upgrade={change['maxSurge']}",
+            f"--max-unavailable-upgrade={change['maxUnavailable']}",
+            "--async",
+            "--format=json"
+        ])
+    op = track_operation((operation[0] if isinstance(operation, list) else operation)["name"], project, region)
+    while op["status"] != "DONE" and not _interrupted.is_set():
+        op["updated"].wait()
+        op["updated"].clear()
+    if op["status"] != "DONE":
+        log(f"Run interrupted, the update of '{name}' keeps running in GKE")
+        return
+    if op["error"]:
+        raise CommandError(f"updating the upgrade settings of '{name}' failed: {op['error']}")
+    log(f"Surge upgrade settings ({change['maxSurge']}/{change['maxUnavailable']}) applied to '{name}'")
+
+def check_surge_upgrade(nodepool, change, cluster_name, region, project, dry_run, decision="ask"):
 # surge upgrade = rolling upgrade
 # that's why we check for it before running the upgrade.
 # the alternative would be a blue-green upgrade which requires some manual validation.
+# change is the plan's surge_change for the pool, decision the approval policy's answer
+# (apply / skip), "ask" leaves it to the user
     name = nodepool["name"]
-    settings = nodepool.get("upgradeSettings", {})
-    surge = settings.get("maxSurge", 0)
-    unavailable = settings.get("maxUnavailable", 1)
-
-    if surge >= 1 and unavailable == 0:
+    if change is None:
         log(f"Node pool '{name}' already has surge upgrade settings.")
         return True
 
     log(f"Node pool '{name}' does not have recommended surge upgrade settings.")
 
+    if decision == "skip":
+        log(f"Policy: leaving the upgrade settings of '{name}' as they are")
+        return False
     if dry_run:
         log(f"DRY RUN: Would apply surge upgrade settings to node pool '{name}'")
         return False
 
-    choice = input(f"Apply --max-surge-upgrade=1 --max-unavailable-upgrade=0 to '{name}'? (y/n): ").strip().lower()
+    if decision == "apply":
+        log(f"Policy: applying surge upgrade settings to '{name}'")
+        choice = 'y'
+    else:
+        choice = ask(f"Apply --max-surge-upgrade={change['maxSurge']} "
+                     f"--max-unavailable-upgrade={change['maxUnavailable']} to '{name}'? (y/n): ")
     if choice == 'y':
-        run_cmd([
-            "gcloud", "container", "node-pools", "update", name,
-            f"--cluster={cluster_name}",
-            f"--region={region}",
-            f"--project={project}",
-            "--max-surge-upgrade=1",
-            "--max-unavailable-upgrade=0"
-        ], return_json=False)
-        log(f"Surge upgrade settings applied to '{name}'")
+        apply_surge_settings(name, cluster_name, region, project, change)
+        # the progress estimates of the upgrade go by the pool's settings
+        nodepool["upgradeSettings"] = {"maxSurge": change["maxSurge"], "maxUnavailable": change["maxUnavailable"]}
         return True
     return False
 
-def get_all_workloads(dry_run):
-# checks for us if we have workloads with replica counts 1 and below
-# which would **fault** in case of a rolling upgrade
-    log("Checking deployments for replica count...")
-    if dry_run:
-        return [{"namespace": "example-ns", "name": "demo-deployment", "replicas": 1}]
+# Workloads
+# Everything a node drain can take down, as one compact record per controller:
+#   [kind, namespace, name, replicas, hpa_min, selector, pod_labels]
+# Deployments, StatefulSets and ReplicaSets no Deployment owns come from one list per kind, bare
+# pods (no owner, nothing recreates them) on the nodes of the pools being upgraded from the pod and
+# node lists the simulation uses as well, and HPA minimums are joined in by scale target. PDB
+# coverage and the risk check both run off this index.
+WORKLOAD_KINDS = {
+    "Deployment": ("/apis/apps/v1/deployments", "deployments", CONTROLLER_COLUMNS),
+    "StatefulSet": ("/apis/apps/v1/statefulsets", "statefulsets", CONTROLLER_COLUMNS),
+    "ReplicaSet": ("/apis/apps/v1/replicasets", "replicasets", CONTROLLER_COLUMNS),
+    "HorizontalPodAutoscaler": ("/apis/autoscaling/v2/horizontalpodautoscalers", "horizontalpodautoscalers",
+                                HPA_COLUMNS),
+}
+
+_kind_cache = {}
+
+def list_kind(cluster_name, region, project, kind):
+# one list per kind and cluster, shared by everything that needs it
+    key = (project, region, cluster_name, kind)
+    if key not in _kind_cache:
+        path, resource, columns = WORKLOAD_KINDS[kind]
+        _kind_cache[key] = cached_fetch(project, region, cluster_name, resource, lambda: kube_list(
+            cluster_name, region, project, path, ["kubectl", "get", resource, "--all-namespaces"], columns))
+    return _kind_cache[key]
+
+_pdb_cache = {}
+
+def list_pdbs(cluster_name, region, project):
+    key = (project, region, cluster_name)
+    if key not in _pdb_cache:
+        _pdb_cache[key] = cached_fetch(project, region, cluster_name, "pdbs", lambda: kube_list(
+            cluster_name, region, project, "/apis/policy/v1/poddisruptionbudgets",
+            ["kubectl", "get", "pdb", "--all-namespaces"], PDB_COLUMNS))
+    return _pdb_cache[key]
+
+def get_all_workloads(cluster_name, region, project, pools):
+# builds the workload index described above; pools are the names of the node pools being upgraded,
+# a bare pod anywhere else is never drained
+    log("Checking workloads for replica count...")
+    hpa_min = {}
+    for ns, target_kind, target_name, min_replicas in list_kind(cluster_name, region, project,
+                                                                "HorizontalPodAutoscaler"):
+        hpa_min[(target_kind, ns, target_name)] = 1 if min_replicas is None else min_replicas
+
     workloads = []
-    output = subprocess.check_output(["kubectl", "get", "deployments", "--all-namespaces", "-o=json"])
-    data = json.loads(output)
-    for item in data["items"]:
-        replicas = item["spec"].get("replicas", 1)
-        if replicas <= 1:
-            workloads.append({
-                "namespace": item["metadata"]["namespace"],
-                "name": item["metadata"]["name"],
-                "replicas": replicas
-            })
+    for kind in ("Deployment", "StatefulSet", "ReplicaSet"):
+        for ns, name, replicas, selector, labels, owner_kinds in list_kind(cluster_name, region, project, kind):
+            # a Deployment's ReplicaSets are covered by the Deployment itself
+            if kind == "ReplicaSet" and owner_kinds:
+                continue
+            workloads.append([kind, ns, name, 1 if replicas is None else replicas,
+                              hpa_min.get((kind, ns, name)), selector, labels or {}])
+    drained = {node[0] for node in list_nodes(cluster_name, region, project) if node[1] in pools}
+    for pod in list_pods(cluster_name, region, project):
+        if not pod[7] and pod[1] in drained:
+            workloads.append(["Pod", pod[0], pod[6], 1, None, None, pod[4]])
     return workloads
 
-def get_pdb_coverage(dry_run):
-# checks for us if we have workloads with a Pod Disruption Budget set in a way
-# that would allow for a NO POD SERVING situation during upgrade
-    if dry_run:
-        return set()
-    output = subprocess.check_output(["kubectl", "get", "pdb", "--all-namespaces", "-o=json"])
-    data = json.loads(output)
+def get_risky_workloads(workloads, covered):
+# a workload can go dark when its guaranteed replica count (the HPA minimum if it has one, the HPA can
+# scale it down mid-upgrade) is 1 or less and no PDB holds the drain back. Bare pods are never
+# recreated once drained, a PDB only delays that.
+    risky = []
+    for i, (kind, ns, name, replicas, hpa_min, _, _) in enumerate(workloads):
+        floor = replicas if hpa_min is None else hpa_min
+        if kind == "Pod":
+            reason = "bare pod, not recreated after the drain"
+        elif floor <= 1 and i not in covered:
+            reason = "1 or fewer replicas, no PDB" if hpa_min is None else "HPA can scale to 1 or fewer, no PDB"
+        else:
+            continue
+        risky.append({"kind": kind, "namespace": ns, "name": name, "replicas": replicas,
+                      "hpa min": "-" if hpa_min is None else hpa_min, "reason": reason})
+    return risky
+
+def build_label_index(entries):
+# entries are (namespace, id, labels); ids are positions in the workload or pod list:
+#   by_label[(ns, key, value)] -> ids
+#   by_key[(ns, key)]          -> ids that have that label at all
+#   by_namespace[ns]           -> every id (needed for NotIn / DoesNotExist / empty selector)
+    index = {"by_label": {}, "by_key": {}, "by_namespace": {}}
+    for ns, item_id, labels in entries:
+        index["by_namespace"].setdefault(ns, set()).add(item_id)
+        for k, v in labels.items():
+            index["by_label"].setdefault((ns, k, v), set()).add(item_id)
+            index["by_key"].setdefault((ns, k), set()).add(item_id)
+    return index
+
+def match_selector(index, ns, selector):
+# resolves a LabelSelector (matchLabels + matchExpressions) against the index, no API calls.
+# every requirement narrows the candidate set, so we stop as soon as it is empty.
+    candidates = set(index["by_namespace"].get(ns, set()))
+    requirements = [{"key": k, "operator": "In", "values": [v]}
+                    for k, v in selector.get("matchLabels", {}).items()]
+    requirements += selector.get("matchExpressions", [])
+
+    for req in requirements:
+        if not candidates:
+            break
+        key = req["key"]
+        op = req["operator"]
+        if op == "In":
+            matched = set()
+            for v in req.get("values", []):
+                matched |= index["by_label"].get((ns, key, v), set())
+            candidates &= matched
+        elif op == "NotIn":
+            for v in req.get("values", []):
+                candidates -= index["by_label"].get((ns, key, v), set())
+        elif op == "Exists":
+            candidates &= index["by_key"].get((ns, key), set())
+        elif op == "DoesNotExist":
+            candidates -= index["by_key"].get((ns, key), set())
+        else:
+            raise ValueError(f"Unknown selector operator '{op}'")
+    return candidates
+
+def get_pdb_coverage(cluster_name, region, project, workloads):
+# checks for us which workloads have a Pod Disruption Budget, returns their positions in workloads
+    # PDBs select pods, so what matters is the pod (template) labels of a workload
+    index = build_label_index((ns, i, labels) for i, (_, ns, _, _, _, _, labels) in enumerate(workloads))
     covered = set()
-    for pdb in data["items"]:
-        ns = pdb["metadata"]["namespace"]
-        selector = pdb["spec"].get("selector", {}).get("matchLabels", {})
-        if selector:
-            match = ",".join([f"{k}={v}" for k, v in selector.items()])
-            try:
-                deployments = subprocess.check_output([
-                    "kubectl", "get", "deploy", "-n", ns, "-l", match, "-o=json"
-                ])
-                deploys = json.loads(deployments)
-                for dep in deploys.get("items", []):
-                    covered.add((ns, dep["metadata"]["name"]))
-            except:
-                continue
+    for ns, pdb_name, selector, _ in list_pdbs(cluster_name, region, project):
+        # a PDB without a selector matches nothing, an empty selector matches the whole namespace
+        if selector is None:
+            continue
+        try:
+            covered |= match_selector(index, ns, selector)
+        except (KeyError, ValueError) as e:
+            log(f"Skipping PDB {ns}/{pdb_name}: invalid selector ({e})")
     return covered
 
-def upgrade_nodepool(name, current_version, target_version, cluster_name, region, project, dry_run):
+# Asynchronous upgrades
+# A node pool upgrade takes 30-90 minutes on a big pool, so we start it with --async and follow the
+# GKE operation instead of blocking on gcloud. A single poller thread serves every in-flight operation
+# (one operations list per project per tick, no matter how many clusters are upgrading) and wakes up
+# the cluster waiting on each one, so fleet runs keep going on other clusters in the meantime.
+OPERATION_POLL_INTERVAL = 15
+# an operation that can't be listed or described for this long (garbage collected, permissions
+# revoked) is given up on: it is marked done with an error instead of keeping its cluster waiting
+OPERATION_LOST_SECONDS = 15 * 60
+NODE_UPGRADE_SECONDS = 6 * 60  # rough time to surge, drain and replace one batch of nodes
+
+_operations = {}
+_operations_lock = threading.Lock()
+_poller = {"thread": None}
+# Ctrl-C only reaches the main thread; fleet workers see it through this event, start no further
+# changes and stop waiting on their operations, which keep running in GKE for --resume to pick up
+_interrupted = threading.Event()
+
+def pool_node_count(nodepool):
+# regional pools get initialNodeCount nodes in every zone they span
+    per_zone = nodepool.get("initialNodeCount", 0)
+    if nodepool.get("autoscaling", {}).get("enabled"):
+        per_zone = max(per_zone, nodepool["autoscaling"].get("minNodeCount", 0))
+    return per_zone * max(1, len(nodepool.get("locations", [])))
+
+def pool_upgrade_parallelism(nodepool):
+# how many nodes GKE replaces at once: the surge nodes plus the ones it may take down
+    settings = nodepool.get("upgradeSettings", {})
+    return max(1, settings.get("maxSurge", 0) + settings.get("maxUnavailable", 1))
+
+def estimate_remaining_seconds(total, done, parallelism, elapsed):
+# before the first batch finishes we only have the pool shape to go on; after that the
+# observed time per batch is a much better predictor
+    remaining_batches = math.ceil(max(total - done, 0) / parallelism)
+    finished_batches = done // parallelism
+    per_batch = elapsed / finished_batches if finished_batches else NODE_UPGRADE_SECONDS
+    return remaining_batches * per_batch
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+def operation_metric(data, *names):
+    for metric in data.get("progress", {}).get("metrics", []):
+        if metric.get("name") in names:
+            return int(metric.get("intValue", 0))
+    return None
+
+def update_operation(op, data):
+    op["status"] = data.get("status", op["status"])
+    done = operation_metric(data, "NODES_DONE", "NODES_COMPLETE")
+    total = operation_metric(data, "NODES_TOTAL")
+    if done is not None:
+        op["nodes_done"] = done
+    if total:
+        op["nodes_total"] = total
+    if op["status"] == "DONE":
+        op["error"] = data.get("error", {}).get("message") or data.get("statusMessage") or None
+    op["polled"] = time.monotonic()
+    op["updated"].set()
+
+def list_operations(project):
+    data = api_or_cli(
+        lambda: api_get(GKE_API_ENDPOINT, f"/v1/projects/{project}/locations/-/operations"),
+        ["gcloud", "container", "operations", "list", f"--project={project}",
+         "--filter=status!=DONE", "--format=json"])
+    return data.get("operations", []) if isinstance(data, dict) else data
+
+def describe_operation(op):
+    return api_or_cli(
+        lambda: api_get(GKE_API_ENDPOINT,
+                        f"/v1/projects/{op['project']}/locations/{op['region']}/operations/{op['name']}"),
+        ["gcloud", "container", "operations", "describe", op["name"],
+         f"--region={op['region']}", f"--project={op['project']}", "--format=json"])
+
+def poll_operations():
+    while True:
+        with _operations_lock:
+            pending = [op for op in _operations.values() if op["status"] != "DONE"]
+            if not pending:
+                _poller["thread"] = None
+                return
+        by_project = {}
+        for op in pending:
+            by_project.setdefault(op["project"], []).append(op)
+        for project, ops in by_project.items():
+            try:
+                listed = {o["name"]: o for o in list_operations(project)}
+            except Exception as e:
+                log(f"Listing operations in {project} failed ({e}), describing them one by one")
+                listed = {}
+            for op in ops:
+                try:
+                    # finished operations drop out of the in-progress list, describe them for the result
+                    update_operation(op, listed.get(op["name"]) or describe_operation(op))
+                except Exception as e:
+                    log(f"Polling operation {op['name']} failed: {e}")
+                    if time.monotonic() - op["polled"] > OPERATION_LOST_SECONDS:
+                        op["error"] = (f"lost track of operation {op['name']}, no successful poll in "
+                                       f"{format_duration(OPERATION_LOST_SECONDS)} (last error: {e})")
+                        op["status"] = "DONE"
+                        op["updated"].set()
+        flush_journals()
+        time.sleep(OPERATION_POLL_INTERVAL)
+
+def track_operation(name, project, region):
+    op = {"name": name, "project": project, "region": region, "status": "RUNNING",
+          "nodes_done": 0, "nodes_total": None, "error": None, "updated": threading.Event(),
+          "polled": time.monotonic()}
+    with _operations_lock:
+        _operations[name] = op
+        if _poller["thread"] is None:
+            _poller["thread"] = threading.Thread(target=poll_operations, daemon=True)
+            _poller["thread"].start()
+    return op
+
+def interrupt_run():
+    _interrupted.set()
+    with _operations_lock:
+        for op in _operations.values():
+            op["updated"].set()
+
+def wait_for_operation(op, nodepool):
+# blocks the calling cluster until its operation is done, streaming progress and ETA as it goes;
+# None if the run was interrupted first
+    name = nodepool["name"]
+    parallelism = pool_upgrade_parallelism(nodepool)
+    started = time.time()
+    last_done = None
+    while True:
+        flush_journals()
+        if _interrupted.is_set():
+            log(f"Node pool '{name}': run interrupted, operation {op['name']} keeps running in GKE")
+            return None
+        op["updated"].wait()
+        op["updated"].clear()
+        if op["status"] == "DONE":
+            break
+        total = op["nodes_total"] or pool_node_count(nodepool)
+        if op["nodes_done"] == last_done:
+            continue
+        last_done = op["nodes_done"]
+        elapsed = time.time() - started
+        eta = estimate_remaining_seconds(total, op["nodes_done"], parallelism, elapsed)
+        log(f"Node pool '{name}': {op['nodes_done']}/{total} nodes upgraded, "
+            f"elapsed {format_duration(elapsed)}, ETA {format_duration(eta)}")
+    log(f"Node pool '{name}': operation {op['name']} finished in {format_duration(time.time() - started)}")
+    return op
+
+def find_pool_upgrade(project, cluster_name, pool_name):
+# the name of the pool's running upgrade operation, if there is one
+    for op in list_operations(project):
+        if (op.get("operationType") == "UPGRADE_NODES" and op.get("status") != "DONE"
+                and op.get("targetLink", "").endswith(f"/clusters/{cluster_name}/nodePools/{pool_name}")):
+            return op["name"]
+    return None
+
+def start_nodepool_upgrade(nodepool, target_version, cluster_name, region, project):
+# returns the GKE operation name of the upgrade it started
+    name = nodepool["name"]
+    path = gke_cluster_path(cluster_name, region, project) + f"/nodePools/{name}"
+    body = {"nodeVersion": target_version,
+            "imageType": nodepool.get("config", {}).get("imageType", "")}
+    if api_enabled():
+        # gcloud only takes over when the PUT never reached GKE (no connection, no token). A rejection
+        # (400/403/409) is passed on to the caller, and after a timeout GKE may well have started the
+        # upgrade, so we look for its operation instead of starting a second one
+        try:
+            return api_request("PUT", GKE_API_ENDPOINT, path, body=body)["name"]
+        except httpx.HTTPStatusError:
+            raise
+        except httpx.TimeoutException as e:
+            operation_name = find_pool_upgrade(project, cluster_name, name)
+            if operation_name:
+                log(f"Upgrade request for '{name}' timed out, but GKE started it as {operation_name}")
+                return operation_name
+            raise RuntimeError(f"upgrade request timed out ({e}) and no upgrade operation is running for "
+                               f"'{name}'; check the pool before trying again") from e
+        except (httpx.ConnectError, subprocess.CalledProcessError, OSError) as e:
+            log(f"API call failed ({e}), falling back to CLI")
+    cmd = [
+        "gcloud", "container", "clusters", "upgrade", cluster_name,
+        f"--node-pool={name}",
+        f"--cluster-version={target_version}",
+        f"--region={region}",
+        f"--project={project}",
+        "--async",
+        "--quiet",
+        "--format=json"
+    ]
+    log(f"Running: {' '.join(cmd)}")
+    started = time.time()
+    try:
+        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode()
+    except subprocess.CalledProcessError as e:
+        record_command("cli", " ".join(cmd[:4]), started, e.returncode, len(e.output or b""))
+        raise
+    record_command("cli", " ".join(cmd[:4]), started, 0, len(output))
+    operation = decode_json_from_text(output)
+    return (operation[0] if isinstance(operation, list) else operation)["name"]
+
+def upgrade_nodepool(nodepool, target_version, cluster_name, region, project, dry_run):
 # checks if the nodepool is already upgraded, if not, offers to upgrade it.
 # on Dry Run mode it will only show WHAT would be upgraded.
+    name = nodepool["name"]
+    current_version = nodepool.get("version", "")
     if current_version == target_version:
         return {"nodepool": name, "status": "Already up-to-date"}
 
-    log(f"Upgrading node pool '{name}' from {current_version} to {target_version}")
+    node_count = pool_node_count(nodepool)
+    parallelism = pool_upgrade_parallelism(nodepool)
+    log(f"Upgrading node pool '{name}' from {current_version} to {target_version} "
+        f"({node_count} nodes, {parallelism} at a time, estimated "
+        f"{format_duration(estimate_remaining_seconds(node_count, 0, parallelism, 0))})")
     if dry_run:
         return {"nodepool": name, "status": f"DRY RUN: Would upgrade to {target_version}"}
 
+    done = checkpointed_step(project, region, cluster_name, name, "done")
+    if done and done["target"] == target_version:
+        return {"nodepool": name, "status": f"{done['status']} (earlier run)"}
+    if _interrupted.is_set():
+        return {"nodepool": name, "status": "Aborted: run interrupted"}
+
+    in_flight = checkpointed_step(project, region, cluster_name, name, "started")
+    if in_flight and in_flight["target"] != target_version:
+        in_flight = None
+    old_nodes = None
+    if PREPULL_IMAGES or DRAIN_WATCH:
+        old_nodes = pre_upgrade_nodes(nodepool, cluster_name, region, project, in_flight)
+    warmup = drain = None
+    if old_nodes is not None:
+        warmup = start_image_warmup(nodepool, old_nodes, cluster_name, region, project) if PREPULL_IMAGES else None
+        drain = start_drain_watch(nodepool, old_nodes, cluster_name, region, project) if DRAIN_WATCH else None
     try:
-        subprocess.check_output([
-            "gcloud", "container", "clusters", "upgrade", cluster_name,
-            f"--node-pool={name}",
-            f"--cluster-version={target_version}",
-            f"--region={region}",
-            f"--project={project}",
-            "--quiet"
-        ])
+        if in_flight:
+            operation_name = in_flight["operation"]
+            log(f"Node pool '{name}': re-attaching to operation {operation_name} of the run being resumed")
+        else:
+            try:
+                operation_name = start_nodepool_upgrade(nodepool, target_version, cluster_name, region, project)
+            except subprocess.CalledProcessError as e:
+                checkpoint(project, region, cluster_name, name, "failed", target=target_version)
+                return {"nodepool": name, "status": f"Upgrade failed: {e.output.decode()}"}
+            except (OSError, ValueError, KeyError, IndexError, RuntimeError) as e:
+                checkpoint(project, region, cluster_name, name, "failed", target=target_version)
+                return {"nodepool": name, "status": f"Upgrade failed: {e}"}
+            except Exception as e:
+                # errors the API answered with (or gave up on), never retried through gcloud
+                if httpx is None or not isinstance(e, httpx.HTTPError):
+                    raise
+                checkpoint(project, region, cluster_name, name, "failed", target=target_version)
+                return {"nodepool": name, "status": f"Upgrade failed: {e}"}
+            checkpoint(project, region, cluster_name, name, "started", target=target_version, operation=operation_name,
+                       old_nodes=sorted(old_nodes) if old_nodes is not None else None)
+            log(f"Node pool '{name}': started operation {operation_name}")
 
+        started = time.time()
+        op = wait_for_operation(track_operation(operation_name, project, region), nodepool)
+        if op is None:
+            return {"nodepool": name, "status": f"Aborted: run interrupted, operation {operation_name} still running"}
+        observe("nodepool upgrade", time.time() - started, ok=not op["error"])
+        if op["error"]:
+            checkpoint(project, region, cluster_name, name, "failed", target=target_version, operation=operation_name)
+            return {"nodepool": name, "status": f"Upgrade failed: {op['error']}"}
+        checkpoint(project, region, cluster_name, name, "done", target=target_version, status="Upgrade successful")
         return {"nodepool": name, "status": "Upgrade successful"}
-    except subprocess.CalledProcessError as e:
-        return {"nodepool": name, "status": f"Upgrade failed: {e.output.decode()}"}
+    finally:
+        if drain:
+            stop_drain_watch(drain)
+        if warmup:
+            finish_image_warmup(warmup, cluster_name, region, project)
+
+def get_cluster(cluster_name, region, project, dry_run):
+    return cached_fetch(project, region, cluster_name, "cluster", lambda: api_or_cli(
+        lambda: gke_get_cluster(cluster_name, region, project),
+        [
+            "gcloud", "container", "clusters", "describe", cluster_name,
+            f"--region={region}",
+            f"--project={project}",
+            gcloud_format(CLUSTER_FIELDS)
+        ], dry_run=dry_run))
 
 def get_control_plane_version(cluster_name, region, project, dry_run):
-    output = run_cmd([
-        "gcloud", "container", "clusters", "describe", cluster_name,
-        f"--region={region}",
-        f"--project={project}",
-        "--format=json"
-    ], dry_run=dry_run)
-    return output.get("currentMasterVersion", "1.X.X")
+    return get_cluster(cluster_name, region, project, dry_run)["currentMasterVersion"]
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--region", required=True)
-    parser.add_argument("--project", required=True)
-    parser.add_argument("--cluster", required=True)
-    parser.add_argument("--dry-run", action="store_true", help="Simulate without making changes")
-    args = parser.parse_args()
+# Disruption simulator
+# Before touching a pool we replay GKE's surge upgrade against the current cluster state: every batch
+# adds maxSurge new nodes, cordons and drains maxSurge+maxUnavailable old ones and evicts their pods.
+# For each batch we check whether the evictions fit the PDBs' disruptionsAllowed (if not, GKE sits on
+# the drain for up to an hour) and whether the rest of the cluster has room for the evicted pods.
+# Pods live in flat arrays grouped by node, so a batch is a slice and the whole replay is a few
+# passes over numbers, fast enough for clusters with 50k pods.
+DRAIN_TIMEOUT_SECONDS = 60 * 60  # GKE respects PDBs for up to an hour before forcing the drain
+NODEPOOL_LABEL = "cloud.google.com/gke-nodepool"
+SIMULATE = True
 
-    dry_run = args.dry_run
-    log(f"Started {'DRY RUN' if dry_run else 'LIVE'} mode at {datetime.now()}\n")
+_quantity_suffixes = [("Ki", 2**10), ("Mi", 2**20), ("Gi", 2**30), ("Ti", 2**40),
+                      ("m", 1e-3), ("k", 1e3), ("M", 1e6), ("G", 1e9), ("T", 1e12)]
 
-    connect_to_cluster(args.region, args.project, args.cluster, dry_run)
+def parse_quantity(value):
+# Kubernetes resource quantities: "250m" CPU, "512Mi" memory, "1.5", "2Gi", ...
+    if value is None:
+        return 0.0
+    value = str(value)
+    for suffix, factor in _quantity_suffixes:
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * factor
+    return float(value)
 
-    control_plane_version_raw = get_control_plane_version(args.cluster, args.region, args.project, dry_run)
-    control_plane_version = strip_gke_suffix(control_plane_version_raw)
-    log(f"Control plane version: {control_plane_version_raw}")
+def compact_pod(row):
+# only what the simulator needs, so the cached snapshot of a 50k pod cluster stays small
+# (the name and whether it has an owner at all are for spotting bare pods)
+    ns, node_name, cpu, mem, labels, owner_kinds, name = row
+    return [ns, node_name, sum(parse_quantity(v) for v in cpu or []), sum(parse_quantity(v) for v in mem or []),
+            labels or {}, "DaemonSet" in (owner_kinds or []), name, bool(owner_kinds)]
+
+def compact_node(row):
+    name, labels, cpu, mem = row
+    return [name, (labels or {}).get(NODEPOOL_LABEL), parse_quantity(cpu), parse_quantity(mem)]
+
+_pod_cache = {}
+_node_cache = {}
+
+def list_pods(cluster_name, region, project):
+    key = (project, region, cluster_name)
+    if key not in _pod_cache:
+        _pod_cache[key] = cached_fetch(project, region, cluster_name, "pods", lambda: [
+            compact_pod(row) for row in kube_list(
+                cluster_name, region, project, "/api/v1/pods",
+                ["kubectl", "get", "pods", "--all-namespaces", "--field-selector=status.phase=Running"],
+                POD_COLUMNS, params={"fieldSelector": "status.phase=Running"})])
+    return _pod_cache[key]
+
+def list_nodes(cluster_name, region, project):
+    key = (project, region, cluster_name)
+    if key not in _node_cache:
+        _node_cache[key] = cached_fetch(project, region, cluster_name, "nodes", lambda: [
+            compact_node(row) for row in kube_list(
+                cluster_name, region, project, "/api/v1/nodes", ["kubectl", "get", "nodes"], NODE_COLUMNS)])
+    return _node_cache[key]
+
+def build_cluster_model(pods, nodes, pdbs):
+    node_index = {node[0]: i for i, node in enumerate(nodes)}
+    model = {
+        "node_names": [node[0] for node in nodes],
+        "node_pools": [node[1] for node in nodes],
+        "node_cpu": array('d', (node[2] for node in nodes)),
+        "node_mem": array('d', (node[3] for node in nodes)),
+        "pdb_names": [f"{ns}/{name}" for ns, name, _, _ in pdbs],
+        "pdb_allowed": array('l', (allowed or 0 for _, _, _, allowed in pdbs)),
+    }
+
+    # DaemonSet pods go away with their node and never need a new home, so they are left out.
+    # The rest are sorted by node: the pods of node n are pod_*[node_start[n]:node_start[n + 1]]
+    movable = sorted((pod for pod in pods if not pod[5] and pod[1] in node_index),
+                     key=lambda pod: node_index[pod[1]])
+    model["pod_cpu"] = array('d', (pod[2] for pod in movable))
+    model["pod_mem"] = array('d', (pod[3] for pod in movable))
+    node_start = array('l', [0]) * (len(nodes) + 1)
+    for pod in movable:
+        node_start[node_index[pod[1]] + 1] += 1
+    for n in range(len(nodes)):
+        node_start[n + 1] += node_start[n]
+    model["node_start"] = node_start
+    model["used_cpu"] = sum(model["pod_cpu"])
+    model["used_mem"] = sum(model["pod_mem"])
+
+    # each pod points at (the first) PDB covering it, -1 if none
+    pod_pdb = array('l', [-1]) * len(movable)
+    index = build_label_index((pod[0], i, pod[4]) for i, pod in enumerate(movable))
+    for j, (ns, _, selector, _) in enumerate(pdbs):
+        if selector is None:
+            continue
+        try:
+            matched = match_selector(index, ns, selector)
+        except (KeyError, ValueError):
+            continue
+        for i in matched:
+            if pod_pdb[i] == -1:
+                pod_pdb[i] = j
+    model["pod_pdb"] = pod_pdb
+    return model
+
+def simulate_pool_upgrade(model, pool_name, surge, unavailable):
+    nodes = [n for n, pool in enumerate(model["node_pools"]) if pool == pool_name]
+    if not nodes:
+        return None
+    node_cpu, node_mem, node_start, pod_pdb = model["node_cpu"], model["node_mem"], model["node_start"], model["pod_pdb"]
+    parallelism = max(1, surge + unavailable)
+    # new nodes come from the same template, so they look like the average node of the pool
+    template_cpu = sum(node_cpu[n] for n in nodes) / len(nodes)
+    template_mem = sum(node_mem[n] for n in nodes) / len(nodes)
+    total_cpu = sum(node_cpu)
+    total_mem = sum(node_mem)
+
+    blocked = []
+    shortfalls = []
+    seconds = 0
+    batches = 0
+    for b in range(0, len(nodes), parallelism):
+        batch = nodes[b:b + parallelism]
+        batches += 1
+        surge_nodes = min(surge, len(batch))
+        batch_cpu = sum(node_cpu[n] for n in batch)
+        batch_mem = sum(node_mem[n] for n in batch)
+
+        # while the batch drains its nodes are gone and only the surge nodes have been added
+        short_cpu = model["used_cpu"] - (total_cpu - batch_cpu + surge_nodes * template_cpu)
+        short_mem = model["used_mem"] - (total_mem - batch_mem + surge_nodes * template_mem)
+        if short_cpu > 0 or short_mem > 0:
+            shortfalls.append({"batch": batches, "cpu": max(short_cpu, 0), "memory": max(short_mem, 0)})
 
-    nodepools = get_node_pools(args.cluster, args.region, args.project, dry_run)
+        evictions = {}
+        for n in batch:
+            for i in range(node_start[n], node_start[n + 1]):
+                if pod_pdb[i] >= 0:
+                    evictions[pod_pdb[i]] = evictions.get(pod_pdb[i], 0) + 1
+        over_budget = [j for j, count in evictions.items() if count > model["pdb_allowed"][j]]
+        seconds += NODE_UPGRADE_SECONDS
+        if over_budget:
+            seconds += DRAIN_TIMEOUT_SECONDS
+            blocked.append({"batch": batches, "nodes": [model["node_names"][n] for n in batch],
+                            "pdbs": [model["pdb_names"][j] for j in over_budget]})
 
-    upgrades_needed = False
+        # once the batch is done every old node has been replaced by a new one
+        total_cpu += len(batch) * template_cpu - batch_cpu
+        total_mem += len(batch) * template_mem - batch_mem
+
+    return {"nodes": len(nodes), "batches": batches, "blocked": blocked,
+            "shortfalls": shortfalls, "seconds": seconds}
+
+def simulate_nodepool_upgrades(cluster_name, region, project, nodepools, cluster=None, dry_run=False):
+# advisory: if the cluster state can't be read we say so and carry on. With the cluster resource
+# given, the surge tuner also picks a maxSurge for every pool (see tune_surge)
+    if not SIMULATE or not nodepools:
+        return {}
+    log("Simulating surge upgrades against current pods, nodes and PDBs...")
+    try:
+        started = time.time()
+        model = build_cluster_model(list_pods(cluster_name, region, project),
+                                    list_nodes(cluster_name, region, project),
+                                    list_pdbs(cluster_name, region, project))
+    except Exception as e:
+        log(f"Could not load cluster state for the simulation ({e}), skipping it.")
+        return {}
+
+    quotas = None
+    if cluster is not None:
+        try:
+            quotas = get_region_quotas(project, region, dry_run)
+        except Exception as e:
+            log(f"Could not read the quotas of {location_region(region)} ({e}), surge settings are not tuned.")
+
+    simulations = {}
+    rows = []
     for np in nodepools:
-        current_version = strip_gke_suffix(np.get("version", ""))
-        if version.parse(current_version) < version.parse(control_plane_version):
-            upgrades_needed = True
-            break
+        settings = np.get("upgradeSettings", {})
+        sim = simulate_pool_upgrade(model, np["name"], settings.get("maxSurge", 0), settings.get("maxUnavailable", 1))
+        if sim is None:
+            continue
+        simulations[np["name"]] = sim
+        worst = max(sim["shortfalls"], key=lambda s: s["cpu"], default=None)
+        row = {
+            "nodepool": np["name"],
+            "nodes": sim["nodes"],
+            "batches": sim["batches"],
+            "blocked drains": len(sim["blocked"]),
+            "capacity shortfall": f"{worst['cpu']:.1f} CPU / {worst['memory'] / 2**30:.1f} GiB" if worst else "-",
+            "estimated duration": format_duration(sim["seconds"])
+        }
+        for block in sim["blocked"][:5]:
+            log(f"  {np['name']} batch {block['batch']}: drain of {', '.join(block['nodes'])} "
+                f"blocked by PDB {', '.join(block['pdbs'][:3])}")
+        if cluster is not None:
+            sim["tuned"] = tune_surge(model, np, cluster, quotas,
+                                      policy_settings(project, cluster_name, np["name"])["max_surge"])
+            choice = sim["tuned"]["choice"]
+            row["tuned surge"] = choice["maxSurge"] if choice else "-"
+            row["tuned duration"] = format_duration(choice["seconds"]) if choice else "-"
+            log(f"  {np['name']} surge options: " + ", ".join(
+                f"{option['maxSurge']} -> {format_duration(option['seconds'])}"
+                + (f" (over {', '.join(option['over'])})" if option["over"] else "")
+                for option in sim["tuned"]["options"]))
+        rows.append(row)
+    log(tabulate(rows, headers="keys"))
+    log(f"Simulated {len(rows)} node pools over {len(model['pod_cpu'])} pods in {time.time() - started:.2f}s")
+    return simulations
+
+# Surge tuner
+# maxSurge=1 replaces a pool one node at a time, so a 200-node pool takes 200 rounds. The tuner runs
+# larger surges through the simulator and keeps those that are safe: the surge nodes have to fit the
+# region's CPU quota headroom (and its IP address headroom, unless the nodes are private), and the
+# drains may not run into a PDB that a surge of 1 wouldn't run into already. The policy can cap the
+# surge (max_surge); of what is left the fastest estimate wins, ties going to the smaller surge.
+# maxUnavailable stays 0, capacity only ever grows during the upgrade.
+COMPUTE_API_ENDPOINT = os.environ.get("COMPUTE_API_ENDPOINT", "https://compute.googleapis.com")
+SURGE_CANDIDATES = (1, 2, 3, 5, 10, 20, 50, 100)
+QUOTA_SHARE = 1  # fleet runs upgrade up to --max-per-region clusters of a region at once, they share its quota
+_quota_cache = {}
+
+def get_region_quotas(project, region, dry_run):
+# headroom (limit - usage) per quota metric of the region the cluster's nodes live in
+    region_name = location_region(region)
+    key = (project, region_name)
+    if key not in _quota_cache:
+        data = cached_fetch(project, region, "-", "quotas", lambda: api_or_cli(
+            lambda: api_get(COMPUTE_API_ENDPOINT, f"/compute/v1/projects/{project}/regions/{region_name}",
+                            params={"fields": "quotas"}),
+            ["gcloud", "compute", "regions", "describe", region_name, f"--project={project}",
+             "--format=json(quotas)"], dry_run=dry_run))
+        _quota_cache[key] = {quota["metric"]: quota["limit"] - quota["usage"] for quota in data.get("quotas", [])}
+    return _quota_cache[key]
+
+def machine_vcpus(machine_type):
+# what a node counts against the CPU quota: e2-standard-8 -> 8, n2-custom-4-16384 -> 4,
+# the shared-core types (e2-medium, g1-small, ...) 2 or 1
+    parts = machine_type.split("-")
+    try:
+        if "custom" in parts:
+            return int(parts[parts.index("custom") + 1])
+        if parts[-1].isdigit():
+            return int(parts[-1])
+    except (IndexError, ValueError):
+        pass
+    return 1 if parts[0] in ("f1", "g1") else 2
+
+def tune_surge(model, nodepool, cluster, quotas, max_surge=None):
+# returns every candidate surge with its estimate and the limits it breaks, plus the chosen one;
+# without quotas no surge above 1 is known to be safe, and no choice is made: the pool keeps its own
+# settings rather than having an operator's larger surge lowered for want of data
+    name = nodepool["name"]
+    nodes = sum(1 for pool in model["node_pools"] if pool == name)
+    machine_type = nodepool.get("config", {}).get("machineType", "")
+    vcpus = machine_vcpus(machine_type)
+    limits = {}
+    if quotas is None:
+        limits["unknown quota"] = 1
+    else:
+        family_cpus = f"{machine_type.split('-')[0].upper()}_CPUS"
+        cpus = min(quotas.get("CPUS", math.inf), quotas.get(family_cpus, math.inf))
+        limits["CPU quota"] = cpus / (vcpus * QUOTA_SHARE)
+        if not cluster.get("privateClusterConfig", {}).get("enablePrivateNodes"):
+            limits["IP quota"] = quotas.get("IN_USE_ADDRESSES", math.inf) / QUOTA_SHARE
+    if max_surge is not None:
+        limits["policy"] = max_surge
+
+    # a surge beyond the pool size changes nothing, the whole pool then goes in one batch
+    candidates = sorted({surge for surge in SURGE_CANDIDATES if surge < nodes} | {max(1, min(nodes, 100))})
+    options = []
+    baseline_pdbs = None
+    for surge in candidates:
+        sim = simulate_pool_upgrade(model, name, surge, 0)
+        pdbs = {pdb for block in sim["blocked"] for pdb in block["pdbs"]}
+        if baseline_pdbs is None:
+            baseline_pdbs = pdbs
+        over = [limit for limit, value in limits.items() if surge > value]
+        if pdbs - baseline_pdbs:
+            over.append(f"PDB {sorted(pdbs - baseline_pdbs)[0]}")
+        options.append({"maxSurge": surge, "seconds": sim["seconds"], "blocked": len(sim["blocked"]), "over": over})
+    # a surge of 1 is the fallback even when it breaks a limit itself, it is what the upgrade did before
+    if quotas is None:
+        return {"options": options, "choice": None}
+    allowed = [option for option in options if not option["over"]] or options[:1]
+    return {"options": options, "choice": min(allowed, key=lambda option: (option["seconds"], option["maxSurge"]))}
+
+# Image warmup
+# Pods drained off an old node land on a new one that has none of their images yet, and a multi-GB
+# cold pull easily takes longer than the eviction itself. With --prepull-images, a temporary DaemonSet
+# is created before a pool's upgrade that only fits the pool's new nodes (the current ones are
+# excluded by name). It has one container per distinct image (by digest) running in the pool, so each
+# new node starts pulling all of them in parallel the moment it joins, ahead of the pods; an image the
+# node can't pull only holds up its own container. The containers only sleep, in a static busybox copied
+# in from a shared volume by the one init container, which works for distroless images too. Images
+# that need a pod's imagePullSecrets are left out, the kube-system DaemonSet has no access to them.
+# Afterwards the pods' time-to-ready on the new nodes is compared with what the same pool's pods took
+# before, and the DaemonSet is removed again.
+PREPULL_IMAGES = False
+PREPULL_NAMESPACE = "kube-system"
+PREPULL_HELPER_IMAGE = "registry.k8s.io/e2e-test-images/busybox:1.36.1-1"
+WARMUP_POD_COLUMNS = [("metadata.namespace", str), ("metadata.name", str), ("spec.nodeName", str),
+                      ("status.startTime", str), ("status.conditions[*].type", str.split),
+                      ("status.conditions[*].lastTransitionTime", str.split),
+                      ("spec.containers[*].image", str.split), ("status.containerStatuses[*].imageID", str.split),
+                      ("metadata.ownerReferences[*].kind", str.split),
+                      ("spec.imagePullSecrets[*].name", str.split)]
+
+def http_status(e):
+# the status code of an error answer from an API server, None for anything else
+    return e.response.status_code if httpx is not None and isinstance(e, httpx.HTTPStatusError) else None
+
+def kube_write(cluster_name, region, project, method, path, body, cli_cmd):
+# changes go through the API, kubectl is only used if the API can't be reached at all; an answer
+# from the API server (404, 409, ...) is passed on to the caller
+    if api_enabled():
+        try:
+            base_url, verify = get_kube_target(cluster_name, region, project)
+            return api_request(method, base_url, path, body=body, verify=verify)
+        except httpx.HTTPStatusError:
+            raise
+        except (httpx.HTTPError, subprocess.CalledProcessError, OSError, ValueError, KeyError) as e:
+            log(f"API call failed ({e}), falling back to kubectl")
+    ensure_kube_credentials(cluster_name, region, project)
+    return run_cmd(cli_cmd + [f"--context={kube_context(cluster_name, region, project)}"], return_json=False)
+
+def pool_node_names(cluster_name, region, project, pool_name):
+# read fresh every time, the point is to tell the nodes from before the upgrade from the new ones
+    return {row[0] for row in kube_list(
+        cluster_name, region, project, "/api/v1/nodes", ["kubectl", "get", "nodes", f"-l={NODEPOOL_LABEL}={pool_name}"],
+        [("metadata.name", str)], params={"labelSelector": f"{NODEPOOL_LABEL}={pool_name}"})}
+
+def pre_upgrade_nodes(nodepool, cluster_name, region, project, in_flight):
+# the pool's nodes from before its upgrade; a resumed upgrade has already replaced some of them, so it
+# takes the ones the "started" checkpoint recorded (None if there are none to go by)
+    pool_name = nodepool["name"]
+    if in_flight:
+        if in_flight.get("old_nodes") is None:
+            log(f"The checkpoint has no pre-upgrade nodes of '{pool_name}', "
+                "resuming without the image warmup and drain watch.")
+            return None
+        return set(in_flight["old_nodes"])
+    try:
+        return pool_node_names(cluster_name, region, project, pool_name)
+    except Exception as e:
+        log(f"Could not list the nodes of '{pool_name}' ({e}), upgrading without the image warmup and drain watch.")
+        return None
+
+def list_running_pods(cluster_name, region, project):
+    return kube_list(cluster_name, region, project, "/api/v1/pods",
+                     ["kubectl", "get", "pods", "--all-namespaces", "--field-selector=status.phase=Running"],
+                     WARMUP_POD_COLUMNS, params={"fieldSelector": "status.phase=Running"})
+
+def parse_kube_time(value):
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").timestamp()
+
+def ready_seconds(row):
+# from the kubelet taking the pod to its Ready condition, cold image pulls included
+    _, _, _, start, types, times = row[:6]
+    if not start or not types or "Ready" not in types or len(times or []) != len(types):
+        return None
+    seconds = parse_kube_time(times[types.index("Ready")]) - parse_kube_time(start)
+    return seconds if seconds >= 0 else None
+
+def distinct_images(rows):
+# one pullable reference per digest; containers whose digest isn't known yet go by their image name
+    images = {}
+    for row in rows:
+        specs, ids = row[6] or [], row[7] or []
+        for i, image in enumerate(specs):
+            image_id = ids[i].split("://")[-1] if i < len(ids) and ids[i] else ""
+            if "@sha256:" in image_id:
+                images.setdefault(image_id.split("@")[1], image_id)
+            else:
+                images.setdefault(image, image)
+    return sorted(images.values())
+
+def warmup_daemonset(name, pool_name, old_nodes, images):
+    mount = [{"name": "warmup", "mountPath": "/warmup"}]
+    tiny = {"requests": {"cpu": "1m", "memory": "8Mi"}}
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "DaemonSet",
+        "metadata": {"name": name, "namespace": PREPULL_NAMESPACE, "labels": {"app": name}},
+        "spec": {
+            "selector": {"matchLabels": {"app": name}},
+            "template": {
+                "metadata": {"labels": {"app": name}},
+                "spec": {
+                    "affinity": {"nodeAffinity": {"requiredDuringSchedulingIgnoredDuringExecution": {
+                        "nodeSelectorTerms": [{
+                            "matchExpressions": [{"key": NODEPOOL_LABEL, "operator": "In", "values": [pool_name]}],
+                            "matchFields": [{"key": "metadata.name", "operator": "NotIn", "values": old_nodes}]
+                        }]}}},
+                    "tolerations": [{"operator": "Exists"}],
+                    "terminationGracePeriodSeconds": 0,
+                    "volumes": [{"name": "warmup", "emptyDir": {}}],
+                    "initContainers": [{"name": "busybox", "image": PREPULL_HELPER_IMAGE, "resources": tiny,
+                                        "command": ["cp", "/bin/busybox", "/warmup/busybox"], "volumeMounts": mount}],
+                    # regular containers start (and pull) side by side, init containers one after another
+                    "containers": [{"name": f"image-{i}", "image": image, "resources": tiny,
+                                    "command": ["/warmup/busybox", "sleep", "2147483647"], "volumeMounts": mount}
+                                   for i, image in enumerate(images)]
+                }
+            }
+        }
+    }
+
+def create_warmup_daemonset(cluster_name, region, project, manifest):
+    path = f"/apis/apps/v1/namespaces/{PREPULL_NAMESPACE}/daemonsets"
+    fd, manifest_file = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f)
+    try:
+        create = lambda: kube_write(cluster_name, region, project, "POST", path, manifest,
+                                    ["kubectl", "apply", "-f", manifest_file])
+        try:
+            create()
+        except Exception as e:
+            # left behind by an interrupted run
+            if http_status(e) != 409:
+                raise
+            delete_warmup_daemonset(cluster_name, region, project, manifest["metadata"]["name"])
+            create()
+    finally:
+        os.unlink(manifest_file)
+
+def delete_warmup_daemonset(cluster_name, region, project, name):
+    try:
+        kube_write(cluster_name, region, project, "DELETE",
+                   f"/apis/apps/v1/namespaces/{PREPULL_NAMESPACE}/daemonsets/{name}", None,
+                   ["kubectl", "delete", "daemonset", name, f"--namespace={PREPULL_NAMESPACE}", "--ignore-not-found"])
+    except Exception as e:
+        if http_status(e) != 404:
+            raise
+
+def start_image_warmup(nodepool, old_nodes, cluster_name, region, project):
+# advisory like the simulation: if it can't be set up we say so and upgrade without it
+    pool_name = nodepool["name"]
+    name = f"prepull-{pool_name}"[:63]
+    try:
+        pods = [row for row in list_running_pods(cluster_name, region, project)
+                if row[2] in old_nodes and "DaemonSet" not in (row[8] or [])]
+        images = distinct_images([row for row in pods if not row[9]])
+        private = set(distinct_images([row for row in pods if row[9]])) - set(images)
+        if private:
+            log(f"Not pre-pulling {len(private)} images of '{pool_name}' that need imagePullSecrets: "
+                f"{', '.join(sorted(private)[:5])}{' ...' if len(private) > 5 else ''}")
+        if not images:
+            log(f"No images to pre-pull for node pool '{pool_name}'.")
+            return None
+        create_warmup_daemonset(cluster_name, region, project,
+                                warmup_daemonset(name, pool_name, sorted(old_nodes), images))
+    except Exception as e:
+        log(f"Could not set up the image warmup for '{pool_name}' ({e}), upgrading without it.")
+        return None
+    log(f"Pre-pulling {len(images)} distinct images from {len(pods)} pods onto the new nodes of "
+        f"'{pool_name}' (DaemonSet {PREPULL_NAMESPACE}/{name})")
+    return {"name": name, "pool": pool_name, "old_nodes": old_nodes, "images": len(images),
+            "before": [seconds for seconds in map(ready_seconds, pods) if seconds is not None]}
+
+def seconds_summary(values, unit="pods"):
+    if not values:
+        return "-"
+    ordered = sorted(values)
+    return (f"median {format_duration(statistics.median(ordered))}, "
+            f"p90 {format_duration(ordered[int(0.9 * (len(ordered) - 1))])} over {len(ordered)} {unit}")
+
+def finish_image_warmup(warmup, cluster_name, region, project):
+# reports the effect, then removes the DaemonSet whatever happened
+    try:
+        new_nodes = pool_node_names(cluster_name, region, project, warmup["pool"]) - warmup["old_nodes"]
+        rows = [row for row in list_running_pods(cluster_name, region, project) if row[2] in new_nodes]
+        pulls = [ready_seconds(row) for row in rows
+                 if row[0] == PREPULL_NAMESPACE and row[1].startswith(warmup["name"] + "-")]
+        after = [ready_seconds(row) for row in rows
+                 if row[0] != PREPULL_NAMESPACE and "DaemonSet" not in (row[8] or [])]
+        pulls = [seconds for seconds in pulls if seconds is not None]
+        after = [seconds for seconds in after if seconds is not None]
+        log(f"Image warmup for '{warmup['pool']}': {warmup['images']} images pre-pulled on {len(pulls)} "
+            f"of {len(new_nodes)} new nodes (pull time per node: {seconds_summary(pulls, 'nodes')})")
+        log(f"  pod time-to-ready before: {seconds_summary(warmup['before'])}")
+        log(f"  pod time-to-ready after:  {seconds_summary(after)}")
+        if warmup["before"] and after:
+            saved = statistics.median(warmup["before"]) - statistics.median(after)
+            observe("pod time-to-ready saved by warmup", max(saved, 0))
+            log(f"  median time-to-ready {'down' if saved >= 0 else 'up'} by {format_duration(abs(saved))}")
+    except Exception as e:
+        log(f"Could not measure the image warmup for '{warmup['pool']}' ({e})")
+    finally:
+        try:
+            delete_warmup_daemonset(cluster_name, region, project, warmup["name"])
+            log(f"Removed DaemonSet {PREPULL_NAMESPACE}/{warmup['name']}")
+        except Exception as e:
+            log(f"Could not remove DaemonSet {PREPULL_NAMESPACE}/{warmup['name']} ({e}), delete it by hand")
+
+# Drain watcher
+# While a pool upgrades, GKE cordons its old nodes a batch at a time and evicts their pods. An eviction a
+# PDB refuses is quietly retried for up to an hour and an evicted pod with nowhere to go sits Pending;
+# neither shows in the operation's progress. The watcher follows the drain through the Kubernetes watch
+# API the way client-go's informers do (list once, then one long-lived watch each for the pool's nodes,
+# all pods and the PDBs, resumed from the last resourceVersion), so a pod a PDB holds on a cordoned node
+# or a pod that can't be scheduled is reported within seconds, and each node's drain latency (cordon to
+# its last pod gone, DaemonSets aside) is logged and observed as "node drain". It only keeps the pods on
+# the pool's old nodes (node, labels, whether they are terminating) and the unschedulable ones. The pods
+# come from one paginated list of every pod that hasn't finished, each cut down to DRAIN_POD_FIELDS and
+# sorted onto its node right away; every other pod, listed or watched, is dropped as soon as it is read.
+DRAIN_WATCH = True
+DRAIN_WATCH_TIMEOUT = 60  # the API server ends each watch after this long, it is then resumed
+DRAIN_STUCK_SECONDS = 10  # a pod still on its node this long after the cordon is checked against the PDBs
+DRAIN_CHECK_INTERVAL = 2
+DRAIN_POD_FIELDS = ["metadata.namespace", "metadata.name", "metadata.labels", "metadata.ownerReferences",
+                    "metadata.deletionTimestamp", "spec.nodeName", "status.phase", "status.conditions"]
+
+def get_watch_client(base_url, verify=True):
+# watches hold their connection for minutes, so they get a client of their own instead of taking
+# connections from the pool every other call shares
+    with _http_lock:
+        client = _http_clients.get(("watch", base_url))
+        if client is None:
+            client = httpx.Client(base_url=base_url, verify=verify,
+                                  timeout=httpx.Timeout(HTTP_TIMEOUT, read=DRAIN_WATCH_TIMEOUT + HTTP_TIMEOUT),
+                                  limits=httpx.Limits(max_connections=None, max_keepalive_connections=0))
+            _http_clients[("watch", base_url)] = client
+        return client
+
+def kube_get_raw(cluster_name, region, project, path, params):
+# a single Kubernetes GET, whole object; kubectl's --raw takes the same path and query
+    if api_enabled():
+        try:
+            return kube_get(cluster_name, region, project, path, params=params)
+        except (httpx.HTTPError, subprocess.CalledProcessError, OSError, ValueError, KeyError) as e:
+            log(f"API call failed ({e}), falling back to kubectl")
+    ensure_kube_credentials(cluster_name, region, project)
+    return run_cmd(["kubectl", "get", "--raw", f"{path}?{urlencode(params)}",
+                    f"--context={kube_context(cluster_name, region, project)}"])
+
+def watch_lines(watcher, cluster_name, region, project, path, params):
+# one watch request, read line by line as the API server writes its events. Stopping the watcher
+# shuts the socket down (or kills kubectl), which ends the read at once.
+    started = time.time()
+    size = 0
+    if api_enabled():
+        base_url, verify = get_kube_target(cluster_name, region, project)
+        status = "error"
+        try:
+            with get_watch_client(base_url, verify).stream(
+                    "GET", path, params=params, headers={"Authorization": f"Bearer {get_access_token()}"}) as response:
+                status = response.status_code
+                response.raise_for_status()
+                sock = response.extensions["network_stream"].get_extra_info("socket")
+                with watcher["lock"]:
+                    watcher["closers"].append(lambda: sock.shutdown(socket.SHUT_RDWR))
+                if watcher["stop"].is_set():
+                    return
+                for line in response.iter_lines():
+                    size += len(line)
+                    yield line
+        finally:
+            if not watcher["stop"].is_set():
+                record_command("api", f"GET {base_url}{path}", started, status, size)
+        return
+    ensure_kube_credentials(cluster_name, region, project)
+    cmd = ["kubectl", "get", "--raw", f"{path}?{urlencode(params)}",
+           f"--context={kube_context(cluster_name, region, project)}"]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    with watcher["lock"]:
+        watcher["closers"].append(process.kill)
+    try:
+        for line in process.stdout:
+            size += len(line)
+            yield line
+    finally:
+        process.kill()
+        process.wait()
+        if not watcher["stop"].is_set():
+            record_command("cli", " ".join(cmd[:4]), started, process.returncode, size)
+
+def project_object(obj, fields):
+# the object with only the given dotted fields, nested as they were
+    projected = {}
+    for field in fields:
+        *parents, key = field.split(".")
+        source, target = obj, projected
+        for part in parents:
+            source = source.get(part) if isinstance(source, dict) else None
+            target = target.setdefault(part, {})
+        if isinstance(source, dict) and key in source:
+            target[key] = source[key]
+    return projected
+
+def kube_watch(watcher, cluster_name, region, project, path, params, fields=None):
+# list-then-watch: ("LIST", None), the current objects as ADDED events, ("SYNCED", None), then every
+# change from the list's resourceVersion on, bookmarks keeping that resourceVersion current. The list
+# is paged, all pages share the first one's resourceVersion; with fields, every object is cut down to
+# them before it is handed on. If the resourceVersion has expired when a watch is resumed (410 Gone)
+# it starts over with a new list.
+    while not watcher["stop"].is_set():
+        yield "LIST", None
+        resource_version = None
+        query = dict(params, limit=KUBE_PAGE_SIZE)
+        while True:
+            page = kube_get_raw(cluster_name, region, project, path, query)
+            resource_version = resource_version or page["metadata"]["resourceVersion"]
+            for item in page.get("items", []):
+                yield "ADDED", project_object(item, fields) if fields else item
+            token = page["metadata"].get("continue")
+            if not token:
+                break
+            query["continue"] = token
+        yield "SYNCED", None
+        while resource_version and not watcher["stop"].is_set():
+            query = dict(params, watch="true", allowWatchBookmarks="true", resourceVersion=resource_version,
+                         timeoutSeconds=DRAIN_WATCH_TIMEOUT)
+            for line in watch_lines(watcher, cluster_name, region, project, path, query):
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                obj = event.get("object", {})
+                if event["type"] == "ERROR":
+                    if obj.get("code") != 410:
+                        raise ValueError(obj.get("message", "watch failed"))
+                    resource_version = None
+                    break
+                resource_version = obj["metadata"]["resourceVersion"]
+                if event["type"] != "BOOKMARK":
+                    yield event["type"], project_object(obj, fields) if fields else obj
+
+def watch_node(watcher, kind, node):
+    if kind in ("LIST", "SYNCED"):
+        return
+    name = node["metadata"]["name"]
+    if name not in watcher["old_nodes"] or name in watcher["drained"]:
+        return
+    now = time.time()
+    if kind == "DELETED":
+        # whatever was still on it is gone with it
+        for key in [key for key, pod in watcher["pods"].items() if pod[0] == name]:
+            del watcher["pods"][key]
+        watcher["cordoned"].setdefault(name, now)
+        watcher["emptied"].setdefault(name, now)
+    elif node.get("spec", {}).get("unschedulable") and name not in watcher["cordoned"]:
+        watcher["cordoned"][name] = now
+        log(f"Node pool '{watcher['pool']}': node {name} cordoned, draining")
+
+def watch_pod(watcher, kind, pod):
+# keeps a pod only while it is on one of the pool's old nodes (DaemonSet pods aside, they go with the
+# node) or can't be scheduled anywhere
+    if kind == "LIST":
+        watcher["pods"].clear()
+        watcher["pending"].clear()
+        return
+    if kind == "SYNCED":
+        if "pods" not in watcher["synced"] and watcher["pending"]:
+            log(f"Node pool '{watcher['pool']}': {len(watcher['pending'])} pods were already unschedulable "
+                f"before the upgrade")
+            watcher["flagged"].update(watcher["pending"])
+        return
+    meta, spec, status = pod["metadata"], pod.get("spec", {}), pod.get("status", {})
+    key = (meta["namespace"], meta["name"])
+    node = spec.get("nodeName")
+    gone = kind == "DELETED" or status.get("phase") in ("Succeeded", "Failed") or \
+        any(owner.get("kind") == "DaemonSet" for owner in meta.get("ownerReferences", []))
+    previous = watcher["pods"].pop(key, None)
+    if not gone and node in watcher["old_nodes"]:
+        watcher["pods"][key] = (node, meta.get("labels") or {}, "deletionTimestamp" in meta)
+    elif previous:
+        watcher["emptied"][previous[0]] = time.time()
+        watcher["evicted"][previous[0]] = watcher["evicted"].get(previous[0], 0) + 1
+
+    scheduled = next((c for c in status.get("conditions") or [] if c.get("type") == "PodScheduled"), {})
+    if not gone and not node and scheduled.get("reason") == "Unschedulable":
+        watcher["pending"].setdefault(key, (time.time(), scheduled.get("message", "")))
+        return
+    pending = watcher["pending"].pop(key, None)
+    if pending and node and not gone:
+        log(f"Node pool '{watcher['pool']}': pod {key[0]}/{key[1]} scheduled on {node} after "
+            f"{format_duration(time.time() - pending[0])} pending")
+
+def watch_pdb(watcher, kind, pdb):
+    if kind == "LIST":
+        watcher["pdbs"].clear()
+    elif kind == "DELETED":
+        watcher["pdbs"].pop((pdb["metadata"]["namespace"], pdb["metadata"]["name"]), None)
+    elif kind != "SYNCED":
+        watcher["pdbs"][(pdb["metadata"]["namespace"], pdb["metadata"]["name"])] = (
+            pdb.get("spec", {}).get("selector"), pdb.get("status", {}).get("disruptionsAllowed", 0))
+
+def blocking_pdbs(watcher, ns, labels):
+# the PDBs covering the pod that allow no disruption right now
+    index = build_label_index([(ns, 0, labels)])
+    blocking = []
+    for (pdb_ns, pdb_name), (selector, allowed) in watcher["pdbs"].items():
+        if pdb_ns != ns or allowed or selector is None:
+            continue
+        try:
+            if match_selector(index, ns, selector):
+                blocking.append(f"{pdb_ns}/{pdb_name}")
+        except (KeyError, ValueError):
+            continue
+    return blocking
+
+def check_drain(watcher):
+    now = time.time()
+    pool = watcher["pool"]
+    with watcher["lock"]:
+        if "pods" not in watcher["synced"]:
+            return
+        occupied = {pod[0] for pod in watcher["pods"].values()}
+        for node, cordoned in watcher["cordoned"].items():
+            if node in watcher["drained"] or node in occupied:
+                continue
+            seconds = watcher["drained"][node] = max(watcher["emptied"].get(node, cordoned) - cordoned, 0)
+            observe("node drain", seconds)
+            log(f"Node pool '{pool}': node {node} drained in {format_duration(seconds)} "
+                f"({watcher['evicted'].get(node, 0)} pods evicted)")
+
+        for key, (node, labels, terminating) in watcher["pods"].items():
+            cordoned = watcher["cordoned"].get(node)
+            if cordoned is None or terminating or key in watcher["flagged"] or now - cordoned < DRAIN_STUCK_SECONDS:
+                continue
+            blocking = blocking_pdbs(watcher, key[0], labels)
+            if blocking:
+                watcher["flagged"].add(key)
+                watcher["blocked"] += 1
+                log(f"Node pool '{pool}': pod {key[0]}/{key[1]} on {node} is held by PDB {', '.join(blocking)} "
+                    f"(no disruptions allowed) {format_duration(now - cordoned)} into the drain; GKE forces it "
+                    f"after {format_duration(DRAIN_TIMEOUT_SECONDS)}")
+
+        for key, (since, message) in watcher["pending"].items():
+            if key not in watcher["flagged"]:
+                watcher["flagged"].add(key)
+                watcher["unschedulable"] += 1
+                log(f"Node pool '{pool}': pod {key[0]}/{key[1]} can't be scheduled: {message}")
+
+def run_drain_checks(watcher):
+    while not watcher["stop"].wait(DRAIN_CHECK_INTERVAL):
+        check_drain(watcher)
+
+def follow_watch(watcher, cluster_name, region, project, resource, path, params, fields, handle):
+# one thread per watch. Advisory like the rest: a watch that can't even list is given up, one that
+# breaks later is started over.
+    while not watcher["stop"].is_set():
+        try:
+            for kind, obj in kube_watch(watcher, cluster_name, region, project, path, params, fields):
+                with watcher["lock"]:
+                    if watcher["stop"].is_set():
+                        return
+                    handle(watcher, kind, obj)
+                    if kind == "SYNCED":
+                        watcher["synced"].add(resource)
+        except Exception as e:
+            if watcher["stop"].is_set():
+                return
+            if resource not in watcher["synced"]:
+                log(f"Node pool '{watcher['pool']}': can't watch {resource} ({e}), following the drain without them")
+                return
+            log(f"Node pool '{watcher['pool']}': the {resource} watch broke ({e}), starting it over")
+            watcher["stop"].wait(DRAIN_CHECK_INTERVAL)
+
+def start_drain_watch(nodepool, old_nodes, cluster_name, region, project):
+    pool_name = nodepool["name"]
+    watcher = {"pool": pool_name, "old_nodes": old_nodes, "lock": threading.Lock(), "stop": threading.Event(),
+               "closers": [], "synced": set(), "pods": {}, "pending": {}, "pdbs": {}, "cordoned": {},
+               "emptied": {}, "evicted": {}, "drained": {}, "flagged": set(), "blocked": 0, "unschedulable": 0}
+    # a pod that finishes leaves the selection, the watch reports it as DELETED
+    watches = [
+        ("nodes", "/api/v1/nodes", {"labelSelector": f"{NODEPOOL_LABEL}={pool_name}"}, None, watch_node),
+        ("pods", "/api/v1/pods", {"fieldSelector": "status.phase!=Succeeded,status.phase!=Failed"},
+         DRAIN_POD_FIELDS, watch_pod),
+        ("pdbs", "/apis/policy/v1/poddisruptionbudgets", {}, None, watch_pdb),
+    ]
+    for watch in watches:
+        threading.Thread(target=with_log_context(follow_watch), args=(watcher, cluster_name, region, project) + watch,
+                         daemon=True).start()
+    watcher["checker"] = threading.Thread(target=with_log_context(run_drain_checks), args=(watcher,), daemon=True)
+    watcher["checker"].start()
+    log(f"Watching the drain of the {len(old_nodes)} nodes of '{pool_name}'")
+    return watcher
+
+def stop_drain_watch(watcher):
+    watcher["stop"].set()
+    with watcher["lock"]:
+        closers = list(watcher["closers"])
+    for close in closers:
+        try:
+            close()
+        except OSError:
+            pass
+    watcher["checker"].join()
+    if "pods" not in watcher["synced"]:
+        return
+    check_drain(watcher)
+    log(f"Drain watch for '{watcher['pool']}': {len(watcher['drained'])} of {len(watcher['old_nodes'])} nodes "
+        f"drained (drain latency: {seconds_summary(list(watcher['drained'].values()), 'nodes')}), "
+        f"{watcher['blocked']} pods held by PDBs, {watcher['unschedulable']} unschedulable")
+
+# Pre-flight
+# Everything the plan and the risk gate need is read-only, so it is fetched at once: the pre-flight
+# takes as long as the slowest list instead of the sum of them. The cluster and its node pools come
+# first, and only a cluster with pools behind its control plane goes on to the workload, PDB, pod
+# and node lists, so the common "nothing to do" case stays two reads. Nothing is changed on the
+# cluster until the gate has been passed.
+PREFETCH_WORKERS = 10
+
+def run_fetches(fetches):
+# fetches: name -> (fetch, required); a failed optional fetch is left out of the results
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(PREFETCH_WORKERS, len(fetches))) as executor:
+        futures = {executor.submit(with_log_context(fetch)): (name, required)
+                   for name, (fetch, required) in fetches.items()}
+        for future in as_completed(futures):
+            name, required = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception:
+                if required:
+                    raise
+    return results
+
+def fetch_cluster_and_pools(cluster_name, region, project, dry_run):
+    results = run_fetches({
+        "cluster": (lambda: get_cluster(cluster_name, region, project, dry_run), True),
+        "node pools": (lambda: get_node_pools(cluster_name, region, project, dry_run), True),
+    })
+    return results["cluster"], results["node pools"]
+
+def prefetch_cluster_state(cluster_name, region, project, dry_run):
+# the workload, PDB, pod and node lists and the region's quotas end up in their caches, where the
+# simulation, the surge tuner and the risk gate pick them up
+    fetches = {}
+    for kind, (_, resource, _) in WORKLOAD_KINDS.items():
+        fetches[resource] = (lambda kind=kind: list_kind(cluster_name, region, project, kind), True)
+    fetches["pdbs"] = (lambda: list_pdbs(cluster_name, region, project), True)
+    fetches["pods"] = (lambda: list_pods(cluster_name, region, project), True)
+    # the risk gate needs the nodes to tell which bare pods get drained
+    fetches["nodes"] = (lambda: list_nodes(cluster_name, region, project), True)
+    # the simulation is advisory, if the quotas can't be read it reports that itself later on
+    if SIMULATE:
+        fetches["quotas"] = (lambda: get_region_quotas(project, region, dry_run), False)
+
+    log(f"Fetching {', '.join(fetches)} in parallel...")
+    started = time.time()
+    run_fetches(fetches)
+    elapsed = time.time() - started
+    observe("pre-flight reads", elapsed)
+    log(f"Pre-flight reads finished in {elapsed:.2f}s")
+
+# Approval policy
+# Instead of answering prompts, a policy file (--policy, JSON or YAML) decides up front for every
+# cluster and pool:
+#   {"defaults": {"surge": "apply", "risky_workloads": "deny", "max_minor_jump": 1},
+#    "rules": [{"project": "dev-.*", "risky_workloads": "allow"},
+#              {"project": "prod-.*", "cluster": "payments-.*", "nodepool": "gpu-.*", "surge": "skip"}]}
+# surge: apply | skip | ask, risky_workloads: allow | deny | ask, max_minor_jump: how many minor
+# versions a pool may move in one upgrade (null for no limit), max_surge: the largest maxSurge the surge
+# tuner may pick for a pool (null for whatever the quotas and PDBs allow). Patterns are full-match regexes and a
+# rule without one matches everything; every matching rule applies in order, later ones win, and
+# rules with a nodepool pattern only affect pool settings. Without --policy everything is "ask" as
+# before; with one, whatever it leaves open is skip / deny, so unattended runs never stop on a prompt.
+POLICY_CHOICES = {"surge": ("apply", "skip", "ask"), "risky_workloads": ("allow", "deny", "ask")}
+POLICY_SETTINGS = ("surge", "risky_workloads", "max_minor_jump", "max_surge")
+_policy = {"rules": [], "defaults": {"surge": "ask", "risky_workloads": "ask", "max_minor_jump": None,
+                                     "max_surge": None}}
+
+def load_policy(path):
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ValueError("PyYAML is needed for YAML policy files, use JSON or install it")
+            try:
+                data = yaml.safe_load(f) or {}
+            except yaml.YAMLError as e:
+                raise ValueError(str(e))
+        else:
+            data = json.load(f)
+
+    defaults = {"surge": "skip", "risky_workloads": "deny", "max_minor_jump": None, "max_surge": None}
+    defaults.update(data.get("defaults", {}))
+    rules = []
+    for rule in [defaults] + data.get("rules", []):
+        for key, value in rule.items():
+            if key in POLICY_CHOICES and value not in POLICY_CHOICES[key]:
+                raise ValueError(f"{key} must be one of {', '.join(POLICY_CHOICES[key])}, not '{value}'")
+            if key == "max_minor_jump" and value is not None and not isinstance(value, int):
+                raise ValueError(f"max_minor_jump must be a number, not '{value}'")
+            if key == "max_surge" and value is not None and not (isinstance(value, int) and value >= 1):
+                raise ValueError(f"max_surge must be a number of at least 1, not '{value}'")
+            if key not in POLICY_SETTINGS + ("project", "cluster", "nodepool"):
+                raise ValueError(f"unknown policy key '{key}'")
+        if rule is not defaults:
+            rules.append({key: re.compile(value) if key in ("project", "cluster", "nodepool") else value
+                          for key, value in rule.items()})
+    return {"rules": rules, "defaults": defaults}
+
+def policy_settings(project, cluster_name, nodepool=None):
+    settings = dict(_policy["defaults"])
+    for rule in _policy["rules"]:
+        if "nodepool" in rule and nodepool is None:
+            continue
+        targets = (("project", project), ("cluster", cluster_name), ("nodepool", nodepool))
+        if all(field not in rule or rule[field].fullmatch(value) for field, value in targets):
+            settings.update({key: rule[key] for key in POLICY_SETTINGS if key in rule})
+    return settings
+
+def minor_jump(current_version, target_version):
+    current = parse_gke_version(current_version)
+    target = parse_gke_version(target_version)
+    return target.minor - current.minor if target.major == current.major else math.inf
+
+def apply_policy(entry):
+# writes the policy's decisions into a plan entry, before anything on the cluster changes
+    entry["policy"] = {"risky_workloads": policy_settings(entry["project"], entry["cluster"])["risky_workloads"]}
+    for pool in entry["nodepools"]:
+        if not pool["upgrade"]:
+            continue
+        settings = policy_settings(entry["project"], entry["cluster"], pool["name"])
+        pool["policy"] = {"surge": settings["surge"]}
+        jump = minor_jump(pool["current_version"], pool["target_version"])
+        if settings["max_minor_jump"] is not None and jump > settings["max_minor_jump"]:
+            pool["policy"]["blocked"] = f"{jump} minor versions, policy allows {settings['max_minor_jump']}"
+    return entry
 
-    if not upgrades_needed:
+# Checkpoints
+# Live upgrade and apply runs append every step that changes a cluster to a checkpoint journal
+# (--checkpoint-file, one JSON record per line, fsynced as it is written): the risky-workloads gate
+# passed, a pool upgrade started (with its GKE operation), a pool finished, a cluster finished. If the
+# run dies halfway, --resume replays that journal: finished clusters and pools are skipped, pools
+# whose operation was in flight re-attach to it instead of starting a second upgrade, and clusters
+# that already passed their gate (or, for apply, the plan check) are not asked or checked again.
+CHECKPOINT_FILE = "nodepool-upgrade-checkpoint.jsonl"
+_checkpoint = {"file": None, "lock": threading.Lock(), "steps": {}}
+
+def remember_step(record):
+# pool operations drop out once the pool finished or failed, so only in-flight ones remain
+    key = (record["project"], record["region"], record["cluster"], record["nodepool"])
+    steps = _checkpoint["steps"].setdefault(key, {})
+    if record["step"] in ("done", "failed"):
+        steps.pop("started", None)
+    if record["step"] != "failed":
+        steps[record["step"]] = record
+
+def load_checkpoint(path, command):
+    try:
+        with open(path) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        log(f"No checkpoint at {path}, nothing to resume; starting from the beginning.")
+        return
+    except ValueError:
+        raise CommandError(f"{path} is not a checkpoint journal") from None
+    if records and records[0].get("command") != command:
+        raise CommandError(f"{path} records a '{records[0].get('command')}' run, it cannot resume '{command}'")
+    for record in records[1:]:
+        remember_step(record)
+    clusters = sum(1 for key, steps in _checkpoint["steps"].items() if key[3] == "-" and "done" in steps)
+    in_flight = sum(1 for steps in _checkpoint["steps"].values() if "started" in steps)
+    log(f"Resuming the run from {records[0]['started_at'] if records else 'an empty checkpoint'}: "
+        f"{clusters} clusters finished, {in_flight} pool upgrades in flight")
+
+def open_checkpoint(path, command, resume):
+    if resume:
+        load_checkpoint(path, command)
+    elif os.path.exists(path):
+        log(f"Starting a new checkpoint at {path}; pass --resume to continue the run it recorded instead.")
+    _checkpoint["file"] = open(path, "a" if resume and os.path.exists(path) else "w")
+    if _checkpoint["file"].tell() == 0:
+        write_checkpoint({"command": command, "started_at": datetime.now().isoformat(timespec="seconds")})
+
+def write_checkpoint(record):
+    with _checkpoint["lock"]:
+        _checkpoint["file"].write(json.dumps(record) + "\n")
+        _checkpoint["file"].flush()
+        os.fsync(_checkpoint["file"].fileno())
+
+def checkpoint(project, region, cluster_name, nodepool, step, **fields):
+# dry runs change nothing and keep no checkpoint
+    if _checkpoint["file"] is None:
+        return
+    record = {"ts": time.time(), "project": project, "region": region, "cluster": cluster_name,
+              "nodepool": nodepool, "step": step, **fields}
+    write_checkpoint(record)
+    with _checkpoint["lock"]:
+        remember_step(record)
+
+def checkpointed_step(project, region, cluster_name, nodepool, step):
+    with _checkpoint["lock"]:
+        return _checkpoint["steps"].get((project, region, cluster_name, nodepool), {}).get(step)
+
+def resumable(cluster_fn):
+# wraps a fleet cluster_fn: clusters the checkpoint has as finished are reported, not redone
+    def run_target(target):
+        project, region, cluster_name = target["project"], target["region"], target["cluster"]
+        done = checkpointed_step(project, region, cluster_name, "-", "done")
+        if done:
+            log(f"Cluster {cluster_name} was finished by the run being resumed.")
+            return [dict(row, status=f"{row['status']} (earlier run)") for row in done["rows"]]
+        rows = cluster_fn(target)
+        # clusters with failed or aborted pools are retried on resume
+        if all(not row["status"].startswith(("Upgrade failed", "Aborted", "Failed")) for row in rows):
+            checkpoint(project, region, cluster_name, "-", "done", rows=rows)
+        return rows
+    return run_target
+
+# Plan / apply
+# "plan" reads the clusters (read-only, the snapshot cache may serve it) and writes down what an
+# upgrade would do: target versions, surge setting changes, risky workloads and a fingerprint of the
+# GKE state the plan was made from. "apply" re-reads only the cluster and its node pools, checks the
+# fingerprint and carries out exactly that plan, so a fleet planned overnight can be applied in a
+# maintenance window without rediscovering every cluster's workloads.
+PLAN_FORMAT = 1
+
+def state_fingerprint(control_plane_version, nodepools):
+# everything the plan's decisions depend on that apply can re-read with two cheap calls
+    pools = sorted(({field: np.get(field) for field in ("name", "version", "status", "initialNodeCount",
+                                                        "locations", "autoscaling", "upgradeSettings")}
+                    for np in nodepools), key=lambda pool: pool["name"])
+    state = json.dumps({"controlPlane": control_plane_version, "nodePools": pools}, sort_keys=True)
+    return "sha256:" + hashlib.sha256(state.encode()).hexdigest()
+
+def plan_cluster(project, region, cluster_name, dry_run):
+# everything the upgrade decides before it changes anything; returns the plan entry and the node pools
+    connect_to_cluster(region, project, cluster_name, dry_run)
+
+    cluster, nodepools = fetch_cluster_and_pools(cluster_name, region, project, dry_run)
+    control_plane_version_raw = cluster["currentMasterVersion"]
+    log(f"Control plane version: {control_plane_version_raw}")
+
+    entry = {"project": project, "region": region, "cluster": cluster_name,
+             "control_plane_version": control_plane_version_raw,
+             "fingerprint": state_fingerprint(control_plane_version_raw, nodepools),
+             "nodepools": [], "risky_workloads": []}
+    outdated = []
+    for np in nodepools:
+        current_version = np.get("version", "")
+        upgrade = parse_gke_version(current_version) < parse_gke_version(control_plane_version_raw)
+        entry["nodepools"].append({"name": np["name"], "current_version": current_version,
+                                   "target_version": control_plane_version_raw if upgrade else current_version,
+                                   "upgrade": upgrade, "surge_change": surge_change(np) if upgrade else None})
+        if upgrade:
+            outdated.append(np)
+    if not outdated:
+        return apply_policy(entry), nodepools
+
+    prefetch_cluster_state(cluster_name, region, project, dry_run)
+    simulations = simulate_nodepool_upgrades(cluster_name, region, project, outdated, cluster, dry_run)
+    by_name = {np["name"]: np for np in nodepools}
+    for pool in entry["nodepools"]:
+        sim = simulations.get(pool["name"])
+        if sim:
+            pool["estimated_seconds"] = sim["seconds"]
+            pool["blocked_drains"] = len(sim["blocked"])
+            # the tuned surge replaces the default one; its estimate holds once it has been applied
+            if "tuned" in sim and sim["tuned"]["choice"]:
+                choice = sim["tuned"]["choice"]
+                pool["surge_change"] = surge_change(by_name[pool["name"]], choice["maxSurge"])
+                if pool["surge_change"]:
+                    pool["surge_change"]["estimated_seconds"] = choice["seconds"]
+
+    workloads = get_all_workloads(cluster_name, region, project, {np["name"] for np in outdated})
+    entry["risky_workloads"] = get_risky_workloads(workloads,
+                                                   get_pdb_coverage(cluster_name, region, project, workloads))
+    return apply_policy(entry), nodepools
+
+def plan_rows(entry):
+    rows = []
+    for pool in entry["nodepools"]:
+        change = pool["surge_change"]
+        policy = pool.get("policy", {})
+        if "blocked" in policy:
+            decision = f"blocked: {policy['blocked']}"
+        elif pool["upgrade"]:
+            decision = f"surge {policy.get('surge', 'ask') if change else '-'}, " \
+                       f"risky {entry.get('policy', {}).get('risky_workloads', 'ask')}"
+        else:
+            decision = "-"
+        # the estimate assumes the surge change goes ahead unless the policy skips it
+        seconds = change.get("estimated_seconds") if change and policy.get("surge") != "skip" else None
+        seconds = seconds or pool.get("estimated_seconds")
+        rows.append({"nodepool": pool["name"], "current": pool["current_version"],
+                     "target": pool["target_version"] if pool["upgrade"] else "-",
+                     "surge change": f"{change['maxSurge']}/{change['maxUnavailable']}" if change else "-",
+                     "estimate": format_duration(seconds) if pool["upgrade"] and seconds else "-",
+                     "risky workloads": len(entry["risky_workloads"]) if pool["upgrade"] else "-",
+                     "policy": decision})
+    return rows
+
+def write_plan(path, entries):
+# written to a temp file and renamed, a half-written plan must never be applied
+    plan = {"format": PLAN_FORMAT, "created_at": datetime.now().isoformat(timespec="seconds"),
+            "clusters": sorted(entries, key=lambda entry: (entry["project"], entry["region"], entry["cluster"]))}
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(plan, f, indent=2)
+    os.replace(tmp, path)
+
+def load_plan(path):
+    with open(path) as f:
+        plan = json.load(f)
+    if plan.get("format") != PLAN_FORMAT:
+        raise CommandError(f"{path} is not a plan this version can apply "
+                           f"(format {plan.get('format')}, expected {PLAN_FORMAT})")
+    return plan
+
+def confirm_risky_workloads(risky, dry_run, decision="ask"):
+    if not risky:
+        return True
+    log("\nSome workloads could lose all their pods during the upgrade:")
+    log(tabulate(risky, headers="keys"))
+    if decision == "allow":
+        log("Policy: continuing despite risky workloads.")
+        return True
+    if decision == "deny":
+        log("Policy: aborting upgrade due to risky workloads.")
+        return False
+    if dry_run:
+        log("DRY RUN: Would prompt to continue despite risky workloads.")
+        return True
+    choice = ask("\nContinue with upgrade anyway? (y/n): ")
+    if choice != 'y':
+        log("Aborting upgrade due to risky workloads.")
+        return False
+    return True
+
+def upgrade_cluster(project, region, cluster_name, dry_run):
+# the whole check -> plan -> upgrade flow for a single cluster, returns the summary rows
+    entry, nodepools = plan_cluster(project, region, cluster_name, dry_run)
+    if not any(pool["upgrade"] for pool in entry["nodepools"]):
         log("All node pools are already at the control plane version. No upgrades needed.")
-        write_log_file(args.project, args.region, args.cluster)
-        sys.exit(0)
+        return [{"nodepool": "-", "status": "No upgrades needed"}]
+
+    # the gate comes before the first change, surge settings included
+    if checkpointed_step(project, region, cluster_name, "-", "approved"):
+        log("Risky workloads were already confirmed by the run being resumed.")
+    elif not confirm_risky_workloads(entry["risky_workloads"], dry_run, entry["policy"]["risky_workloads"]):
+        return [{"nodepool": "-", "status": "Aborted due to risky workloads"}]
+    else:
+        checkpoint(project, region, cluster_name, "-", "approved")
 
     results = []
-    for np in nodepools:
-        check_surge_upgrade(np, args.cluster, args.region, args.project, dry_run)
-        name = np["name"]
-        current_version_raw = np.get("version", "")
-        current_version = strip_gke_suffix(current_version_raw)
-        if version.parse(current_version) >= version.parse(control_plane_version):
-            results.append({"nodepool": name, "status": "Already up-to-date"})
+    for np, pool in zip(nodepools, entry["nodepools"]):
+        if not pool["upgrade"]:
+            results.append({"nodepool": pool["name"], "status": "Already up-to-date"})
+            continue
+        if "blocked" in pool["policy"]:
+            results.append({"nodepool": pool["name"], "status": f"Skipped by policy: {pool['policy']['blocked']}"})
             continue
-        result = upgrade_nodepool(name, current_version_raw, control_plane_version_raw,
-                                  args.cluster, args.region, args.project, dry_run)
-        results.append(result)
-
-    workloads = get_all_workloads(dry_run)
-    pdb_covered = get_pdb_coverage(dry_run)
-    risky = [w for w in workloads if (w["namespace"], w["name"]) not in pdb_covered]
-
-    if risky:
-        log("\nSome workloads have 1 or fewer replicas and are not covered by a PodDisruptionBudget:")
-        log(tabulate(risky, headers="keys"))
-        if not dry_run:
-            choice = input("\nContinue with upgrade anyway? (y/n): ").strip().lower()
-            if choice != 'y':
-                log("Aborting upgrade due to risky workloads.")
-                write_log_file(args.project, args.region, args.cluster)
-                sys.exit(0)
+        if _interrupted.is_set():
+            results.append({"nodepool": pool["name"], "status": "Aborted: run interrupted"})
+            continue
+        # a pool whose upgrade got under way in the run being resumed is half replaced: GKE won't take a
+        # surge update while it runs, and the settings it was started with stay
+        resumed = any(checkpointed_step(project, region, cluster_name, pool["name"], step)
+                      for step in ("started", "done"))
+        if not resumed:
+            check_surge_upgrade(np, pool["surge_change"], cluster_name, region, project, dry_run,
+                                pool["policy"]["surge"])
+        results.append(upgrade_nodepool(np, pool["target_version"], cluster_name, region, project, dry_run))
+    return results
+
+def apply_cluster_plan(entry, dry_run):
+# runs one cluster's part of a plan, unless the cluster has changed since it was planned
+    project, region, cluster_name = entry["project"], entry["region"], entry["cluster"]
+    control_plane_version_raw = get_control_plane_version(cluster_name, region, project, dry_run)
+    nodepools = get_node_pools(cluster_name, region, project, dry_run)
+    # once apply has started changing a cluster its state no longer matches the plan by design,
+    # so a resumed apply trusts the check it passed before
+    if checkpointed_step(project, region, cluster_name, "-", "approved"):
+        log(f"Cluster {cluster_name} was checked against the plan by the run being resumed.")
+    else:
+        if state_fingerprint(control_plane_version_raw, nodepools) != entry["fingerprint"]:
+            log(f"Cluster {cluster_name} has changed since the plan was made, skipping it. Plan it again.")
+            return [{"nodepool": "-", "status": "Skipped: plan is stale"}]
+        log(f"Cluster {cluster_name} matches the plan.")
+
+        if not any(pool["upgrade"] for pool in entry["nodepools"]):
+            return [{"nodepool": "-", "status": "No upgrades needed"}]
+        if not confirm_risky_workloads(entry["risky_workloads"], dry_run, entry["policy"]["risky_workloads"]):
+            return [{"nodepool": "-", "status": "Aborted due to risky workloads"}]
+        checkpoint(project, region, cluster_name, "-", "approved")
+
+    by_name = {np["name"]: np for np in nodepools}
+    results = []
+    for pool in entry["nodepools"]:
+        if not pool["upgrade"]:
+            results.append({"nodepool": pool["name"], "status": "Already up-to-date"})
+            continue
+        if "blocked" in pool["policy"]:
+            results.append({"nodepool": pool["name"], "status": f"Skipped by policy: {pool['policy']['blocked']}"})
+            continue
+        if _interrupted.is_set():
+            results.append({"nodepool": pool["name"], "status": "Aborted: run interrupted"})
+            continue
+        # the planned surge change is part of what apply was asked to do, unless the policy says skip
+        # or the pool's upgrade already got under way in the run being resumed
+        resumed = any(checkpointed_step(project, region, cluster_name, pool["name"], step)
+                      for step in ("started", "done"))
+        if pool["surge_change"] and pool["policy"]["surge"] != "skip" and not resumed:
+            if dry_run:
+                log(f"DRY RUN: Would apply surge upgrade settings to node pool '{pool['name']}'")
+            else:
+                apply_surge_settings(pool["name"], cluster_name, region, project, pool["surge_change"])
+                by_name[pool["name"]]["upgradeSettings"] = {"maxSurge": pool["surge_change"]["maxSurge"],
+                                                            "maxUnavailable": pool["surge_change"]["maxUnavailable"]}
+        results.append(upgrade_nodepool(by_name[pool["name"]], pool["target_version"],
+                                        cluster_name, region, project, dry_run))
+    return results
+
+# Fleet mode
+# Runs upgrade_cluster for many clusters at once. GKE limits concurrent operations per project
+# and per region, so on top of the overall worker count each cluster needs a free slot for its
+# project and for its region before it starts. Clusters are only handed to a worker once both are
+# free, so a run of clusters from one project waits in the queue, not in the workers, and the
+# clusters of other projects behind them start in the meantime.
+def location_region(location):
+# zones (us-central1-a) count against their region's quota
+    return location.rsplit("-", 1)[0] if location.count("-") >= 2 else location
+
+def load_inventory(path):
+# CSV with a header row: project,region,cluster
+    with open(path, newline="") as f:
+        return [{"project": row["project"].strip(), "region": row["region"].strip(),
+                 "cluster": row["cluster"].strip()}
+                for row in csv.DictReader(f) if row.get("cluster")]
+
+# one clusters list across all locations per project; the returned cluster resources carry the same
+# fields as a describe plus every node pool's version, so we keep them and save calls per cluster later
+DISCOVERY_FIELDS = CLUSTER_FIELDS + ["nodePools[].name", "nodePools[].version"]
+_project_clusters = {}
+
+def list_project_clusters(project, dry_run):
+    if project not in _project_clusters:
+        log(f"Listing clusters in project {project}...")
+        data = cached_fetch(project, "-", "-", "clusters", lambda: api_or_cli(
+            lambda: api_get(GKE_API_ENDPOINT, f"/v1/projects/{project}/locations/-/clusters",
+                            params={"fields": api_fields(DISCOVERY_FIELDS, "clusters")}),
+            ["gcloud", "container", "clusters", "list", f"--project={project}", gcloud_format(DISCOVERY_FIELDS)],
+            dry_run=dry_run))
+        clusters = data.get("clusters", []) if isinstance(data, dict) else data
+        for cluster in clusters:
+            _cluster_cache.setdefault((project, cluster["location"], cluster["name"]), cluster)
+        _project_clusters[project] = clusters
+    return _project_clusters[project]
+
+def discover_clusters(project, dry_run):
+    return [{"project": project, "region": cluster["location"], "cluster": cluster["name"]}
+            for cluster in list_project_clusters(project, dry_run)]
+
+# Fleet version skew index
+# Whether a cluster needs work at all can be read off the project's clusters list: the control plane
+# version against the versions of its node pools. With one list per project, run in parallel over
+# projects, a fleet of hundreds of clusters is sorted out in a few calls instead of a describe and a
+# node pools list per cluster; fleet runs skip the clusters that are already level.
+def build_skew_index(projects, dry_run, max_parallel):
+    clusters = []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(projects)))) as executor:
+        futures = {executor.submit(with_log_context(list_project_clusters), project, dry_run): project
+                   for project in projects}
+        for future in as_completed(futures):
+            # a project that can't be listed (no permission, API disabled) is left out of the index,
+            # its clusters then go through the fleet run like any other cluster missing from it
+            try:
+                clusters.extend((futures[future], cluster) for cluster in future.result())
+            except Exception as e:
+                log(f"Could not list the clusters of project {futures[future]} ({e}), leaving it out of the index")
+
+    index = {}
+    for project, cluster in clusters:
+        control_plane = parse_gke_version(cluster["currentMasterVersion"])
+        versions = [np["version"] for np in cluster.get("nodePools", []) if np.get("version")]
+        behind = [v for v in versions if parse_gke_version(v) < control_plane]
+        oldest = min(versions, key=parse_gke_version, default=None)
+        index[(project, cluster["location"], cluster["name"])] = {
+            "project": project, "region": cluster["location"], "cluster": cluster["name"],
+            "control plane": cluster["currentMasterVersion"],
+            "oldest node pool": oldest or "-",
+            "minor skew": control_plane.minor - parse_gke_version(oldest).minor if behind else 0,
+            "pools behind": len(behind),
+            "node pools": len(versions)
+        }
+    return index
+
+def print_skew_report(index, elapsed):
+    skewed = sorted((row for row in index.values() if row["pools behind"]),
+                    key=lambda row: (-row["minor skew"], row["project"], row["region"], row["cluster"]))
+    log(f"\n{len(skewed)} of {len(index)} clusters have control plane/node version skew "
+        f"(indexed in {elapsed:.2f}s):\n")
+    if skewed:
+        log(tabulate(skewed, headers="keys"))
+
+def run_fleet(inventory, cluster_fn, max_parallel, max_per_project, max_per_region):
+# cluster_fn(target) does the work for one cluster (upgrade, plan or apply) and returns its summary rows
+    def worker(target):
+        project, region, cluster_name = target["project"], target["region"], target["cluster"]
+        _log_context.prefix = f"[{project}/{region}/{cluster_name}] "
+        _log_context.journal = open_journal(f"{project}-{region}-{cluster_name}")
+        try:
+            return cluster_fn(target)
+        except Exception as e:
+            log(f"Cluster run failed: {e}")
+            return [{"nodepool": "-", "status": f"Failed: {e}"}]
+        finally:
+            close_journal(_log_context.journal)
+            del _log_context.prefix, _log_context.journal
+
+    # slots in use per project and region, only ever touched here on the dispatching thread
+    project_busy = {}
+    region_busy = {}
+    pending = list(inventory)
+    running = {}
+    summary = []
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        try:
+            while pending or running:
+                waiting = []
+                for target in pending:
+                    project, region = target["project"], location_region(target["region"])
+                    if (len(running) < max_parallel and project_busy.get(project, 0) < max_per_project
+                            and region_busy.get(region, 0) < max_per_region):
+                        project_busy[project] = project_busy.get(project, 0) + 1
+                        region_busy[region] = region_busy.get(region, 0) + 1
+                        running[executor.submit(worker, target)] = target
+                    else:
+                        waiting.append(target)
+                pending = waiting
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    target = running.pop(future)
+                    project_busy[target["project"]] -= 1
+                    region_busy[location_region(target["region"])] -= 1
+                    for row in future.result():
+                        summary.append({"project": target["project"], "region": target["region"],
+                                        "cluster": target["cluster"], **row})
+        except KeyboardInterrupt:
+            # the running clusters stop at their next pool, the queued ones never start; waiting for
+            # them keeps the checkpoint and the journals open until they have written their last step
+            log("Interrupted, waiting for the running clusters to stop...")
+            interrupt_run()
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    summary.sort(key=lambda row: (row["project"], row["region"], row["cluster"]))
+    return summary
+
+def exit_if_failed(rows):
+    # policy-driven runs are unattended, the exit status is all that tells them a cluster or pool failed
+    if any(row["status"].startswith(("Failed", "Upgrade failed")) for row in rows):
+        sys.exit(1)
+
+def positive_int(value):
+# argparse type for the fleet limits: with a limit of 0 nothing is ever dispatched
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", nargs="?", choices=["upgrade", "plan", "apply", "skew"], default="upgrade",
+                        help="upgrade (default) checks and upgrades interactively; plan only writes what it would "
+                             "do to --plan-file; apply carries out a plan file; skew lists the clusters whose "
+                             "node pools are behind their control plane")
+    parser.add_argument("--plan-file", default="nodepool-upgrade-plan.json",
+                        help="Where plan writes the plan and apply reads it from")
+    parser.add_argument("--policy", help="Approval policy file (JSON or YAML) that answers the prompts up front")
+    parser.add_argument("--checkpoint-file", default=CHECKPOINT_FILE,
+                        help="Where live upgrade/apply runs record their progress")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the run recorded in --checkpoint-file: skip finished clusters and pools "
+                             "and re-attach to upgrade operations still running")
+    parser.add_argument("--region")
+    parser.add_argument("--project")
+    parser.add_argument("--cluster")
+    parser.add_argument("--dry-run", action="store_true", help="Simulate without making changes")
+    parser.add_argument("--transport", choices=["api", "cli"], default="api",
+                        help="Talk to the GKE/Kubernetes APIs in-process (default) or fork gcloud/kubectl per call")
+    parser.add_argument("--inventory", help="Fleet mode: CSV file with project,region,cluster columns")
+    parser.add_argument("--discover-project", action="append", default=[],
+                        help="Fleet mode: upgrade every cluster in this project (can be repeated)")
+    parser.add_argument("--max-parallel", type=positive_int, default=8, help="Fleet mode: clusters processed at once")
+    parser.add_argument("--max-per-project", type=positive_int, default=2,
+                        help="Fleet mode: concurrent clusters per project")
+    parser.add_argument("--max-per-region", type=positive_int, default=4,
+                        help="Fleet mode: concurrent clusters per region")
+    parser.add_argument("--poll-interval", type=float, default=OPERATION_POLL_INTERVAL,
+                        help="Seconds between checks on running upgrade operations")
+    parser.add_argument("--offline-plan", action="store_true",
+                        help="Dry run using only the cached cluster snapshots, no API calls")
+    parser.add_argument("--cache-ttl", type=int, default=CACHE_TTL,
+                        help="Seconds a cached snapshot is reused by dry runs")
+    parser.add_argument("--invalidate-cache", action="store_true",
+                        help="Drop the cached snapshots of the targeted clusters before running")
+    parser.add_argument("--no-cache", action="store_true", help="Neither read nor write the snapshot cache")
+    parser.add_argument("--no-simulation", action="store_true",
+                        help="Skip the pre-upgrade drain/capacity simulation")
+    parser.add_argument("--no-drain-watch", action="store_true",
+                        help="Don't watch the node drains (PDB-blocked and unschedulable pods) during upgrades")
+    parser.add_argument("--prepull-images", action="store_true",
+                        help="Pre-pull the images running in each node pool onto its new nodes during the upgrade")
+    parser.add_argument("--metrics-file",
+                        help="Write per-operation latency metrics here for node_exporter's textfile collector "
+                             "(e.g. /var/lib/node_exporter/textfile_collector/nodepool_upgrader.prom)")
+    parser.add_argument("--profile", action="store_true", help="Print where the run spent its time at exit")
+    args = parser.parse_args()
+
+    fleet_mode = bool(args.inventory or args.discover_project)
+    if args.command == "skew" and not (fleet_mode or args.project):
+        parser.error("skew needs --project, --inventory or --discover-project")
+    if args.resume and args.command not in ("upgrade", "apply"):
+        parser.error("--resume only applies to upgrade and apply runs")
+    if args.command not in ("apply", "skew") and not fleet_mode and not (args.project and args.region and args.cluster):
+        parser.error("--project, --region and --cluster are required unless --inventory or --discover-project is used")
+
+    # the interrupted run's journals are its crash record, a resumed run writes on after them
+    global JOURNAL_APPEND
+    JOURNAL_APPEND = args.resume
+    if args.command in ("apply", "skew"):
+        _run_journal["journal"] = open_journal(f"{args.command}-{datetime.now():%Y%m%d-%H%M%S}")
+    elif fleet_mode:
+        _run_journal["journal"] = open_journal(f"fleet-{datetime.now():%Y%m%d-%H%M%S}")
+    else:
+        _run_journal["journal"] = open_journal(f"{args.project}-{args.region}-{args.cluster}")
+    started = time.time()
+    failed = False
+    interrupted = False
+    try:
+        run(args, fleet_mode)
+    except CommandError as e:
+        log(f"Stopped: {e}")
+        failed = True
+    except KeyboardInterrupt:
+        log("Interrupted." + (f" Pass --resume to continue from {args.checkpoint_file}."
+                              if _checkpoint["file"] else ""))
+        interrupted = True
+    finally:
+        if args.profile:
+            print_profile(time.time() - started)
+        if args.metrics_file:
+            write_metrics_file(args.metrics_file)
+            log(f"Metrics written to {args.metrics_file}")
+        if _checkpoint["file"]:
+            _checkpoint["file"].close()
+        close_journal(_run_journal["journal"])
+    if interrupted:
+        sys.exit(130)
+    if failed:
+        sys.exit(1)
+
+def run(args, fleet_mode):
+    global TRANSPORT, HTTP_POOL_SIZE, OPERATION_POLL_INTERVAL, CACHE_MODE, CACHE_TTL, SIMULATE, QUOTA_SHARE, \
+        PREPULL_IMAGES, DRAIN_WATCH, _policy
+    TRANSPORT = args.transport
+    OPERATION_POLL_INTERVAL = args.poll_interval
+    if TRANSPORT == "api" and httpx is None:
+        log("httpx is not installed, using gcloud/kubectl instead of the API client.")
+        TRANSPORT = "cli"
+
+    # live runs always refetch before changing anything; the cache only serves planning.
+    # apply re-reads the cluster to check the plan's fingerprint, so that read is never cached.
+    dry_run = args.dry_run or args.offline_plan
+    planning = args.command == "plan"
+    CACHE_TTL = args.cache_ttl
+    SIMULATE = not args.no_simulation
+    PREPULL_IMAGES = args.prepull_images
+    DRAIN_WATCH = not args.no_drain_watch
+    QUOTA_SHARE = min(args.max_per_region, args.max_parallel) if fleet_mode or args.command == "apply" else 1
+    if args.no_cache:
+        CACHE_MODE = "off"
+    elif args.offline_plan and args.command != "apply":
+        CACHE_MODE = "only"
+    elif args.command == "apply" or not (dry_run or planning or args.command == "skew"):
+        CACHE_MODE = "refresh"
+    mode = "PLAN" if planning else "SKEW REPORT" if args.command == "skew" else "DRY RUN" if dry_run else "LIVE"
+    log(f"Started {mode}{' APPLY' if args.command == 'apply' else ''} mode at {datetime.now()}\n")
+
+    if args.policy:
+        try:
+            _policy = load_policy(args.policy)
+        except (OSError, ValueError, re.error) as e:
+            log(f"Invalid policy file {args.policy}: {e}")
+            sys.exit(1)
+        log(f"Using approval policy {args.policy} ({len(_policy['rules'])} rules)")
+
+    if args.command in ("upgrade", "apply"):
+        if dry_run:
+            if args.resume:
+                load_checkpoint(args.checkpoint_file, args.command)
+        else:
+            open_checkpoint(args.checkpoint_file, args.command, args.resume)
+
+    if args.command == "apply":
+        plan = load_plan(args.plan_file)
+        # a policy given to apply overrides the decisions recorded at plan time
+        if args.policy:
+            for entry in plan["clusters"]:
+                apply_policy(entry)
+        log(f"Applying {args.plan_file} (planned {plan['created_at']}, {len(plan['clusters'])} clusters)")
+        HTTP_POOL_SIZE = max(HTTP_POOL_SIZE, args.max_parallel)
+        summary = run_fleet(plan["clusters"], resumable(lambda entry: apply_cluster_plan(entry, dry_run)),
+                            args.max_parallel, args.max_per_project, args.max_per_region)
+        log("\nApply Summary:\n")
+        log(tabulate(summary, headers="keys"))
+        exit_if_failed(summary)
+        return
+
+    if args.command == "skew":
+        projects = set(args.discover_project) | {args.project} - {None}
+        if args.inventory:
+            projects |= {target["project"] for target in load_inventory(args.inventory)}
+        if args.invalidate_cache:
+            for project in projects:
+                invalidate_cache(project)
+        started = time.time()
+        index = build_skew_index(sorted(projects), dry_run, args.max_parallel)
+        print_skew_report(index, time.time() - started)
+        return
+
+    if args.invalidate_cache:
+        if fleet_mode:
+            for project in args.discover_project:
+                invalidate_cache(project)
         else:
-            log("DRY RUN: Would prompt to continue despite risky workloads.")
+            invalidate_cache(args.project, args.region, args.cluster)
+
+    # plan entries are collected as the clusters finish and written in one go at the end
+    entries = []
+
+    def plan_target(target):
+        entry, _ = plan_cluster(target["project"], target["region"], target["cluster"], True)
+        entries.append(entry)
+        return plan_rows(entry)
+
+    def upgrade_target(target):
+        return upgrade_cluster(target["project"], target["region"], target["cluster"], dry_run)
 
-    log("\nUpgrade Summary:\n")
-    log(tabulate(results, headers="keys"))
-    write_log_file(args.project, args.region, args.cluster)
+    cluster_fn = plan_target if planning else resumable(upgrade_target)
+    if not fleet_mode:
+        summary = cluster_fn({"project": args.project, "region": args.region, "cluster": args.cluster})
+        log("\nPlan:\n" if planning else "\nUpgrade Summary:\n")
+        log(tabulate(summary, headers="keys"))
+    else:
+        HTTP_POOL_SIZE = max(HTTP_POOL_SIZE, args.max_parallel)
+        inventory = load_inventory(args.inventory) if args.inventory else []
+        if args.invalidate_cache:
+            for target in inventory:
+                invalidate_cache(target["project"], target["region"], target["cluster"])
+        for project in args.discover_project:
+            inventory.extend(discover_clusters(project, dry_run))
+
+        # clusters the skew index shows as level are done without touching them
+        index = build_skew_index(sorted({target["project"] for target in inventory}), dry_run, args.max_parallel)
+        # clusters missing from the index (e.g. an inventory region that is really a zone) are still processed
+        level = [target for target in inventory
+                 if index.get((target["project"], target["region"], target["cluster"]), {}).get("pools behind") == 0]
+        inventory = [target for target in inventory if target not in level]
+        log(f"Fleet run over {len(inventory)} clusters, {len(level)} already level "
+            f"(max {args.max_parallel} at once, {args.max_per_project} per project, {args.max_per_region} per region)")
+
+        summary = run_fleet(inventory, cluster_fn, args.max_parallel, args.max_per_project, args.max_per_region)
+        summary += [{"project": target["project"], "region": target["region"], "cluster": target["cluster"],
+                     "nodepool": "-", "status": "No upgrades needed"} for target in level]
+        summary.sort(key=lambda row: (row["project"], row["region"], row["cluster"]))
+        log("\nFleet Plan:\n" if planning else "\nFleet Upgrade Summary:\n")
+        log(tabulate(summary, headers="keys"))
+
+    if planning:
+        write_plan(args.plan_file, entries)
+        log(f"\nPlan for {len(entries)} clusters written to {args.plan_file}; "
+            f"run '{os.path.basename(sys.argv[0])} apply --plan-file {args.plan_file}' to carry it out.")
+    else:
+        exit_if_failed(summary)
 
 if __name__ == "__main__":
     main()
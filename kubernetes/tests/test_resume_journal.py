@@ -0,0 +1,62 @@
+"""
+A --resume run must write on after the journals of the run it continues, not replace them.
+
+Runs nodepoolUpgrader.py live against fake-gke-api.py, then again with --resume in the same
+directory, and checks the cluster's .jsonl and .log still hold what the first run wrote.
+
+    python -m pytest kubernetes/tests
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from common import KUBERNETES_DIR, write_runnable_script  # noqa: E402
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def run_upgrader(script, cwd, env, *extra):
+    cmd = [sys.executable, script, "--project", "test-project", "--region", "us-central1",
+           "--cluster", "fake-cluster", "--no-cache", "--no-drain-watch", "--poll-interval", "0.1", *extra]
+    # answers "yes" to every confirmation the run asks for
+    return subprocess.run(cmd, cwd=cwd, env=env, input="y\n" * 20, capture_output=True, text=True, timeout=120)
+
+def test_resume_keeps_the_earlier_journal(tmp_path):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(KUBERNETES_DIR, "fake-gke-api.py"), "--port", str(port),
+                               "--node-pools", "2", "--deployments", "10", "--pdbs", "2", "--seconds-per-node", "0"],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        # it prints the exports once it is listening
+        server.stdout.readline()
+        endpoint = f"http://127.0.0.1:{port}"
+        env = dict(os.environ, GKE_API_ENDPOINT=endpoint, KUBE_API_ENDPOINT=endpoint, COMPUTE_API_ENDPOINT=endpoint,
+                   GKE_ACCESS_TOKEN="fake-token", NODEPOOL_UPGRADER_CACHE_DIR=str(tmp_path / "cache"))
+        script = write_runnable_script("nodepoolUpgrader.py", str(tmp_path))
+
+        first = run_upgrader(script, tmp_path, env)
+        assert first.returncode == 0, first.stdout[-2000:] + first.stderr[-2000:]
+        with open(tmp_path / "test-project-us-central1-fake-cluster.jsonl") as f:
+            earlier = f.read()
+        assert "started operation" in earlier
+
+        resumed = run_upgrader(script, tmp_path, env, "--resume")
+        assert resumed.returncode == 0, resumed.stdout[-2000:] + resumed.stderr[-2000:]
+    finally:
+        server.terminate()
+        server.wait()
+
+    with open(tmp_path / "test-project-us-central1-fake-cluster.jsonl") as f:
+        journal = f.read()
+    assert journal.startswith(earlier)
+    messages = [json.loads(line).get("msg", "") for line in journal[len(earlier):].splitlines()]
+    assert any(message.startswith("Resuming the run") for message in messages)
+    with open(tmp_path / "test-project-us-central1-fake-cluster.log") as f:
+        log = f.read()
+    assert "started operation" in log and "Resuming the run" in log